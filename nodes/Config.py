@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Configuration snapshot of the pHin node server
+
+The custom parameters are validated once per change into a read-only
+Config. The controller swaps in a new snapshot when Polyglot sends
+changed parameters, config and poll code (also on the poll worker
+thread) only ever read a snapshot, so they never see half of a change.
+
+Copyright (C) 2020 starcode911
+"""
+
+import re
+import json
+from types import MappingProxyType
+
+
+EMAIL_PATTERN = re.compile(r"[^@]+@[^@]+\.[^@]+")
+
+
+#
+# The value if it is set and at least length characters long
+#
+def minLength(value, length):
+    if not value or len(value) < length:
+        return None
+    return value
+
+
+class Config(object):
+
+    __slots__ = ('params', 'email', 'uuid', 'verifyUrl', 'activationCode', 'authToken',
+                 'refreshToken', 'refreshUrl', 'vesselUrl', 'vesselUrls', 'logLevel',
+                 'metricsFile', 'metricsPort', 'influxFile', 'mqttHost', 'mqttPort', 'mqttTopic')
+
+    #
+    # params - customParams sent by Polyglot, invalid values are None
+    #
+    def __init__(self, params=None, logger=None):
+        params = dict(params or {})
+        values = {'params': MappingProxyType(params)}
+
+        email = params.get('email')
+        values['email'] = email if email and EMAIL_PATTERN.search(email) else None
+
+        values['uuid'] = minLength(params.get('uuid'), 20)
+        values['verifyUrl'] = minLength(params.get('verifyurl'), 20)
+        values['authToken'] = minLength(params.get('authtoken'), 40)
+        values['vesselUrl'] = minLength(params.get('vesselurl'), 20)
+        values['refreshToken'] = params.get('refreshtoken') or None
+        values['refreshUrl'] = params.get('refreshurl') or None
+        values['metricsFile'] = params.get('metricsfile') or None
+        values['metricsPort'] = params.get('metricsport') or None
+        values['influxFile'] = params.get('influxfile') or None
+        values['mqttTopic'] = params.get('mqtttopic') or 'phin'
+
+        #
+        # mqtthost is host or host:port of the broker readings are sent to
+        #
+        mqtthost, mqttport = params.get('mqtthost') or None, 1883
+        if mqtthost and ':' in mqtthost:
+            mqtthost, port = mqtthost.rsplit(':', 1)
+            try:
+                mqttport = int(port)
+            except ValueError:
+                if logger is not None:
+                    logger.error('status=invalid_mqtthost mqtthost=%s', params['mqtthost'])
+                mqtthost = None
+        values['mqttHost'] = mqtthost or None
+        values['mqttPort'] = mqttport
+
+        activationcode = params.get('activationcode')
+        if not activationcode or len(activationcode) > 10 or not activationcode.isnumeric():
+            activationcode = None
+        values['activationCode'] = activationcode
+
+        #
+        # Vessel routes of all locations, installs configured before multiple
+        # locations were supported only have the single vesselurl
+        #
+        vesselurls = None
+        if params.get('vesselurls'):
+            try:
+                vesselurls = json.loads(params['vesselurls'])
+            except ValueError:
+                if logger is not None:
+                    logger.error('status=invalid_vesselurls vesselurls=%s', params['vesselurls'])
+            if not isinstance(vesselurls, list) or len(vesselurls) == 0:
+                vesselurls = None
+        if vesselurls is None and values['vesselUrl']:
+            vesselurls = [values['vesselUrl']]
+        values['vesselUrls'] = tuple(vesselurls) if vesselurls else None
+
+        try:
+            loglevel = int(params.get('loglevel', 10))
+        except (TypeError, ValueError):
+            loglevel = 10
+        values['logLevel'] = min(max(loglevel, 0), 50)
+
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is read only')
+
+    #
+    # Raw value of a custom parameter, None if it is not set
+    #
+    def get(self, key):
+        return self.params.get(key)
+
+    #
+    # True if the snapshot was built from these customParams
+    #
+    def matches(self, params):
+        return dict(self.params) == dict(params or {})
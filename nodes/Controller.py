@@ -2,7 +2,8 @@
 """
 Polyglot v2 node server pHin Smart Water Monitor data
 
-This version only support a single pHin monitor
+Every body of water (vessel) of every pHin location is added as a
+child node, the controller node mirrors the first vessel
 
 Copyright (C) 2020 starcode911
 """
@@ -17,21 +18,43 @@ import datetime
 import requests
 import socket
 import math
-import re
 import json
+import threading
+from contextlib import contextmanager, ExitStack
 import uuid;
 
 
-from pyPhin import pHin
+from pyPhin import pHin, pHinAuth, pHinUnauthorized
+from pyPhinBreaker import pHinCircuitOpen
+from pyPhinTrace import jsonTracer, profile
+from pyPhinStore import pHinStore
+from pyPhinBackfill import pHinBackfill
+from pyPhinSinks import batchingSink, influxFileSink, mqttSink, readings
+from nodes.Vessel import Vessel, vesselAddress
+from nodes.Drivers import VESSEL_DRIVERS, TREND_DRIVERS, CONTROLLER_MAP, VESSEL_MAP, driverList, driverUpdates, sendUpdates
+from nodes.PollScheduler import PollScheduler
+from nodes.DriverReporter import DriverReporter
+from nodes.Snapshot import Snapshot
+from nodes.Config import Config
+from nodes.PollWorker import PollWorker
 
 LOGGER = polyinterface.LOGGER
 
+#
+# DEBUG command value that profiles and traces the next poll
+#
+PROFILE_LEVEL = 5
+
 class Controller(polyinterface.Controller):
 
     id = 'phin'
     hint = [0,0,0,0]
  
-    def __init__(self, polyglot):
+    #
+    # storePath - SQLite database of the chart history
+    # snapshotPath - JSON file the values of the last poll are kept in
+    #
+    def __init__(self, polyglot, storePath='phin.db', snapshotPath='phin-snapshot.json'):
         super(Controller, self).__init__(polyglot)
 
         self.name       = 'pHin Smart Water Monitor'
@@ -49,7 +72,23 @@ class Controller(polyinterface.Controller):
 
         self.uom        = {}
         self.logger     = polyinterface.LOGGER
-        self.phin       = pHin(LOGGER)
+        self.store      = pHinStore(storePath, LOGGER)
+        self.phin       = pHin(LOGGER, seriesStore=self.store)
+        self.backfill   = pHinBackfill(self.phin, self.store, LOGGER)
+        self.backfilled = 0
+        self.backfillThread = None
+        self.scheduler  = PollScheduler()
+        self.reporters  = {}
+        self.batches    = threading.local()
+        self.config     = Config()
+        self.auth       = None
+        self.authParam  = None
+        self.failures   = 0
+        self.profileNext = False
+        self.snapshot   = Snapshot(snapshotPath, LOGGER)
+        self.worker     = PollWorker(self.pollPoolData, LOGGER)
+        self.sinks      = []
+        self.sinkConfig = None
 
         self.poly.onConfig(self.processConfig)
 
@@ -64,82 +103,48 @@ class Controller(polyinterface.Controller):
         return deviceuuid;
 
 
-    def getEmail(self):
-            email = self.getCustomParam('email')
+    #
+    # Rebuild the config snapshot if the custom parameters changed, returns
+    # the current snapshot. The snapshot is replaced, never modified, so
+    # the poll worker can read it at any time.
+    #
+    def updateConfig(self, config=None):
+        if config is None:
+            config = self.polyConfig
+        params = (config or {}).get('customParams') or {}
+        if not self.config.matches(params):
+            self.config = Config(params, LOGGER)
+            LOGGER.debug('status=config_updated params=%s', ','.join(sorted(params)))
+        return self.config
 
-            if not email:
-                return None
-            
-            # 
-            # check if we are having a valid email address
-            #
-            regex = "[^@]+@[^@]+\.[^@]+"
-            if(not re.search(regex,email)):  
-                return None
-
-            return email
-
-
-
-    def getUUID(self):
-            uuid = self.getCustomParam('uuid')
-            if not uuid:
-                return None
-            if len(uuid) < 20:
-                return None
-            return uuid
-
-    def getVerifyURL(self):
-            verifyurl = self.getCustomParam('verifyurl')
-            if not verifyurl:
-                return None
-            if len(verifyurl) < 20:
-                return None
-            return verifyurl
-
-    def getActivationCode(self):
-            activationcode = self.getCustomParam('activationcode')
-            if not activationcode:
-                return None
-            if len(activationcode) > 10:
-                return None
-            if not activationcode.isnumeric():
-                return None
-            return activationcode
-
-
-    def getAuthToken(self):
-        authtoken = self.getCustomParam('authtoken')
+    #
+    # Tokens used to query the service. The auth token is refreshed with
+    # the refresh token before it expires, and when it is rejected, so the
+    # activation code only has to be entered again if that fails. Installs
+    # configured before refresh tokens were saved have no refreshtoken.
+    #
+    def getAuth(self, config=None):
+        if config is None:
+            config = self.config
+        authtoken = config.authToken
         if not authtoken:
             return None
-        if len(authtoken) < 40:
-            return None
-        return authtoken
-  
-    def getVesselURL(self):
-        vesselurl = self.getCustomParam('vesselurl')
-        if not vesselurl:
-            return None
-        if len(vesselurl) < 20:
-            return None
-        return vesselurl
-
-
-    def getLogLevel(self):
-        loglevel = self.getCustomParam('loglevel')
-        if loglevel is None:
-            loglevel = 10
-
-        loglevel = int(loglevel)
-
-        if loglevel < 0:
-            loglevel = 0
-
-        if loglevel > 50:
-            loglevel = 50
-
-        return loglevel
 
+        #
+        # a refreshed token is only in the params once Polyglot sent the
+        # config back, rebuild only for a token entered by activation
+        #
+        if self.auth is None or authtoken not in (self.authParam, self.auth.authToken):
+            self.auth = pHinAuth(authtoken,
+                                 config.refreshToken,
+                                 config.refreshUrl,
+                                 onRefresh=self.saveTokens)
+        self.authParam = authtoken
+        return self.auth
+
+    def saveTokens(self, auth):
+        LOGGER.info('status=token_refreshed expires=%s', auth.expires)
+        self.addCustomParam({'authtoken' : auth.authToken, 'refreshtoken' : auth.refreshToken})
 
     #
     #
@@ -165,11 +170,16 @@ class Controller(polyinterface.Controller):
         self.removeNoticesAll()
 
         self.removeCustomParam('authtoken')
+        self.removeCustomParam('refreshtoken')
+        self.removeCustomParam('refreshurl')
         self.removeCustomParam('vesselurl')
+        self.removeCustomParam('vesselurls')
         self.removeCustomParam('activationcode')
 
         self.addActivationCodeParam(True)
 
+        self.auth = None
+
         self.registering = False
         self.registered = False
         self.activating = False
@@ -196,11 +206,13 @@ class Controller(polyinterface.Controller):
         if self.configuring is True: 
             return
 
+        settings = self.updateConfig(config)
+
         #
         # if we have an auth token we are all set and
         # can query the service
         #
-        if not self.getAuthToken():
+        if not settings.authToken:
 
             LOGGER.debug('status=CONFIG_INCOMPLETE registering=%r registered=%r activating=%r activated=%r',
                                 self.registering,
@@ -210,7 +222,7 @@ class Controller(polyinterface.Controller):
                         )
 
 
-            if self.getCustomParam('email')  is None:
+            if settings.get('email')  is None:
                 
                 LOGGER.debug('status=CONFIG_REQUEST_EMAIL')
 
@@ -220,20 +232,26 @@ class Controller(polyinterface.Controller):
                 self.addNotice('Enter the email you used to register with pHin', 'email')
 
 
-            if self.getEmail() is not None:
+            if settings.email is not None:
 
                 #
                 # we have a valid email new lets set a UUID
                 #
-                if self.getUUID() is None:
+                if settings.uuid is None:
 
                     LOGGER.debug("status=CONFIG_ADDING_UUID email=%s uuid=%s",
-                                    self.getEmail(),   
-                                    self.getUUID()
+                                    settings.email,   
+                                    settings.uuid
                                 )
 
                     self.addCustomParam({'uuid' : self.getGeneratedUUID()})    
 
+                    #
+                    # the snapshot is immutable, rebuild it so the new
+                    # uuid registers in this pass
+                    #
+                    settings = self.updateConfig(config)
+
 
             #
             # we have an email but uuid has not been set yet, in this
@@ -242,8 +260,8 @@ class Controller(polyinterface.Controller):
             # If we already have a verifyURL we have registered already
             # and are waiting for the user to enter the validation code
             #
-            if self.getEmail() and self.getUUID() and self.registering is False:
-                if not self.getVerifyURL():
+            if settings.email and settings.uuid and self.registering is False:
+                if not settings.verifyUrl:
 
                     self.registering = True
 
@@ -254,18 +272,19 @@ class Controller(polyinterface.Controller):
                     # for the next step
                     #
                     LOGGER.info("status=CONFIG_REGISTER email=%s uuid=%s", 
-                                    self.getEmail(), 
-                                    self.getUUID()
+                                    settings.email, 
+                                    settings.uuid
                                 )
 
-                    verifyurl = self.phin.login(self.getEmail(), self.getUUID())
+                    verifyurl = self.phin.login(settings.email, settings.uuid)
 
                     self.addCustomParam({'verifyurl' : verifyurl})
+                    settings = self.updateConfig(config)
 
                     LOGGER.info("status=CONFIG_REGISTER_COMPLETED email=%s uuid=%s verifyurl=%s", 
-                                    self.getEmail(), 
-                                    self.getUUID(),
-                                    self.getVerifyURL(),
+                                    settings.email, 
+                                    settings.uuid,
+                                    verifyurl,
                                 )
                  
                     self.removeNoticesAll()
@@ -277,21 +296,25 @@ class Controller(polyinterface.Controller):
 
 
                 else:
-                    if self.getActivationCode() is not None and self.activating is False and self.activated is False:
+                    if settings.activationCode is not None and self.activating is False and self.activated is False:
 
                         self.activating = True
 
                         LOGGER.debug("status=CONFIG_ACTIVATING email=%s uuid=%s verifyurl=%s activationcode=%s", 
-                                                self.getEmail(), 
-                                                self.getUUID(),
-                                                self.getVerifyURL(),
-                                                self.getActivationCode()
+                                                settings.email, 
+                                                settings.uuid,
+                                                settings.verifyUrl,
+                                                settings.activationCode
                                     )
 
                         try:
-                            authdata = self.phin.verify(self.getEmail(), self.getUUID(), self.getVerifyURL(), self.getActivationCode())
+                            authdata = self.phin.verify(settings.email, settings.uuid, settings.verifyUrl, settings.activationCode)
                             self.addCustomParam({'authtoken' : authdata['authToken']})
+                            self.addCustomParam({'refreshtoken' : authdata['refreshToken']})
+                            self.addCustomParam({'refreshurl' : authdata['refreshUrl']})
                             self.addCustomParam({'vesselurl' : authdata['vesselUrl']})
+                            self.addCustomParam({'vesselurls' : json.dumps(authdata['vesselUrls'])})
+                            settings = self.updateConfig(config)
 
                             #
                             # Setup configuraton has been completed. At this time we do no longer
@@ -299,10 +322,10 @@ class Controller(polyinterface.Controller):
                             # TODO: Delete them?
                             #
                             LOGGER.debug("status=CONFIG_COMPLETED email=%s uuid=%s vesselurl=%s authtoken=%s", 
-                                                self.getEmail(), 
-                                                self.getUUID(),
-                                                self.getVesselURL(),
-                                                self.getAuthToken()
+                                                settings.email, 
+                                                settings.uuid,
+                                                settings.vesselUrl,
+                                                settings.authToken
                                         )
 
                             self.removeNoticesAll()
@@ -310,7 +333,7 @@ class Controller(polyinterface.Controller):
                             #
                             #  get the data
                             #
-                            self.queryPoolData()
+                            self.queryPoolData('verify', fresh=True)
 
 
                         except Exception as err:
@@ -323,10 +346,10 @@ class Controller(polyinterface.Controller):
                                 self.addActivationCodeParam();
                                 self.restartNodeServer()
             else:
-                LOGGER.debug('status=passconfig authtoken=%s', self.getAuthToken())
+                LOGGER.debug('status=passconfig authtoken=%s', settings.authToken)
 
         else:
-            LOGGER.debug('status=noauthtoken authtoken=%s', self.getAuthToken())
+            LOGGER.debug('status=noauthtoken authtoken=%s', settings.authToken)
 
 
         LOGGER.debug('status=END_processConfig')
@@ -335,118 +358,362 @@ class Controller(polyinterface.Controller):
     
     def start(self):
         LOGGER.info('Starting node server')
+        self.updateConfig()
         self.setLogLevel()
+        self.serveMetrics()
 
         LOGGER.info('Node server started')
 
         #
-        # Do an initial query to get filled in as soon as possible
+        # Publish the last known values right away, the initial query runs
+        # on the poll worker so the drivers never show zeros while the
+        # service is slow or down
         #
-        self.queryPoolData()
+        self.restoreSnapshot()
+        self.queryPoolData('start')
 
     def longPoll(self):
         LOGGER.info('longPoll')
 
+    #
+    # shortPoll only sets the granularity, the scheduler decides when
+    # new data is expected and the service should be queried
+    #
     def shortPoll(self):
         LOGGER.info('shortPoll')
-        self.queryPoolData()
+        if self.scheduler.isDue():
+            self.queryPoolData('shortPoll')
+        else:
+            LOGGER.debug('status=poll_skipped nextpoll=%s',
+                            datetime.datetime.fromtimestamp(self.scheduler.nextPoll))
+        self.updateDataAge()
 
 
     #
-    # If we have an auth token query the pHin service for the pool data
+    # Ask the poll worker to query the pHin service, returns right away
+    # with the (possibly shared) poll, use .wait() to wait for it
     #
-    def queryPoolData(self):
+    def queryPoolData(self, reason='poll', fresh=False):
 
-        LOGGER.info('queryPoolData')
+        LOGGER.info('queryPoolData reason=%s', reason)
+
+        return self.worker.trigger(reason, fresh)
+
+    #
+    # If we have an auth token query the pHin service for the pool data,
+    # runs on the poll worker thread. The whole poll uses the config
+    # snapshot current when it started.
+    #
+    def pollPoolData(self):
 
-        if self.getAuthToken():
+        config = self.config
+        if config.authToken:
+            started = time.time()
             try:
-                data = self.phin.getData(self.getAuthToken(), self.getUUID(), self.getVesselURL())
+                vessels = self.getVesselsData(config)
+            except pHinCircuitOpen as err:
+                #
+                # The service keeps failing, do not query it again before
+                # the circuit breaker lets requests through
+                #
+                LOGGER.warning('status=circuit_open error=%s', str(err))
+                vessels = None
+                self.scheduler.failure(retryAt=err.retryAt)
+            except pHinUnauthorized as err:
+                #
+                # Auth token is no longer valid and could not be refreshed,
+                # user will need to enter a new registration code from their
+                # email in order to obtain a new token
+                #
+                LOGGER.error('exception phin.getData error=%s', str(err))
+                self.resetConfig()
+                self.restartNodeServer()
+
+                vessels = None
+                self.scheduler.failure()
             except Exception as err:
-                e = str(err)
                 LOGGER.error('exception phin.getData error=%s', str(err))
-                if e.find('Unauthorized') != -1:
-                    #
-                    # Auth token is no longer valid, user will need to enter a new
-                    # registration code from their email in order to obtain
-                    # a new token
-                    #
-                    self.resetConfig()
-                    self.restartNodeServer()
-
-                data = None
-
-            LOGGER.debug('phin.getData data='+str(data))
-            if data:
-                if data.__contains__("pool"):
-                    poolData = data["pool"]
-                    if poolData.__contains__("status_id"):
-                        self.setDriver('GV2', int(poolData['status_id']), force=True)
-                    if poolData.__contains__("test_strip_required"):
-                        teststrip = 0
-                        if poolData['test_strip_required'] is True:
-                            teststrip = 1 
-                        self.setDriver('GV11', teststrip, force=True)
-                else:
-                     LOGGER.error("status=no_pooldata")
-
-                if data.__contains__("waterData"):
-                    waterData = data["waterData"]
-                    if waterData.__contains__("temperature"):
-                        self.setDriver('WATERT', waterData['temperature'], force=True)
-                    if waterData.__contains__("ta"):
-                        self.setDriver('GV3', waterData['ta'], force=True)
-                    if waterData.__contains__("cya"):
-                        self.setDriver('GV4', waterData['cya'], force=True)
-                    if waterData.__contains__("th"):
-                        self.setDriver('GV5', waterData['th'], force=True)
-
-                    if waterData.__contains__("ph"):
-                        phData = waterData['ph']
-                        if phData.__contains__("value"):
-                            self.setDriver('GV1', round(phData['value'], 1), force=True)
-                        if phData.__contains__("status"):
-                            self.setDriver('GV6', int(phData['status']), force=True)
-                    else:
-                        LOGGER.error("status=no_ph")
-
-                    if waterData.__contains__("orp"):
-                        orpData = waterData['orp']
-                        if orpData.__contains__("value"):
-                            self.setDriver('GV7', orpData['value'], force=True)
-                        if orpData.__contains__("status"):
-                            self.setDriver('GV8', int(orpData['status']), force=True)
-                    else:
-                        LOGGER.error("status=no_orpdata")
-                else:
-                    LOGGER.error("status=no_waterdata")
+                vessels = None
+                self.scheduler.failure()
+            else:
+                self.scheduler.success(self.phin.getChartChanges())
 
+            LOGGER.debug('phin.getVesselsData data='+str(vessels))
 
-                if data.__contains__("vesselData"):
+            latency = time.time() - started
+            self.updatePollMetrics(latency, vessels is not None)
 
-                    vesselData = data["vesselData"]
+            updates = []
+            if vessels:
+                self.snapshot.save(vessels)
+                updates = self.mapDrivers(vessels)
 
-                    if vesselData.__contains__("battery"):
-                            batteryData = vesselData["battery"]
+            #
+            # the driver changes of the poll are reported per node when
+            # the batch ends, the batch only covers setting the drivers
+            #
+            with self.reportBatch():
+                self.setPollDrivers(latency)
+                self.publish(updates)
 
-                            if batteryData.__contains__("percentage"):
-                                self.setDriver('GV9', (batteryData['percentage']*100), force=True)
-                    else:
-                        LOGGER.error("status=no_batterydata")
+                #
+                # if the query failed the last known values stay published,
+                # the data age tells ISY programs how old they are
+                #
+                self.updateDataAge()
 
-                    if vesselData.__contains__("rssi"):  
-                            rssiData = vesselData["rssi"]
-
-                            if rssiData.__contains__("value"):
-                                self.setDriver('GV10', data['vesselData']['rssi']['value'], force=True)
-                    else:
-                        LOGGER.error("status=no_rssidata")
-                else:
-                    LOGGER.error("status=no_vesseldata")
+            if vessels:
+                self.exportReadings(config, vessels)
+                self.backfillHistory(config)
 
         else:
                 LOGGER.debug("status=noauthtoken")
-            
+
+
+    #
+    # Map the data to driver updates of the controller (first vessel, with
+    # the pH and ORP trends) and of every vessel, adding vessel nodes that
+    # are new. Paths missing from the data are logged once per poll.
+    # Returns [(node, [(driver, value)])] for publish().
+    #
+    def mapDrivers(self, vessels):
+        nodes = [(self, vessels[0], CONTROLLER_MAP)]
+        nodes.extend((self.getVesselNode(data['vessel']), data, VESSEL_MAP) for data in vessels)
+
+        updates = []
+        missing = set()
+        for node, data, driverMap in nodes:
+            nodeUpdates, absent = driverUpdates(data, driverMap)
+            updates.append((node, nodeUpdates))
+            missing.update(absent)
+
+        if missing:
+            LOGGER.error('status=missing_fields paths=%s', ','.join(sorted(missing)))
+        return updates
+
+    #
+    # Set the driver updates of mapDrivers()
+    #
+    def publish(self, updates):
+        for node, nodeUpdates in updates:
+            sendUpdates(self.getReporter(node), nodeUpdates)
+
+    #
+    # Queue the readings of the poll for the sinks set in the influxfile
+    # and mqtthost parameters. The sinks write in the background, a slow
+    # or unreachable sink drops its oldest readings instead of holding
+    # up the poll.
+    #
+    def exportReadings(self, config, vessels):
+        self.updateSinks(config)
+        if not self.sinks:
+            return
+        batch = readings(vessels, config.uuid)
+        for sink in self.sinks:
+            sink.put(batch)
+
+    #
+    # Rebuild the sinks when their parameters changed
+    #
+    def updateSinks(self, config):
+        sinkConfig = (config.influxFile, config.mqttHost, config.mqttPort, config.mqttTopic)
+        if sinkConfig == self.sinkConfig:
+            return
+        self.closeSinks(wait=False)
+        self.sinkConfig = sinkConfig
+
+        sinks = []
+        try:
+            if config.influxFile:
+                sinks.append(influxFileSink(config.influxFile, maxBytes=10000000))
+            if config.mqttHost:
+                sinks.append(mqttSink(config.mqttHost, config.mqttPort, config.mqttTopic))
+        except Exception as err:
+            LOGGER.error('status=sink_failed error=%s', str(err))
+        self.sinks = [batchingSink(sink, metrics=self.phin.metrics, logger=LOGGER) for sink in sinks]
+        if self.sinks:
+            LOGGER.info('status=sinks_started sinks=%s', ','.join(sink.name for sink in self.sinks))
+
+    #
+    # Flush and close the sinks, at most timeout seconds each. Sinks that
+    # are replaced are closed on their own thread (wait=False) so a slow
+    # sink does not hold up the poll worker.
+    #
+    def closeSinks(self, timeout=5, wait=True):
+        sinks, self.sinks = self.sinks, []
+        if not sinks:
+            return
+
+        def close():
+            for sink in sinks:
+                sink.close(timeout)
+
+        if wait:
+            close()
+        else:
+            threading.Thread(target=close, name='phin-sink-close', daemon=True).start()
+
+    #
+    # Download the chart routes of the vessels that come with timestamps
+    # into the local store for the long range rollups, at most once per
+    # backfill interval. The checkpoints in the store keep charts that did
+    # not change, and undated charts, from being downloaded again. The
+    # backfill runs on its own thread so its downloads never delay the
+    # next poll or count towards the poll latency.
+    #
+    def backfillHistory(self, config):
+        if time.time() - self.backfilled < self.backfill.minInterval:
+            return
+        if self.backfillThread is not None and self.backfillThread.is_alive():
+            return
+        self.backfilled = time.time()
+        self.backfillThread = threading.Thread(target=self.runBackfill, args=(config,),
+                                               name='phin-backfill', daemon=True)
+        self.backfillThread.start()
+
+    def runBackfill(self, config):
+        try:
+            self.backfill.run(self.getAuth(config), config.uuid, config.vesselUrls)
+        except Exception as err:
+            LOGGER.error('status=backfill_failed error=%s', str(err))
+
+    #
+    # Publish the values of the last successful poll before a restart
+    #
+    def restoreSnapshot(self):
+        vessels = self.snapshot.load()
+        if not vessels:
+            return
+        LOGGER.info('status=snapshot_restored vessels=%d age=%ds', len(vessels), self.snapshot.getAge())
+        updates = self.mapDrivers(vessels)
+        with self.reportBatch():
+            self.publish(updates)
+            self.updateDataAge()
+
+    #
+    # Minutes since the published values were fetched (GV14)
+    #
+    def updateDataAge(self):
+        age = self.snapshot.getAge()
+        if age is None:
+            return
+        self.getReporter(self).setDriver('GV14', int(age // 60))
+
+    #
+    # Query all vessels, under cProfile and with every request and parse
+    # stage traced to phin-trace.jsonl if profiling was requested with
+    # the DEBUG command
+    #
+    def getVesselsData(self, config):
+        query = lambda: self.phin.getVesselsData(self.getAuth(config), config.uuid, config.vesselUrls)
+        if not self.profileNext:
+            return query()
+
+        self.profileNext = False
+        tracer = jsonTracer('phin-trace.jsonl').attach(self.phin)
+        try:
+            vessels, stats = profile(query, 'phin-profile.txt', client=self.phin)
+        finally:
+            tracer.close()
+
+        LOGGER.info('status=poll_profiled profile=phin-profile.txt trace=phin-trace.jsonl\n%s', stats)
+        return vessels
+
+    #
+    # Poll latency and failed polls in a row are recorded as metrics,
+    # setPollDrivers() mirrors them to the GV12 and GV13 drivers
+    #
+    def updatePollMetrics(self, latency, succeeded):
+        if succeeded:
+            self.failures = 0
+        else:
+            self.failures += 1
+
+        self.phin.metrics.observe('phin_poll_seconds', latency)
+        self.phin.metrics.set('phin_poll_failures', self.failures)
+
+        self.writeMetrics()
+
+    #
+    # Poll latency (GV12) and failed polls in a row (GV13)
+    #
+    def setPollDrivers(self, latency):
+        reporter = self.getReporter(self)
+        reporter.setDriver('GV12', round(latency, 1))
+        reporter.setDriver('GV13', self.failures)
+
+    #
+    # Metrics are exported in the Prometheus text format to the file set in
+    # the metricsfile parameter and/or on the local HTTP port set in the
+    # metricsport parameter
+    #
+    def writeMetrics(self):
+        metricsfile = self.config.metricsFile
+        if not metricsfile:
+            return
+        try:
+            self.phin.metrics.writeFile(metricsfile)
+        except (IOError, OSError) as err:
+            LOGGER.error('status=metrics_write_failed file=%s error=%s', metricsfile, str(err))
+
+    def serveMetrics(self):
+        metricsport = self.config.metricsPort
+        if not metricsport:
+            return
+        try:
+            self.phin.metrics.serve(int(metricsport))
+            LOGGER.info('status=metrics_serving port=%s', metricsport)
+        except (ValueError, OSError) as err:
+            LOGGER.error('status=metrics_serve_failed port=%s error=%s', metricsport, str(err))
+
+    #
+    # Get the child node of a vessel, adding it if we did not see
+    # this vessel before
+    #
+    def getVesselNode(self, vesselInfo):
+        address = vesselAddress(vesselInfo)
+        if address not in self.nodes:
+            LOGGER.info('status=add_vessel address=%s name=%s', address, vesselInfo['name'])
+            self.addNode(Vessel(self, self.address, address, vesselInfo['name']))
+        return self.nodes[address]
+
+    #
+    # Change-only driver reporting for a node
+    #
+    def getReporter(self, node):
+        if node.address not in self.reporters:
+            self.reporters[node.address] = DriverReporter(node)
+        reporter = self.reporters[node.address]
+
+        stack = getattr(self.batches, 'stack', None)
+        if stack is not None and node.address not in self.batches.nodes:
+            self.batches.nodes.add(node.address)
+            stack.enter_context(reporter.batch())
+        return reporter
+
+    #
+    # Batch the driver changes of every node used in the block on this
+    # thread, each node reports its changes once when the block ends
+    #
+    @contextmanager
+    def reportBatch(self):
+        if getattr(self.batches, 'stack', None) is not None:
+            yield
+            return
+        with ExitStack() as stack:
+            self.batches.stack = stack
+            self.batches.nodes = set()
+            try:
+                yield
+            finally:
+                self.batches.stack = None
+
+    #
+    # Adds nodes for all vessels
+    #
+    def discover(self, *args, **kwargs):
+        LOGGER.info('discover')
+        self.queryPoolData('discover')
 
     def query(self):
         LOGGER.info('query')
@@ -457,6 +724,10 @@ class Controller(polyinterface.Controller):
 
     def stop(self):
         LOGGER.info('Stopping node server')
+        self.worker.stop(10)
+        if self.backfillThread is not None:
+            self.backfillThread.join(10)
+        self.closeSinks()
 
     def updateProfile(self, command):
         st = self.poly.installprofile()
@@ -477,12 +748,20 @@ class Controller(polyinterface.Controller):
         LOGGER.debug("loglevel=%s", str(level))
 
         if level is None:
-            loglevel = self.getLogLevel()
+            loglevel = self.config.logLevel
         else:
             if level is not None:
                 if level.__contains__("value"):
                     loglevel = int(level["value"])
 
+        if loglevel == PROFILE_LEVEL:
+            #
+            # profile the next poll and log at debug level
+            #
+            LOGGER.info('status=profile_next_poll')
+            self.profileNext = True
+            loglevel = 10
+
         self.setDriver('GV20', int(loglevel), force=True)
         self.addCustomParam({'loglevel' : loglevel})
 
@@ -491,31 +770,25 @@ class Controller(polyinterface.Controller):
 
 
     commands = {
+        'DISCOVER': discover,
         'UPDATE_PROFILE': updateProfile,
         'REMOVE_NOTICES_ALL': removeAllNotices,
         'DEBUG': setLogLevel,
     }
 
     #
-    # For this node server, all of the info is available in the single
-    # controller node.
-    #
-    drivers = [
-            {'driver': 'ST', 'value': 1, 'uom': 2},   # node server status
-            {'driver': 'WATERT', 'value': 0, 'uom': 17},   # water temperature
-            {'driver': 'GV1', 'value': 0, 'uom': 56},       # pH level
-            {'driver': 'GV2', 'value': 0, 'uom': 25},       # status
-            {'driver': 'GV3', 'value': 0, 'uom': 54},       # TA
-            {'driver': 'GV4', 'value': 0, 'uom': 54},       # CYA
-            {'driver': 'GV5', 'value': 0, 'uom': 54},       # TH
-            {'driver': 'GV6', 'value': 0, 'uom': 25},       # pH Status 
-            {'driver': 'GV7', 'value': 0, 'uom': 43},       # ORP
-            {'driver': 'GV8', 'value': 0, 'uom': 25},       # ORP Status
-            {'driver': 'GV9', 'value': 0, 'uom': 51},       # Battery
-            {'driver': 'GV10', 'value': 0, 'uom': 12},       # RSSI
-            {'driver': 'GV11', 'value': 0, 'uom': 2},       # Test Strip
+    # The controller node shows the first vessel, every vessel also
+    # has its own child node (see nodes/Vessel.py). The vessel and trend
+    # drivers are defined with their mapping in nodes/Drivers.py.
+    #
+    drivers = ([{'driver': 'ST', 'value': 1, 'uom': 2}] +   # node server status
+            driverList(VESSEL_DRIVERS) + [
+            {'driver': 'GV12', 'value': 0, 'uom': 58},      # poll latency
+            {'driver': 'GV13', 'value': 0, 'uom': 56},      # failed polls in a row
+            {'driver': 'GV14', 'value': 0, 'uom': 45},      # data age (minutes)
+            ] + driverList(TREND_DRIVERS) + [
             {'driver': 'GV20', 'value': 0, 'uom': 25},     # log level
-    ]
+    ])
 
 
 
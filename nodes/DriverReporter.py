@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Change-only driver reporting for the pHin node server
+
+Every setDriver that reaches ISY is an MQTT/ISY update and re-triggers ISY
+programs. The reporter only passes a value on when it moved by more than
+the deadband of its driver since it was last reported, and reports every
+driver again once per heartbeat so ISY never drifts from the node server.
+
+Copyright (C) 2020 starcode911
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+
+#
+# Smallest change reported per driver, drivers not listed here are
+# reported on any change
+#
+DEADBANDS = {
+    'WATERT': 0.5,  # water temperature (F)
+    'GV1': 0.05,    # pH
+    'GV7': 5,       # ORP (mV)
+    'GV9': 1,       # battery (%)
+    'GV10': 3,      # RSSI
+    'GV12': 1,      # poll latency (s)
+    'GV14': 5,      # data age (min)
+    'GV15': 0.01,   # pH drift per day
+    'GV16': 1,      # hours until pH leaves ok range
+    'GV17': 5,      # ORP drift per day (mV)
+    'GV18': 1,      # hours until ORP leaves ok range
+}
+
+
+class DriverReporter(object):
+
+    #
+    # node      - node the drivers are reported for
+    # deadbands - smallest change reported per driver
+    # heartbeat - seconds after which a driver is reported even
+    #             if it did not change
+    #
+    def __init__(self, node, deadbands=DEADBANDS, heartbeat=3600):
+        self.node = node
+        self.deadbands = deadbands
+        self.heartbeat = heartbeat
+        self.reported = {}
+        self.lock = threading.Lock()
+        self.batches = threading.local()
+
+    #
+    # Same as node.setDriver, but the value is only reported if it
+    # moved past the deadband or the heartbeat of the driver is due.
+    # Inside batch() on the same thread the value is only collected,
+    # returns None then.
+    #
+    def setDriver(self, driver, value, now=None):
+        if now is None:
+            now = time.time()
+
+        pending = getattr(self.batches, 'pending', None)
+        if pending is not None:
+            pending[driver] = (value, now)
+            return None
+
+        with self.lock:
+            return self.report(driver, value, now)
+
+    def report(self, driver, value, now):
+        last = self.reported.get(driver)
+        if last is None or now - last[1] >= self.heartbeat:
+            self.node.setDriver(driver, value, force=True)
+        elif self.changed(driver, last[0], value):
+            self.node.setDriver(driver, value)
+        else:
+            return False
+
+        self.reported[driver] = (value, now)
+        return True
+
+    #
+    # Collect the driver changes of a block (e.g. one poll) and report them
+    # together when the block ends. A driver set more than once is only
+    # reported with its last value. The changes are collected per thread
+    # without the lock, it is only taken once to report them, so drivers
+    # set on other threads meanwhile are reported right away. Batches can
+    # be nested, the outermost one reports.
+    #
+    @contextmanager
+    def batch(self):
+        outer = getattr(self.batches, 'pending', None) is None
+        if outer:
+            self.batches.pending = {}
+        try:
+            yield self
+        finally:
+            if outer:
+                pending, self.batches.pending = self.batches.pending, None
+                with self.lock:
+                    for driver, (value, now) in pending.items():
+                        self.report(driver, value, now)
+
+    def changed(self, driver, last, value):
+        deadband = self.deadbands.get(driver, 0)
+        try:
+            if deadband > 0:
+                return abs(float(value) - float(last)) >= deadband - 1e-9
+            return float(value) != float(last)
+        except (TypeError, ValueError):
+            return value != last
+
+    #
+    # Forget what was reported so everything is sent on the next update
+    #
+    def reset(self):
+        self.reported = {}
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Driver mapping of the pHin node server
+
+Every driver set from pHin data is one row of a table: the path of the
+value in a pHin.getData() style result, the driver, its UOM and an
+optional transform. The tables are compiled once into pyPhinMapping
+field maps. Every poll maps each node in a single pass to a list of
+(driver, value) updates, adding a driver is adding a row.
+
+Copyright (C) 2020 starcode911
+"""
+
+from pyPhinMapping import fieldMap
+
+
+#
+# Longest forecast reported by the time to threshold drivers, also
+# reported while the trend stays in the ok range
+#
+MAX_FORECAST_HOURS = 168
+
+
+#
+# Hours until a trend leaves the ok range, capped at MAX_FORECAST_HOURS
+#
+def forecastHours(trend):
+    hours = trend.get('hoursToLimit')
+    if hours is None or hours > MAX_FORECAST_HOURS:
+        hours = MAX_FORECAST_HOURS
+    return round(hours, 1)
+
+
+#
+# Drivers of every vessel node, and of the controller for the first vessel
+#
+VESSEL_DRIVERS = [
+    {'path': 'waterData.temperature', 'driver': 'WATERT', 'uom': 17},   # water temperature
+    {'path': 'waterData.ph.value', 'driver': 'GV1', 'uom': 56,
+        'transform': lambda value: round(value, 1)},                      # pH level
+    {'path': 'pool.status_id', 'driver': 'GV2', 'uom': 25, 'transform': int},       # status
+    {'path': 'waterData.ta', 'driver': 'GV3', 'uom': 54},                 # TA
+    {'path': 'waterData.cya', 'driver': 'GV4', 'uom': 54},                # CYA
+    {'path': 'waterData.th', 'driver': 'GV5', 'uom': 54},                 # TH
+    {'path': 'waterData.ph.status', 'driver': 'GV6', 'uom': 25, 'transform': int},  # pH Status
+    {'path': 'waterData.orp.value', 'driver': 'GV7', 'uom': 43},          # ORP
+    {'path': 'waterData.orp.status', 'driver': 'GV8', 'uom': 25, 'transform': int}, # ORP Status
+    {'path': 'vesselData.battery.percentage', 'driver': 'GV9', 'uom': 51,
+        'transform': lambda percentage: percentage * 100},                # Battery
+    {'path': 'vesselData.rssi.value', 'driver': 'GV10', 'uom': 12},       # RSSI
+    {'path': 'pool.test_strip_required', 'driver': 'GV11', 'uom': 2,
+        'transform': lambda required: 1 if required is True else 0},      # Test Strip
+]
+
+#
+# pH and ORP trends of the first vessel on the controller, trends are
+# only there once enough chart points were seen
+#
+TREND_DRIVERS = [
+    {'path': 'waterData.ph.trend.drift', 'driver': 'GV15', 'uom': 56, 'required': False},   # pH drift per day
+    {'path': 'waterData.ph.trend', 'driver': 'GV16', 'uom': 20,
+        'transform': forecastHours, 'required': False},                   # hours until pH leaves ok range
+    {'path': 'waterData.orp.trend.drift', 'driver': 'GV17', 'uom': 56, 'required': False},  # ORP drift per day (mV)
+    {'path': 'waterData.orp.trend', 'driver': 'GV18', 'uom': 20,
+        'transform': forecastHours, 'required': False},                   # hours until ORP leaves ok range
+]
+
+
+#
+# Compile a driver table into a field map
+#
+def compileDrivers(rows):
+    return fieldMap([(row['path'], row['driver'], row.get('transform'), None, row.get('required', True))
+                     for row in rows])
+
+
+#
+# Polyglot drivers list of a driver table
+#
+def driverList(rows):
+    return [{'driver': row['driver'], 'value': 0, 'uom': row['uom']} for row in rows]
+
+
+VESSEL_MAP = compileDrivers(VESSEL_DRIVERS)
+CONTROLLER_MAP = compileDrivers(VESSEL_DRIVERS + TREND_DRIVERS)
+
+
+#
+# Map a pHin.getData() style result (models or the dictionaries of a
+# snapshot) to driver updates, returns ([(driver, value)], [missing paths])
+#
+def driverUpdates(data, driverMap=VESSEL_MAP):
+    updates, missing = driverMap.apply(data)
+    return updates, [row.path for row in missing]
+
+
+#
+# Set the drivers of a node, usually a DriverReporter so only changed
+# values are sent
+#
+def sendUpdates(node, updates):
+    for driver, value in updates:
+        node.setDriver(driver, value)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Adaptive poll scheduler for the pHin node server
+
+The pHin disc uploads a new data point about once an hour. Instead of
+querying the service on every shortPoll, the scheduler learns the upload
+cadence from the moments new chart data shows up, schedules the next fetch
+just after the next expected upload and backs off while nothing changes.
+
+Copyright (C) 2020 starcode911
+"""
+
+import time
+
+
+class PollScheduler(object):
+
+    #
+    # minInterval     - shortest time between two fetches (seconds)
+    # maxInterval     - longest backoff between two fetches while waiting
+    #                   for new data
+    # maxStaleness    - hard upper bound on the time since the last
+    #                   successful fetch
+    # expectedCadence - initial guess of the device upload cadence
+    # margin          - how long after the expected upload to fetch
+    #
+    def __init__(self, minInterval=60, maxInterval=900, maxStaleness=1800,
+                 expectedCadence=3600, margin=120):
+        self.minInterval = minInterval
+        self.maxInterval = max(maxInterval, minInterval)
+        self.maxStaleness = maxStaleness
+        self.margin = margin
+
+        self.expectedCadence = expectedCadence
+        self.interval = minInterval
+        self.lastChanges = {}
+        self.cadences = {}
+        self.lastSuccess = None
+        self.nextPoll = 0
+
+    #
+    # True if a fetch should be done now
+    #
+    def isDue(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.nextPoll
+
+    #
+    # Record a successful fetch, changes holds the time new chart data was
+    # last seen per chart route (None if no change has been seen yet). Each
+    # route (vessel) has its own upload cadence, routes missing from changes
+    # (removed or renamed vessels) are forgotten.
+    #
+    def success(self, changes, now=None):
+        if now is None:
+            now = time.time()
+
+        self.lastSuccess = now
+
+        for route in set(self.lastChanges) - set(changes):
+            del self.lastChanges[route]
+        for route in set(self.cadences) - set(changes):
+            del self.cadences[route]
+
+        changed = False
+        for route, lastChange in changes.items():
+            previous = self.lastChanges.get(route)
+            if lastChange is None or lastChange == previous:
+                continue
+            if previous is not None:
+                self.learnCadence(route, lastChange - previous)
+            self.lastChanges[route] = lastChange
+            changed = True
+
+        if changed:
+            self.interval = self.minInterval
+
+        candidates = []
+        overdue = len(changes) == 0
+        for route in changes:
+            lastChange = self.lastChanges.get(route)
+            if lastChange is None:
+                overdue = True
+                continue
+            expected = lastChange + self.cadences.get(route, self.expectedCadence) + self.margin
+            if expected > now:
+                candidates.append(max(expected, now + self.minInterval))
+            else:
+                overdue = True
+
+        if overdue:
+            #
+            # an upload is overdue or the cadence is unknown, poll again
+            # and back off while nothing changes
+            #
+            candidates.append(now + self.interval)
+            self.interval = min(self.interval * 2, self.maxInterval)
+
+        self.nextPoll = min(min(candidates), self.lastSuccess + self.maxStaleness)
+
+    #
+    # Record a failed fetch, retry with backoff but not before retryAt
+    # (the service is known to be unavailable until then)
+    #
+    def failure(self, now=None, retryAt=None):
+        if now is None:
+            now = time.time()
+
+        self.nextPoll = max(now + self.interval, retryAt or 0)
+        self.interval = min(self.interval * 2, self.maxInterval)
+
+    #
+    # Update the cadence estimate, intervals where we probably missed an
+    # upload (more than twice the cadence) are ignored
+    #
+    def learnCadence(self, route, observed):
+        cadence = self.cadences.get(route, self.expectedCadence)
+        if observed <= 0 or observed > 2 * cadence:
+            return
+        self.cadences[route] = 0.7 * cadence + 0.3 * observed
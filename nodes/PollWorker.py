@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Background poll worker for the pHin node server
+
+Queries of the pHin service run on a dedicated thread so Polyglot callbacks
+(shortPoll, config changes, commands) return right away. Triggers that
+arrive while a poll is queued or running share that poll instead of
+fetching again.
+
+Copyright (C) 2020 starcode911
+"""
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+#
+# One queued or running poll, shared by every trigger coalesced into it
+#
+class Flight(object):
+
+    def __init__(self, reason):
+        self.reasons = [reason]
+        self.started = False
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    #
+    # Wait for the poll to finish, returns False on timeout
+    #
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class PollWorker(object):
+
+    #
+    # poll - called on the worker thread for every flight
+    #
+    # At most one poll waits behind the running one, so the queue is
+    # bounded by design
+    #
+    def __init__(self, poll, logger=None):
+        self.poll = poll
+        self.logger = logger
+        self.queue = queue.Queue(2)
+        self.lock = threading.Lock()
+        self.waiting = None
+        self.running = None
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='pHinPollWorker')
+                self.thread.daemon = True
+                self.thread.start()
+
+    #
+    # Ask for a poll, returns the Flight right away. The trigger joins the
+    # waiting poll or the running one. With fresh set (data fetched before
+    # the trigger is not good enough, e.g. after new credentials) it only
+    # joins a poll that has not started yet.
+    #
+    def trigger(self, reason='poll', fresh=False):
+        self.start()
+        with self.lock:
+            flight = self.waiting
+            if flight is None and not fresh:
+                flight = self.running
+            if flight is not None:
+                flight.reasons.append(reason)
+                return flight
+
+            flight = Flight(reason)
+            self.waiting = flight
+            self.queue.put_nowait(flight)
+            return flight
+
+    def run(self):
+        while True:
+            flight = self.queue.get()
+            if flight is None:
+                return
+
+            with self.lock:
+                self.waiting = None
+                self.running = flight
+                flight.started = True
+
+            try:
+                flight.result = self.poll()
+            except Exception as err:
+                flight.error = err
+                if self.logger is not None:
+                    self.logger.error('status=poll_failed reasons=%s error=%s', ','.join(flight.reasons), str(err))
+            finally:
+                with self.lock:
+                    self.running = None
+                flight.done.set()
+
+    #
+    # Finish the waiting polls and stop the worker thread
+    #
+    def stop(self, timeout=None):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join(timeout)
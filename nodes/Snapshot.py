@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Last known vessel data of the pHin node server
+
+The data of the last successful poll is kept in a JSON file so the
+drivers can be filled in right after a restart, before (or without) the
+pHin service answering.
+
+Copyright (C) 2020 starcode911
+"""
+
+import os
+import json
+import time
+
+
+class Snapshot(object):
+
+    #
+    # path - JSON file the snapshot is kept in
+    #
+    def __init__(self, path='phin-snapshot.json', logger=None):
+        self.path = path
+        self.logger = logger
+        self.saved = None
+        self.vessels = None
+
+    #
+    # Read the snapshot, returns the list of getVesselsData() style
+    # dictionaries or None if there is no usable snapshot
+    #
+    def load(self):
+        try:
+            with open(self.path) as snapshotFile:
+                snapshot = json.load(snapshotFile)
+            self.saved = float(snapshot['saved'])
+            self.vessels = list(snapshot['vessels'])
+        except (IOError, OSError):
+            return None
+        except (ValueError, KeyError, TypeError) as err:
+            if self.logger is not None:
+                self.logger.error('status=snapshot_invalid path=%s error=%s', self.path, str(err))
+            return None
+        return self.vessels
+
+    #
+    # Replace the snapshot with the data of a successful poll. The file is
+    # written next to the old one and renamed over it, so a crash leaves
+    # either the old or the new snapshot.
+    #
+    def save(self, vessels, now=None):
+        if now is None:
+            now = time.time()
+
+        vessels = [data.asDict() if hasattr(data, 'asDict') else data for data in vessels]
+        tempPath = '%s.tmp' % self.path
+        try:
+            with open(tempPath, 'w') as snapshotFile:
+                json.dump({'saved': now, 'vessels': vessels}, snapshotFile)
+                snapshotFile.flush()
+                os.fsync(snapshotFile.fileno())
+            os.replace(tempPath, self.path)
+        except (IOError, OSError) as err:
+            if self.logger is not None:
+                self.logger.error('status=snapshot_write_failed path=%s error=%s', self.path, str(err))
+            return False
+
+        self.saved = now
+        self.vessels = vessels
+        return True
+
+    #
+    # Seconds since the snapshot data was fetched, None without snapshot
+    #
+    def getAge(self, now=None):
+        if self.saved is None:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0, now - self.saved)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Polyglot v2 node for a single body of water monitored by pHin
+
+Copyright (C) 2020 starcode911
+"""
+
+try:
+    import polyinterface
+except ImportError:
+    import pgc_interface as polyinterface
+import zlib
+
+from nodes.Drivers import VESSEL_DRIVERS, driverList
+
+
+LOGGER = polyinterface.LOGGER
+
+
+#
+# Node address for a vessel, ISY addresses are limited to 14 characters
+# so the vessel id is hashed into a short stable address
+#
+def vesselAddress(vesselInfo):
+    return 'v%08x' % (zlib.crc32(vesselInfo['id'].encode('utf-8')) & 0xffffffff)
+
+
+class Vessel(polyinterface.Node):
+
+    id = 'phinvessel'
+
+    def __init__(self, controller, primary, address, name):
+        super(Vessel, self).__init__(controller, primary, address, name)
+
+    def query(self, command=None):
+        LOGGER.info('query address=%s', self.address)
+        self.reportDrivers()
+
+
+    commands = {
+        'QUERY': query,
+    }
+
+    #
+    # Drivers are defined with their mapping in nodes/Drivers.py
+    #
+    drivers = driverList(VESSEL_DRIVERS)
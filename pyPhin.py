@@ -12,28 +12,179 @@ I am in no way affiliated with the ConnectedYard, Inc. organization.
 import requests
 import json
 import re
+import time
+import base64
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import pyPhinStats
+import pyPhinTrace
+from pyPhinBreaker import circuitBreaker, pHinCircuitOpen
+from pyPhinMetrics import metricsRegistry
+from pyPhinMapping import fieldMap
+from pyPhinModels import PoolData, WaterData, VesselData, PoolStatus, Reading, Trend
+
+
+'''pHinUnauthorized
+Raised when the service rejects the auth token
+'''
+class pHinUnauthorized(Exception):
+	pass
+
+
+'''tokenExpiry()
+Returns the expiry (epoch seconds) of a JWT auth token, or None if
+the token does not tell
+'''
+def tokenExpiry(authToken):
+	try:
+		payload = authToken.split(".")[1]
+		payload += "=" * (-len(payload) % 4)
+		return float(json.loads(base64.urlsafe_b64decode(payload.encode("ascii")))["exp"])
+	except Exception:
+		return None
+
+
+'''pHinAuth
+Tokens of an account, pass it to getData() or getVesselsData()
+instead of the auth token to have the auth token refreshed
+before it expires and when it is rejected
+
+authToken - Token recieved from verify()
+refreshToken - refreshToken recieved from verify()
+refreshUrl - refreshUrl recieved from verify()
+expires - Expiry of authToken (epoch seconds), read from the
+	token if not given
+onRefresh - Called with the pHinAuth after every refresh, for
+	example to save the new tokens
+'''
+class pHinAuth():
+
+	def __init__(self, authToken, refreshToken=None, refreshUrl=None, expires=None, onRefresh=None):
+		self.authToken = authToken
+		self.refreshToken = refreshToken
+		self.refreshUrl = refreshUrl
+		self.expires = expires if expires is not None else tokenExpiry(authToken)
+		self.onRefresh = onRefresh
+
+		#Only one refresh runs at a time, concurrent callers wait
+		#for it and use its token
+		self.lock = threading.Lock()
+		self.asyncLock = None
+
+	def canRefresh(self):
+		return bool(self.refreshToken) and bool(self.refreshUrl)
+
+	'''isExpiring()
+	True if the auth token expires within margin seconds,
+	tokens with an unknown expiry never do
+	'''
+	def isExpiring(self, margin, now=None):
+		if self.expires is None:
+			return False
+		if now is None:
+			now = time.time()
+		return self.expires - now <= margin
+
+
+'''testStripRequired()
+True if the required actions of a vessel ask for a test strip
+'''
+def testStripRequired(actions):
+	return any(action["buttonDetails"]["title"] == "Dip a test strip" for action in actions)
 
 
 class pHin():
 
 	baseUrl = "https://api.phin.co"
 
+	#Seconds before expiry an auth token is refreshed
+	refreshMargin = 300
+
+	#Tracing hooks, see addHook() and pyPhinTrace
+	hookNames = ("onRequestStart", "onRequestEnd", "onParse")
+
+	#Fields of a vessel response: (path, (model section, field),
+	#transform, default), see pyPhinMapping
+	vesselFields = fieldMap([
+		("waterReport.TA.value", ("waterData", "ta")),
+		("waterReport.CYA.value", ("waterData", "cya")),
+		("waterReport.TH.value", ("waterData", "th")),
+		("requiredActions", ("pool", "test_strip_required"), testStripRequired, []),
+		("disc.temperatureF", ("waterData", "temperature")),
+		("disc.name", ("pool", "status_title")),
+		("disc.waterStatus.value", ("pool", "status_id")),
+	])
+
+	#Readings with a trend: (name, chart series, store column), the
+	#ok range (status 3) the time to threshold is predicted for
+	trendSeries = (("ph", "ph", 1), ("orp", "orpMv", 2))
+	trendLimits = {"ph":(7.0, 7.5), "orp":(600, 875)}
+
+	#Seconds between chart points, points of a chart seen for the
+	#first time are dated this far apart ending now
+	chartInterval = 3600
+
+	#Seconds after which a chart point has half its weight in the
+	#trend, and points needed before a trend is reported
+	trendHalfLife = 86400
+	trendMinPoints = 6
+
 	'''init()
 	Initializes the Library with Specified parameters
 
 	logger - Used to pass in a logger for module to use
 
-	All remaining parameters used to specify the amount
+	The DataPointAvgLen parameters specify the amount
 	of data points to be used in average calculation.
 	A data point is roughly taken every hour.
 
+	The remaining parameters configure the keep-alive
+	connection pool shared by all requests:
+	poolConnections - Number of per-host pools to keep
+	poolMaxSize - Max connections kept alive per host
+	connectTimeout - Seconds to wait for a connection
+	readTimeout - Seconds to wait for the server to respond
+	maxRetries - Retries on connection resets (GET is also
+		retried on read errors, POST is not)
+	maxWorkers - Max requests run concurrently by getVesselsData()
+
+	seriesStore - Optional pyPhinStore.pHinStore, every new chart
+		response is merged into it
+
+	baseUrl - Service to use instead of api.phin.co, for example
+		a pyPhinFakeServer.fakeServer
+
+	breaker - pyPhinBreaker.circuitBreaker guarding all requests,
+		requests to an endpoint that keeps failing raise
+		pHinCircuitOpen without being sent
+
+	metrics - pyPhinMetrics.metricsRegistry recording latency,
+		bytes, errors and parse failures per endpoint and vessel
+
+	cassette - pyPhinCassette.cassette, requests are recorded to
+		it or replayed from it instead of being sent
+
 	'''
 	def __init__(self, logger=None,
 		phDataPointAvgLen=5,
 		orpMvDataPointAvgLen=5,
 		batteryDataPointAvgLen=5,
-		rssiDataPointAvgLen=1):
+		rssiDataPointAvgLen=1,
+		poolConnections=4,
+		poolMaxSize=10,
+		connectTimeout=5,
+		readTimeout=15,
+		maxRetries=2,
+		maxWorkers=8,
+		seriesStore=None,
+		baseUrl=None,
+		breaker=None,
+		metrics=None,
+		cassette=None):
 		if logger != None:
 			self.logger = logger
 		else:
@@ -48,6 +199,125 @@ class pHin():
 		except Exception as e:
 			self.logger.critcal("ph, orp, or battery Data Point Avg Len is not an Integer! Exception: %s",e)
 
+		self.timeout = (connectTimeout, readTimeout)
+		self.session = self.createSession(poolConnections, poolMaxSize, maxRetries)
+		self.maxWorkers = maxWorkers
+		self.executor = None
+
+		self.chartCache = {}
+		self.chartCacheHits = 0
+		self.chartChanges = {}
+		self.chartRoutes = {}
+		self.vesselCharts = {}
+		self.seriesStore = seriesStore
+		self.trends = {}
+
+		if baseUrl != None:
+			self.baseUrl = baseUrl
+
+		self.breaker = breaker if breaker is not None else circuitBreaker()
+		self.metrics = metrics if metrics is not None else metricsRegistry()
+		self.hooks = dict((name, []) for name in self.hookNames)
+		self.cassette = cassette
+
+	'''createSession()
+	Builds the keep-alive session used for every request, so
+	polls reuse connections to the pHin API instead of doing
+	a new TCP and TLS handshake per request.
+	'''
+	def createSession(self, poolConnections, poolMaxSize, maxRetries):
+		retry = Retry(
+			total=maxRetries,
+			connect=maxRetries,
+			read=maxRetries,
+			status=0,
+			allowed_methods=frozenset(["GET"]),
+			backoff_factor=0.3,
+			raise_on_status=False)
+
+		self.adapter = HTTPAdapter(
+			pool_connections=poolConnections,
+			pool_maxsize=poolMaxSize,
+			max_retries=retry)
+
+		#urllib3's own pools, see updatePoolClasses()
+		self.poolClasses = self.adapter.poolmanager.pool_classes_by_scheme
+
+		session = requests.Session()
+		session.mount("https://", self.adapter)
+		session.mount("http://", self.adapter)
+		return session
+
+	'''getConnectionStats()
+	Returns connection pool counters in a python dictionary object:
+	{
+		"requests": <requests sent>,
+		"connections": <connections opened>,
+		"reused": <requests sent on an already open connection>
+	}
+	Only pools still held by the session are counted.
+	'''
+	def getConnectionStats(self):
+		stats = {"requests":0,"connections":0,"reused":0}
+		pools = self.adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool is None:
+				continue
+			stats["requests"] += pool.num_requests
+			stats["connections"] += pool.num_connections
+		stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+		return stats
+
+	'''close()
+	Closes all pooled connections
+	'''
+	def close(self):
+		self.session.close()
+		if self.executor is not None:
+			self.executor.shutdown(wait=False)
+
+	'''addHook()
+	Adds a tracing hook, called with a span (python dictionary
+	object) for every request and parse stage
+
+	name - onRequestStart, onRequestEnd or onParse, see pyPhinTrace
+		for the fields of the spans
+	callback - Called with the span, exceptions are logged and
+		otherwise ignored
+	'''
+	def addHook(self, name, callback):
+		if name not in self.hooks:
+			raise Exception("Unknown hook %s!" % name)
+		self.hooks[name].append(callback)
+		self.updatePoolClasses()
+
+	def removeHook(self, name, callback):
+		if callback in self.hooks.get(name, []):
+			self.hooks[name].remove(callback)
+		self.updatePoolClasses()
+
+	'''updatePoolClasses()
+	Uses the connection pools of pyPhinTrace, which record the DNS,
+	connect and TLS handshake times, only while request hooks are
+	added. Open pools are closed when the pools change, so the next
+	request uses the new ones.
+	'''
+	def updatePoolClasses(self):
+		tracing = len(self.hooks["onRequestStart"]) > 0 or len(self.hooks["onRequestEnd"]) > 0
+		poolClasses = pyPhinTrace.tracePoolClasses if tracing else self.poolClasses
+		poolManager = self.adapter.poolmanager
+		if poolManager.pool_classes_by_scheme is not poolClasses:
+			poolManager.pool_classes_by_scheme = poolClasses
+			poolManager.clear()
+
+	def callHooks(self, name, span):
+		for callback in list(self.hooks[name]):
+			try:
+				callback(span)
+			except Exception as e:
+				self.logger.error("Tracing hook %s failed: Exception=%s", name, e)
+
 	'''login()
 	Used to start verification process by sending a verificaton
 	email request.
@@ -70,7 +340,7 @@ class pHin():
 			"versionCheck": "/version"
 		}
 		'''
-		urls = json.loads(self.requestGet(self.baseUrl + "/urls").text)
+		urls = self.checkRequest(self.requestGet(self.baseUrl + "/urls"))
 
 		''' signin
 		{
@@ -84,8 +354,7 @@ class pHin():
 			headers=self.createHeader(deviceUUID))
 
 
-		self.checkRequest(req)
-		reqJson = json.loads(req.text)
+		reqJson = self.checkRequest(req)
 
 
 
@@ -100,7 +369,8 @@ class pHin():
 	verifyUrl - Url obtained from login()
 	verficationCode - Numeric code obtained from contact email
 
-	Returns authToken and vesselUrl in a python dictionary object
+	Returns authToken, refreshToken, refreshUrl, vesselUrl and
+	vesselUrls (one per location) in a python dictionary object
 	'''
 	def verify(self, contact, deviceUUID, verifyUrl, verificationCode):
 
@@ -128,18 +398,9 @@ class pHin():
 			headers=self.createHeader(deviceUUID))
 
 
-		self.checkRequest(req)
-		reqJson = json.loads(req.text)
-
-		if not reqJson["success"]:
-			raise Exception(reqJson)
-		if "existing" in reqJson:
-			raise Exception("Contact does not exist!")
+		reqJson = self.checkRequest(req)
 
-		authToken = reqJson["auth_token"]
-		refreshToken = reqJson["refresh_token"]
-		locationUrl = reqJson["user"]["locationsUrl"]
-		userRefreshUrl = reqJson["user"]["userRefreshTokenUrl"]
+		authToken, refreshToken, locationUrl, userRefreshUrl = self.parseVerify(reqJson)
 
 
 		''' locations
@@ -171,40 +432,146 @@ class pHin():
 			headers=self.createHeader(deviceUUID, authToken, "2.0.1")
 			)
 
-		self.checkRequest(req)
-		reqJson = json.loads(req.text)
+		reqJson = self.checkRequest(req)
+
+		return self.parseLocations(authToken, reqJson, refreshToken, userRefreshUrl)
+
+	'''parseVerify()
+	Extracts the tokens and user routes from a verify response
+
+	Returns authToken, refreshToken, locationUrl, userRefreshUrl
+	'''
+	def parseVerify(self, reqJson):
+		if not reqJson["success"]:
+			raise Exception(reqJson)
+		if "existing" in reqJson:
+			raise Exception("Contact does not exist!")
+
+		authToken = reqJson["auth_token"]
+		refreshToken = reqJson["refresh_token"]
+		locationUrl = reqJson["user"]["locationsUrl"]
+		userRefreshUrl = reqJson["user"]["userRefreshTokenUrl"]
 
+		return authToken, refreshToken, locationUrl, userRefreshUrl
 
-		vesselUrl = reqJson["locations"][0]["resources"]["vessels"]["route"]
+	'''parseLocations()
+	Builds the auth data returned by verify() from a locations response
+	'''
+	def parseLocations(self, authToken, reqJson, refreshToken=None, refreshUrl=None):
+		vesselUrls = [location["resources"]["vessels"]["route"] for location in reqJson["locations"]]
 
 		#Auth Dictionary Structure needed to access data.
-		authData = {"authToken":authToken,"vesselUrl":vesselUrl}
+		#vesselUrl is the first location, vesselUrls holds every location
+		authData = {"authToken":authToken,"vesselUrl":vesselUrls[0],"vesselUrls":vesselUrls,
+			"refreshToken":refreshToken,"refreshUrl":refreshUrl}
 
 		return authData
 
+	'''refreshAuth()
+	Gets a new auth token with the refresh token of a pHinAuth
+
+	staleToken - Auth token the caller found expiring or rejected,
+		if another call already replaced it that token is used
+		instead of refreshing again
+
+	Returns the new auth token
+	'''
+	def refreshAuth(self, auth, deviceUUID, staleToken=None):
+		with auth.lock:
+			if staleToken is not None and auth.authToken != staleToken:
+				return auth.authToken
+
+			req = self.requestPost(*self.createRefreshRequest(auth, deviceUUID))
+
+			self.updateAuth(auth, self.checkRequest(req))
+
+		return auth.authToken
+
+	'''createRefreshRequest()
+	Returns url, json and headers of a refresh token request
+	'''
+	def createRefreshRequest(self, auth, deviceUUID):
+		if not auth.canRefresh():
+			raise pHinUnauthorized("No refresh token to refresh the Unauthorized auth token!")
+
+		''' refresh_route
+		{
+			"success": true,
+			"auth_token": <auth_token>,
+			"refresh_token": <refresh_token>,
+			"expires_in": <seconds, optional>
+		}
+		'''
+		return (self.baseUrl + auth.refreshUrl,
+			{"refresh_token":auth.refreshToken,"deviceId":deviceUUID},
+			self.createHeader(deviceUUID, auth.authToken))
+
+	'''updateAuth()
+	Stores the tokens of a refresh response in a pHinAuth
+	'''
+	def updateAuth(self, auth, reqJson):
+		auth.authToken = reqJson["auth_token"]
+		auth.refreshToken = reqJson.get("refresh_token") or auth.refreshToken
+		if reqJson.get("expires_in") is not None:
+			auth.expires = time.time() + float(reqJson["expires_in"])
+		else:
+			auth.expires = tokenExpiry(auth.authToken)
+
+		self.logger.info("Auth token refreshed, expires %s", auth.expires)
+
+		if auth.onRefresh is not None:
+			try:
+				auth.onRefresh(auth)
+			except Exception as e:
+				self.logger.error("Can not save refreshed tokens: Exception=%s",e)
+
+	'''callWithAuth()
+	Calls call(authToken) with the auth token of a pHinAuth.
+	The token is refreshed first if it is about to expire, and
+	once more followed by a retry if the service rejects it.
+	Plain auth tokens are passed through unchanged.
+	'''
+	def callWithAuth(self, auth, deviceUUID, call):
+		if not isinstance(auth, pHinAuth):
+			return call(auth)
+
+		authToken = auth.authToken
+		if auth.canRefresh() and auth.isExpiring(self.refreshMargin):
+			try:
+				authToken = self.refreshAuth(auth, deviceUUID, authToken)
+			except Exception as e:
+				#The old token may still be accepted
+				self.logger.error("Can not refresh auth token: Exception=%s",e)
+
+		try:
+			return call(authToken)
+		except pHinUnauthorized:
+			if not auth.canRefresh():
+				raise
+			self.logger.info("Auth token rejected, refreshing")
+			authToken = self.refreshAuth(auth, deviceUUID, authToken)
+
+		return call(authToken)
+
 
 	'''getData()
 	Used to get the data from authorized account.
 
-	authToken - Token recieved from login()
+	authToken - Token recieved from login(), or a pHinAuth to
+		have the token refreshed when needed
 	deviceUUID - Any UUID
 	vesselUrl - vesselUrl from login()
 
-	Returns data in a python dictionary object:
-
+	Returns a pyPhinModels.PoolData, it reads like the python
+	dictionary object shown in getWaterData(), asDict() returns
+	that dictionary.
 	'''
 	def getData(self, authToken, deviceUUID, vesselUrl):
 
-		def merge(dict_list):
-		    merged = {}
-		    for item in dict_list:
-		        for key in item.keys():
-		            try:
-		                merged[key].update(item[key])
-		            except KeyError:
-		                merged[key] = {}
-		                merged[key].update(item[key])
-		    return merged
+		if isinstance(authToken, pHinAuth):
+			return self.callWithAuth(authToken, deviceUUID,
+				lambda token: self.getData(token, deviceUUID, vesselUrl))
+
 		self.checkUrlRoute(vesselUrl)
 
 		data = {}
@@ -214,57 +581,52 @@ class pHin():
 			deviceUUID,
 			vesselUrl)
 
-		data = merge(dataList)
+		data = self.mergeData(dataList)
 
 
 		return data
 
+	'''mergeData()
+	Merges the list returned by getWaterData() into a single PoolData
+	'''
+	def mergeData(self, dataList):
+		merged = PoolData()
+		for data in dataList:
+			merged = merged.merge(data)
+		return merged
+
 	def getWaterData(self, authToken, deviceUUID, vesselUrl):
 
 
+		#The chart route seen on the last poll is requested together
+		#with the vessel, it is only requested again if it changed
+		chartRoutes = self.chartRoutes.get(vesselUrl)
+		chartFuture = None
+		if chartRoutes:
+			chartFuture = self.getExecutor().submit(
+				self.getChartData, authToken, deviceUUID, chartRoutes[0])
+
 		req = self.requestGet(
 			self.baseUrl+vesselUrl,
 			headers=self.createHeader(deviceUUID, authToken, "2.0.0")
 			)
 
 
-		self.checkRequest(req)
-		reqJson = json.loads(req.text)
-
-		data = {"waterData":{},"pool":{}}
+		reqJson = self.checkRequest(req)
 
-		for dataType in ["TA","CYA","TH"]:
-			try:
-				data["waterData"][dataType.lower()] = reqJson["vessels"][0]["waterReport"][dataType]["value"]
-			except:
-				self.logger.error("Not able to access %s with %s",dataType,req.text)
+		vessels = self.parseVessels(reqJson, req.text, vesselUrl)
+		self.updateChartRoutes(vesselUrl, [chartUrl for info, data, chartUrl in vessels])
+		info, data, chartUrl = vessels[0]
 
-		try:
-			testStrip = False
-			if "requiredActions" in reqJson["vessels"][0]:
-				for action in reqJson["vessels"][0]["requiredActions"]:
-					if action["buttonDetails"]["title"] == "Dip a test strip":
-						testStrip = True
-			data["pool"]["test_strip_required"] = testStrip
-		except:
-			self.logger.error("Not able to access Test Strip with %s",req.text)
-		try:
-			data["waterData"]["temperature"] = reqJson["vessels"][0]["disc"]["temperatureF"]
-		except:
-			self.logger.error("Not able to access temperature with %s",req.text)
-		try:
-			data["pool"]["status_title"] = reqJson["vessels"][0]["disc"]["name"]
-		except:
-			self.logger.error("Not able to access temperature with %s",req.text)
-		try:
-			data["pool"]["status_id"] = reqJson["vessels"][0]["disc"]["waterStatus"]["value"]
-		except:
-			self.logger.error("Not able to access status id with %s",req.text)
-
-		chartData = self.getChartData(
-			authToken,
-			deviceUUID,
-			reqJson["vessels"][0]["widgets"][0]["resources"]["appChartsWeek"]["route"])
+		if chartUrl is None:
+			chartData = None
+		elif chartFuture is not None and chartRoutes[0] == chartUrl:
+			chartData = chartFuture.result()
+		else:
+			chartData = self.getChartData(
+				authToken,
+				deviceUUID,
+				chartUrl)
 
 		returnData = [data,chartData]
 
@@ -304,15 +666,347 @@ class pHin():
 		'''
 		return returnData
 
+	'''getVesselsData()
+	Used to get the data of every vessel in every location.
+	The vessels of all locations, and then the charts of all
+	vessels, are fetched concurrently.
+
+	authToken - Token recieved from login()
+	deviceUUID - Any UUID
+	vesselUrls - vesselUrls from verify()
+
+	Returns a list with a getData() style PoolData per vessel,
+	with an additional "vessel" entry:
+	{
+		"id": <vessel id>,
+		"name": <vessel name>,
+		"vesselUrl": <vessel route of the location>
+	}
+	'''
+	def getVesselsData(self, authToken, deviceUUID, vesselUrls):
+
+		if isinstance(authToken, pHinAuth):
+			return self.callWithAuth(authToken, deviceUUID,
+				lambda token: self.getVesselsData(token, deviceUUID, vesselUrls))
+
+		for vesselUrl in vesselUrls:
+			self.checkUrlRoute(vesselUrl)
+
+		executor = self.getExecutor()
+
+		vesselFutures = [
+			(vesselUrl, executor.submit(self.getVessels, authToken, deviceUUID, vesselUrl))
+			for vesselUrl in vesselUrls]
+
+		#Charts of the routes seen on the last poll are requested
+		#together with the vessels instead of after them
+		prefetched = {}
+		for vesselUrl in vesselUrls:
+			for chartUrl in self.chartRoutes.get(vesselUrl, []):
+				if chartUrl not in prefetched:
+					prefetched[chartUrl] = executor.submit(
+						self.getChartData, authToken, deviceUUID, chartUrl)
+
+		vessels = []
+		chartFutures = []
+		for vesselUrl, vesselFuture in vesselFutures:
+			vesselList = vesselFuture.result()
+			self.updateChartRoutes(vesselUrl, [chartUrl for info, data, chartUrl in vesselList])
+
+			for info, data, chartUrl in vesselList:
+				vessels.append((info, data))
+				if chartUrl is None:
+					chartFutures.append(None)
+					continue
+				chartFuture = prefetched.pop(chartUrl, None)
+				if chartFuture is None:
+					#New or changed route
+					chartFuture = executor.submit(
+						self.getChartData, authToken, deviceUUID, chartUrl)
+				chartFutures.append(chartFuture)
+
+		#Routes that are gone, their results are not used
+		for chartFuture in prefetched.values():
+			chartFuture.cancel()
+
+		returnData = []
+		for (info, data), chartFuture in zip(vessels, chartFutures):
+			chartData = chartFuture.result() if chartFuture is not None else None
+			vesselData = self.mergeData([data, chartData])
+			vesselData["vessel"] = info
+			returnData.append(vesselData)
+			self.metrics.set("phin_vessel_last_success_timestamp_seconds", time.time(), {"vessel":info["id"]})
+
+		return returnData
+
+	'''getVessels()
+	Used to get the water data of all vessels of one location
+
+	Returns a list of (vessel info, water data, chart route)
+	'''
+	def getVessels(self, authToken, deviceUUID, vesselUrl):
+
+		req = self.requestGet(
+			self.baseUrl+vesselUrl,
+			headers=self.createHeader(deviceUUID, authToken, "2.0.0")
+			)
+
+		reqJson = self.checkRequest(req)
+
+		return self.parseVessels(reqJson, req.text, vesselUrl)
+
+	'''updateChartRoutes()
+	Remembers the chart routes of a vessel route for the next poll
+	'''
+	def updateChartRoutes(self, vesselUrl, chartUrls):
+		chartUrls = [chartUrl for chartUrl in chartUrls if chartUrl is not None]
+		previous = self.chartRoutes.get(vesselUrl)
+		if previous is not None and previous != chartUrls:
+			self.logger.info("Chart routes of %s changed from %s to %s", vesselUrl, previous, chartUrls)
+		self.chartRoutes[vesselUrl] = chartUrls
+
+		#Changes of routes that are gone do not count for the cadence
+		if previous is not None:
+			current = set(chartUrl for routes in list(self.chartRoutes.values()) for chartUrl in routes)
+			for chartUrl in set(previous) - current:
+				self.chartChanges.pop(chartUrl, None)
+
+	'''getExecutor()
+	Thread pool used to run requests of one poll concurrently
+	'''
+	def getExecutor(self):
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+		return self.executor
+
+	'''parseVessels()
+	Extracts every vessel from a vessels response
+
+	Returns a list of (vessel info, water data, chart route)
+	'''
+	def parseVessels(self, reqJson, text, vesselUrl):
+		started = time.time()
+		vessels = []
+		charts = []
+		for index, vessel in enumerate(reqJson["vessels"]):
+			info = {"id":str(vessel.get("id", vessel.get("_id", "%s/%d" % (vesselUrl, index)))),
+				"name":vessel.get("name", "Vessel %d" % (index + 1)),
+				"vesselUrl":vesselUrl}
+			data, chartUrl = self.parseVessel(vessel, text)
+			vessels.append((info, data, chartUrl))
+			charts.append((info["id"], self.parseChartRoutes(vessel)))
+		self.vesselCharts[vesselUrl] = charts
+		self.recordParse("vessels", vesselUrl, started)
+		return vessels
+
+	'''parseChartRoutes()
+	Returns every chart route a vessel advertises (appChartsWeek,
+	appChartsMonth, ...) in a python dictionary object {chart name: route}
+	'''
+	def parseChartRoutes(self, vessel):
+		routes = {}
+		for widget in vessel.get("widgets") or []:
+			for name, resource in (widget.get("resources") or {}).items():
+				if name.startswith("appCharts") and isinstance(resource, dict) and resource.get("route"):
+					routes[name] = resource["route"]
+		return routes
+
+	'''parseWaterData()
+	Extracts the water report and pool status of the first vessel
+	from a vessels response
+
+	reqJson - Parsed vessels response
+	text - Raw response, used for error logging
+
+	Returns the water data dictionary and the weekly chart route
+	'''
+	def parseWaterData(self, reqJson, text):
+		return self.parseVessel(reqJson["vessels"][0], text)
+
+	'''parseVessel()
+	Extracts the water report and pool status of one vessel with
+	vesselFields, missing fields are logged once per vessel
+
+	Returns the water data dictionary and the weekly chart route,
+	None if the vessel has no chart
+	'''
+	def parseVessel(self, vessel, text):
+
+		data = PoolData(waterData=WaterData(),pool=PoolStatus())
+		source = str(vessel.get("id", vessel.get("_id")))
+
+		values, missing = self.vesselFields.apply(vessel)
+		for (section, field), value in values:
+			data[section][field] = value
+
+		if len(missing) > 0:
+			self.logger.error("Not able to access %s of vessel %s",
+				", ".join(row.path for row in missing), source)
+			self.logger.debug("Vessel %s: %s", source, text)
+			for row in missing:
+				self.parseError(row.target[1], source)
+
+		chartUrl = self.getChartRoute(vessel, source)
+
+		return data, chartUrl
+
+	'''getChartRoute()
+	Returns the weekly chart route of a vessel, None for a vessel
+	without a chart widget (for example no disc installed yet)
+	'''
+	def getChartRoute(self, vessel, source):
+		for widget in vessel.get("widgets") or []:
+			resource = (widget.get("resources") or {}).get("appChartsWeek")
+			if isinstance(resource, dict) and resource.get("route"):
+				return resource["route"]
+		self.logger.warning("Vessel %s has no chart, reported without chart data", source)
+		return None
+
+	'''getChartData()
+	Used to get the averaged chart data of a vessel.
+
+	The chart only gets a new data point about once an hour, so
+	the validators (ETag/Last-Modified) and the parsed result are
+	kept per chart route. Following requests are conditional and
+	a 304 Not Modified reuses the cached result.
+	'''
 	def getChartData(self, authToken, deviceUUID, chartUrl):
 		req = self.requestGet(
 			self.baseUrl + chartUrl,
-			headers=self.createHeader(deviceUUID, authToken, "1.0.0")
+			headers=self.createChartHeader(deviceUUID, authToken, chartUrl)
 			)
-		self.checkRequest(req)
-		reqJson = json.loads(req.text)
 
-		chartData = {"waterData":{},"vesselData":{}}
+		return self.processChartResponse(chartUrl, req)
+
+	'''getChartChanges()
+	Returns the time new chart data was last seen per chart
+	route, None for routes that did not change yet
+	'''
+	def getChartChanges(self):
+		return dict((chartUrl, change) for chartUrl, (fingerprint, change) in list(self.chartChanges.items()))
+
+	'''createChartHeader()
+	Chart request headers, conditional if we have a cached chart
+	'''
+	def createChartHeader(self, deviceUUID, authToken, chartUrl):
+		headers = self.createHeader(deviceUUID, authToken, "1.0.0")
+
+		cached = self.chartCache.get(chartUrl)
+		if cached is not None:
+			if cached["etag"] != None:
+				headers["If-None-Match"] = cached["etag"]
+			if cached["lastModified"] != None:
+				headers["If-Modified-Since"] = cached["lastModified"]
+		return headers
+
+	'''processChartResponse()
+	Returns the parsed chart data of a chart response, either
+	from the cache on 304 or by parsing and caching the response
+	'''
+	def processChartResponse(self, chartUrl, req):
+		cached = self.chartCache.get(chartUrl)
+		if req is not None and req.status_code == 304 and cached is not None:
+			self.chartCacheHits += 1
+			return cached["chartData"]
+
+		reqJson = self.checkRequest(req)
+
+		chartData = self.parseChartData(reqJson, chartUrl)
+
+		added = None
+		if self.seriesStore is not None:
+			try:
+				added = self.seriesStore.merge(chartUrl, reqJson)
+			except Exception as e:
+				self.logger.error("Can not store chart data: Exception=%s",e)
+
+		#A changed chart body means the disc uploaded new data points,
+		#the first body seen for a route only sets the baseline
+		fingerprint = hash(req.text)
+		previous = self.chartChanges.get(chartUrl)
+		if previous is None:
+			self.chartChanges[chartUrl] = (fingerprint, None)
+		elif previous[0] != fingerprint:
+			self.chartChanges[chartUrl] = (fingerprint, time.time())
+
+		self.updateTrends(chartUrl, reqJson, added, previous is not None and previous[0] != fingerprint)
+		self.addTrends(chartUrl, chartData)
+
+		etag = req.headers.get("ETag")
+		lastModified = req.headers.get("Last-Modified")
+		if etag != None or lastModified != None:
+			self.chartCache[chartUrl] = {
+				"etag":etag,
+				"lastModified":lastModified,
+				"chartData":chartData}
+		else:
+			self.chartCache.pop(chartUrl, None)
+
+		return chartData
+
+	'''updateTrends()
+	Feeds the new points of a chart to the trend estimators of its
+	route, O(1) per point without looking at earlier points again.
+
+	The first chart of a route seeds the estimators. After that the
+	points the series store added are new, without a store the newest
+	point of a changed chart is.
+	'''
+	def updateTrends(self, chartUrl, reqJson, added, changed, now=None):
+		if now is None:
+			now = time.time()
+
+		trends = self.trends.get(chartUrl)
+		seed = trends is None
+		if seed:
+			trends = dict((name, pyPhinStats.onlineTrend(self.trendHalfLife)) for name, key, column in self.trendSeries)
+			self.trends[chartUrl] = trends
+
+		for name, key, column in self.trendSeries:
+			values = reqJson.get(key) or []
+			if seed:
+				points = [(now - (len(values) - 1 - index) * self.chartInterval, value)
+					for index, value in enumerate(values)]
+			elif added is not None:
+				points = [(point[0], point[column]) for point in added]
+			elif changed and len(values) > 0:
+				points = [(now, values[-1])]
+			else:
+				points = []
+
+			for ts, value in points:
+				trends[name].update(ts, value)
+
+	'''addTrends()
+	Adds the trend of the ph and orp readings of a chart result:
+	drift per day, hours until the ok range is left (None if the
+	trend stays in it), std around the trend and the points used
+	'''
+	def addTrends(self, chartUrl, chartData):
+		trends = self.trends.get(chartUrl, {})
+		for name, (low, high) in self.trendLimits.items():
+			trend = trends.get(name)
+			reading = chartData["waterData"].get(name)
+			if trend is None or reading is None or trend.count < self.trendMinPoints:
+				continue
+			hours = trend.timeToThreshold(low, high)
+			reading["trend"] = Trend(drift=round(trend.slope() * 24, 3),
+				hoursToLimit=round(hours, 1) if hours is not None else None,
+				std=round(trend.std(), 3),
+				count=trend.count)
+
+	'''parseChartData()
+	Averages the latest chart data points of all series in one
+	pyPhinStats.windowMeans() call and classifies them. Series
+	shorter than the average length are averaged over the points
+	available.
+
+	source - Chart route, used to count missing series
+	'''
+	def parseChartData(self, reqJson, source=None):
+
+		started = time.time()
+		chartData = PoolData(waterData=WaterData(),vesselData=VesselData())
 
 		'''Status Codes
 		1 - Needs Immediate Attention Low
@@ -322,74 +1016,40 @@ class pHin():
 		5 - Needs Immediate Attention High
 		'''
 
-		#PH
-		try:
-			phAvg = round(sum(reqJson["ph"][-self.phDataPointAvgLen:])/self.phDataPointAvgLen,1)
-
-			phStatus = -1
-			if phAvg < 6.8:
-				phStatus = 1
-			elif phAvg < 7:
-				phStatus = 2
-			elif phAvg <= 7.5:
-				phStatus = 3
-			elif phAvg <= 7.8:
-				phStatus = 4
+		#All series are averaged in a single pass, vectorized when
+		#NumPy is installed
+		series = (("ph", "PH", "ph", self.phDataPointAvgLen),
+			("orp", "ORP", "orpMv", self.orpMvDataPointAvgLen),
+			("battery", "Battery", "batteryMv", self.batteryDataPointAvgLen),
+			("rssi", "RSSI", "rssi", self.rssiDataPointAvgLen))
+		means = pyPhinStats.windowMeans(
+			[reqJson.get(key) for name, label, key, window in series],
+			[window for name, label, key, window in series])
+
+		averages = {}
+		for (name, label, key, window), average in zip(series, means):
+			if average is None:
+				self.logger.error("Can not Access %s: no data points in %s", label, key)
+				self.parseError(name, source)
 			else:
-				phStatus = 5
-			chartData["waterData"]["ph"] = {"value":phAvg,"status":phStatus}
+				averages[name] = average
 
-		except Exception as e:
-			self.logger.error("Can not Access PH: Exception=%s",e)
+		#PH
+		if "ph" in averages:
+			phAvg = round(averages["ph"], 1)
+			chartData["waterData"]["ph"] = Reading(value=phAvg,status=self.phStatus(phAvg))
 		#ORP - Oxidation-Reduction Potential (Sanitization)
-		try:
-			orpAvg = round(sum(reqJson["orpMv"][-self.orpMvDataPointAvgLen:])/self.orpMvDataPointAvgLen, 1)
-
-			orpStatus = -1
-			if orpAvg < 300:
-				orpStatus = 1
-			elif orpAvg < 600:
-				orpStatus = 2
-			elif orpAvg <= 875:
-				orpStatus = 3
-			else:
-				orpStatus = 5
-			chartData["waterData"]["orp"] = {"value":orpAvg,"status":orpStatus}
-
-		except Exception as e:
-			self.logger.error("Can not Access ORP: Exception=%s",e)
+		if "orp" in averages:
+			orpAvg = round(averages["orp"], 1)
+			chartData["waterData"]["orp"] = Reading(value=orpAvg,status=self.orpStatus(orpAvg))
 		#BatteryMv
-		try:
-			batteryAvg = round(sum(reqJson["batteryMv"][-self.batteryDataPointAvgLen:])/self.batteryDataPointAvgLen,1)
-
-			batteryPercentage = .01
-
-			batteryPercentage = round((batteryAvg - 1500)/(3500-1500),2)
-			if batteryPercentage <= 0:
-				batteryPercentage = 0.01
-			elif batteryPercentage >= 1:
-				batteryPercentage = 1
-
-			chartData["vesselData"]["battery"] = {"value":batteryAvg,"percentage":batteryPercentage}
-
-		except Exception as e:
-			self.logger.error("Can not Access Battery: Exception=%s",e)
-
+		if "battery" in averages:
+			batteryAvg = round(averages["battery"], 1)
+			chartData["vesselData"]["battery"] = Reading(value=batteryAvg,percentage=self.batteryPercentage(batteryAvg))
 		#RSSI - Received Signal Strength Indicator
-		try:
-			rssiAvg = round(sum(reqJson["rssi"][-self.rssiDataPointAvgLen:])/self.rssiDataPointAvgLen,0)
-
-			rssiStatus = -1
-			if rssiAvg < -110:
-				rssiStatus = 1
-			elif rssiAvg > -20:
-				rssiStatus = 5
-			else:
-				rssiStatus = 3
-			chartData["vesselData"]["rssi"] = {"value":rssiAvg,"status":rssiStatus}
-
-		except Exception as e:
-			self.logger.error("Can not Access RSSI: Exception=%s",e)
+		if "rssi" in averages:
+			rssiAvg = round(averages["rssi"], 0)
+			chartData["vesselData"]["rssi"] = Reading(value=rssiAvg,status=self.rssiStatus(rssiAvg))
 
 		'''Sample ChartData Return
 		{
@@ -403,8 +1063,44 @@ class pHin():
 			}
 		}
 		'''
+		self.recordParse("chart", source, started)
 		return chartData
 
+	def phStatus(self, phAvg):
+		if phAvg < 6.8:
+			return 1
+		elif phAvg < 7:
+			return 2
+		elif phAvg <= 7.5:
+			return 3
+		elif phAvg <= 7.8:
+			return 4
+		return 5
+
+	def orpStatus(self, orpAvg):
+		if orpAvg < 300:
+			return 1
+		elif orpAvg < 600:
+			return 2
+		elif orpAvg <= 875:
+			return 3
+		return 5
+
+	def batteryPercentage(self, batteryAvg):
+		batteryPercentage = round((batteryAvg - 1500)/(3500-1500),2)
+		if batteryPercentage <= 0:
+			return 0.01
+		elif batteryPercentage >= 1:
+			return 1
+		return batteryPercentage
+
+	def rssiStatus(self, rssiAvg):
+		if rssiAvg < -110:
+			return 1
+		elif rssiAvg > -20:
+			return 5
+		return 3
+
 	def createHeader(self, deviceUUID, authToken=None, version=None):
 		headers = {"x-phin-concise":"true",
 			"x-phin-reporting-app-id":"ios-app",
@@ -416,18 +1112,135 @@ class pHin():
 		return headers
 
 	def requestGet(self,url,headers={}):
-		try:
-			return requests.get(url,headers=headers)
-		except requests.ConnectionError:
-			self.logger.critical("Cannot Connect to Server")
-			raise requests.ConnectionError
+		return self.sendRequest(self.session.get, "GET", url, headers=headers)
 	def requestPost(self,url,json={},headers={}):
+		return self.sendRequest(self.session.post, "POST", url, headers=headers, json=json)
+
+	'''sendRequest()
+	Sends a request through the circuit breaker, raises
+	pHinCircuitOpen while the endpoint is failing
+	'''
+	def sendRequest(self, send, method, url, **kwargs):
+		span = self.startRequestSpan(method, url, kwargs.get("headers"))
+		req = None
 		try:
-			return requests.post(url,headers=headers,json=json)
-		except requests.ConnectionError:
-			self.logger.critical("Cannot Connect to Server")
-			raise requests.ConnectionError
+			endpoint = self.beforeRequest(method, url)
+			pyPhinTrace.resetPhases()
+			if self.cassette is not None:
+				send = self.cassette.wrap(send, method)
+			try:
+				req = send(url, timeout=self.timeout, **kwargs)
+			except requests.Timeout:
+				self.recordRequestError(endpoint, "timeout")
+				self.logger.critical("Timed out waiting for Server")
+				raise requests.Timeout
+			except requests.ConnectionError:
+				self.recordRequestError(endpoint, "connection")
+				self.logger.critical("Cannot Connect to Server")
+				raise requests.ConnectionError
+			except requests.RequestException:
+				self.recordRequestError(endpoint, "request")
+				raise
+			self.recordResponse(endpoint, req.status_code, req.headers.get("Retry-After"),
+				time.time() - span["started"], len(req.content))
+			return req
+		except Exception as e:
+			span["exception"] = repr(e)
+			raise
+		finally:
+			if req is not None:
+				self.endRequestSpan(span, req.status_code, len(req.content),
+					req.elapsed.total_seconds(), pyPhinTrace.getPhases())
+			else:
+				self.endRequestSpan(span, None, 0, None, pyPhinTrace.getPhases())
 
+	'''startRequestSpan()
+	Returns the span of a request and calls the onRequestStart hooks
+	'''
+	def startRequestSpan(self, method, url, headers):
+		span = {"kind":"request",
+			"method":method,
+			"route":self.breaker.endpoint(method, url),
+			"url":url.split("?")[0],
+			"acceptVersion":(headers or {}).get("Accept-Version"),
+			"started":time.time(),
+			"exception":None}
+		self.callHooks("onRequestStart", span)
+		return span
+
+	'''endRequestSpan()
+	Completes the span of a request and calls the onRequestEnd hooks
+
+	headersTime - Seconds until the response headers arrived
+	phases - Connection timings, see pyPhinTrace
+	'''
+	def endRequestSpan(self, span, statusCode, size, headersTime, phases):
+		if len(self.hooks["onRequestEnd"]) == 0:
+			return
+		duration = time.time() - span["started"]
+		phases = dict(phases)
+		if headersTime is not None:
+			if "serverWait" not in phases:
+				phases["serverWait"] = max(0.0, headersTime - sum(phases.values()))
+			phases["transfer"] = max(0.0, duration - headersTime)
+		span.update({"status":statusCode,"bytes":size,"duration":duration,"phases":phases})
+		self.callHooks("onRequestEnd", span)
+
+	'''recordParse()
+	Records the time a parse stage took and calls the onParse hooks
+	'''
+	def recordParse(self, stage, source, started):
+		duration = time.time() - started
+		self.metrics.observe("phin_parse_seconds", duration, {"stage":stage})
+		if len(self.hooks["onParse"]) > 0:
+			self.callHooks("onParse", {"kind":"parse","stage":stage,"source":source,
+				"started":started,"duration":duration})
+
+	'''beforeRequest()
+	Asks the circuit breaker to send a request
+
+	Returns the endpoint of the request
+	'''
+	def beforeRequest(self, method, url):
+		try:
+			return self.breaker.before(method, url)
+		except pHinCircuitOpen as e:
+			self.metrics.inc("phin_request_errors_total", {"endpoint":e.endpoint,"cause":"circuit_open"})
+			raise
+
+	'''recordResponse()
+	Records a response in the circuit breaker and the metrics
+	'''
+	def recordResponse(self, endpoint, statusCode, retryAfter, seconds, size):
+		self.breaker.record(endpoint, statusCode, retryAfter)
+
+		self.metrics.inc("phin_requests_total", {"endpoint":endpoint,"status":statusCode})
+		self.metrics.observe("phin_request_seconds", seconds, {"endpoint":endpoint})
+		self.metrics.inc("phin_response_bytes_total", {"endpoint":endpoint}, size)
+		if statusCode < 400:
+			self.metrics.set("phin_last_success_timestamp_seconds", time.time(), {"endpoint":endpoint})
+		else:
+			self.metrics.inc("phin_request_errors_total", {"endpoint":endpoint,"cause":"http_%d" % statusCode})
+
+	'''recordRequestError()
+	Records a request that got no response
+	'''
+	def recordRequestError(self, endpoint, cause):
+		self.breaker.failure(endpoint)
+		self.metrics.inc("phin_request_errors_total", {"endpoint":endpoint,"cause":cause})
+
+	'''parseError()
+	Counts a field missing from a response, source is the
+	vessel id or chart route
+	'''
+	def parseError(self, field, source):
+		self.metrics.inc("phin_parse_errors_total", {"field":field,"source":source})
+
+	'''checkRequest()
+	Decodes a response once and checks it for errors
+
+	Returns the parsed json
+	'''
 	def checkRequest(self, request):
 		if request == None:
 			raise Exception("Request is None!")
@@ -439,10 +1252,11 @@ class pHin():
 		if "code" in reqJson:
 			if reqJson["code"] == "Unauthorized":
 				self.logger.critical("API Not Authorized! Json=%s",request.text)
-				raise Exception("API not Authorized! Request:" + request.text)
+				raise pHinUnauthorized("API not Authorized! Request:" + request.text)
 		if not reqJson["success"]:
 			self.logger.critical("Request not Successful! Json=%s",request.text)
 			raise Exception("Request not Successful! Request=" + request.text)
+		return reqJson
 
 	def checkUrlRoute(self, urlRoute):
 		if type(urlRoute) != str:
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+"""
+pyPhinAsync - asyncio counterpart of the pyPhin pHin client
+
+Shares the parsing, status classification and averaging of pHin,
+only the network layer is replaced by a single aiohttp session so
+one event loop can keep hundreds of requests in flight.
+
+Requires aiohttp (pip install aiohttp)
+
+"""
+
+import asyncio
+import json
+import random
+import time
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+from pyPhin import pHin, pHinAuth, pHinUnauthorized
+
+
+'''asyncResponse
+Minimal response object so the pHin check and parse
+methods can be used on aiohttp responses
+'''
+class asyncResponse():
+
+	def __init__(self, status_code, text, headers):
+		self.status_code = status_code
+		self.text = text
+		self.headers = headers
+
+
+class asyncPHin(pHin):
+
+	'''init()
+	Initializes the Library with Specified parameters
+
+	Takes the same parameters as pHin, and additionally
+
+	maxConcurrency - Max requests in flight at once for this client
+
+	The aiohttp session is created on first use inside the
+	running event loop, call close() when done.
+	'''
+	def __init__(self, logger=None,
+		phDataPointAvgLen=5,
+		orpMvDataPointAvgLen=5,
+		batteryDataPointAvgLen=5,
+		rssiDataPointAvgLen=1,
+		poolConnections=4,
+		poolMaxSize=100,
+		connectTimeout=5,
+		readTimeout=15,
+		maxRetries=2,
+		maxConcurrency=100,
+		seriesStore=None,
+		baseUrl=None,
+		breaker=None,
+		metrics=None):
+		if aiohttp is None:
+			raise Exception("aiohttp is required for asyncPHin!")
+
+		pHin.__init__(self, logger,
+			phDataPointAvgLen,
+			orpMvDataPointAvgLen,
+			batteryDataPointAvgLen,
+			rssiDataPointAvgLen,
+			poolConnections,
+			poolMaxSize,
+			connectTimeout,
+			readTimeout,
+			maxRetries,
+			seriesStore=seriesStore,
+			baseUrl=baseUrl,
+			breaker=breaker,
+			metrics=metrics)
+
+		self.poolMaxSize = poolMaxSize
+		self.maxRetries = maxRetries
+		self.maxConcurrency = maxConcurrency
+		self.semaphore = None
+		self.connectionStats = {"requests":0,"connections":0,"reused":0}
+
+	'''createSession()
+	The aiohttp session has to be created inside the event loop,
+	see getSession()
+	'''
+	def createSession(self, poolConnections, poolMaxSize, maxRetries):
+		self.adapter = None
+		return None
+
+	def getSession(self):
+		if self.session is None or self.session.closed:
+			connector = aiohttp.TCPConnector(limit=self.poolMaxSize, keepalive_timeout=60)
+			timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+			self.session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+				trace_configs=[self.createTraceConfig()])
+			self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+		return self.session
+
+	'''createTraceConfig()
+	Counts requests, new connections and reused connections
+	for getConnectionStats(), and records the phases of a
+	request in the phases dictionary passed as trace_request_ctx
+	'''
+	def createTraceConfig(self):
+		stats = self.connectionStats
+
+		def mark(context, name):
+			if isinstance(context.trace_request_ctx, dict):
+				context.trace_request_ctx[name] = time.time()
+
+		async def onRequestStart(session, context, params):
+			stats["requests"] += 1
+		async def onConnectionCreateStart(session, context, params):
+			mark(context, "connectStart")
+		async def onConnectionCreate(session, context, params):
+			stats["connections"] += 1
+			mark(context, "connectEnd")
+		async def onConnectionReuse(session, context, params):
+			stats["reused"] += 1
+		async def onDnsStart(session, context, params):
+			mark(context, "dnsStart")
+		async def onDnsEnd(session, context, params):
+			mark(context, "dnsEnd")
+		async def onRequestSent(session, context, params):
+			mark(context, "sent")
+		async def onRequestEnd(session, context, params):
+			mark(context, "headers")
+
+		traceConfig = aiohttp.TraceConfig()
+		traceConfig.on_request_start.append(onRequestStart)
+		traceConfig.on_connection_create_start.append(onConnectionCreateStart)
+		traceConfig.on_connection_create_end.append(onConnectionCreate)
+		traceConfig.on_connection_reuseconn.append(onConnectionReuse)
+		traceConfig.on_dns_resolvehost_start.append(onDnsStart)
+		traceConfig.on_dns_resolvehost_end.append(onDnsEnd)
+		traceConfig.on_request_headers_sent.append(onRequestSent)
+		traceConfig.on_request_end.append(onRequestEnd)
+		return traceConfig
+
+	'''getPhases()
+	Converts the times marked by the trace config into the
+	phases of pyPhinTrace
+	'''
+	def getPhases(self, marks, started):
+		phases = {"dns":0.0,"connect":0.0}
+		if "dnsEnd" in marks:
+			phases["dns"] = marks["dnsEnd"] - marks.get("dnsStart", marks["dnsEnd"])
+		if "connectEnd" in marks:
+			#aiohttp resolves the host inside the connection, TLS is included
+			phases["connect"] = marks["connectEnd"] - marks.get("connectStart", marks["connectEnd"]) - phases["dns"]
+		if "headers" in marks:
+			phases["serverWait"] = marks["headers"] - marks.get("sent", started)
+		return phases
+
+	def getConnectionStats(self):
+		return dict(self.connectionStats)
+
+	'''close()
+	Closes the aiohttp session and all pooled connections
+	'''
+	async def close(self):
+		if self.session is not None and not self.session.closed:
+			await self.session.close()
+
+	async def __aenter__(self):
+		self.getSession()
+		return self
+
+	async def __aexit__(self, excType, excValue, traceback):
+		await self.close()
+
+	'''login()
+	See pHin.login()
+	'''
+	async def login(self, contact, deviceUUID):
+
+		self.checkEmail(contact)
+
+		urls = self.checkRequest(await self.requestGet(self.baseUrl + "/urls"))
+
+		req = await self.requestPost(self.baseUrl+urls["signin"],
+			json={"contact":contact,"deviceType":"python"},
+			headers=self.createHeader(deviceUUID))
+
+		reqJson = self.checkRequest(req)
+
+		#Returns Route needed to verify
+		return reqJson["verifyUrl"]
+
+	'''verify()
+	See pHin.verify()
+	'''
+	async def verify(self, contact, deviceUUID, verifyUrl, verificationCode):
+
+		self.checkVerificationCode(verificationCode)
+		self.checkUrlRoute(verifyUrl)
+		self.checkEmail(contact)
+
+		req = await self.requestPost(
+			self.baseUrl+verifyUrl,
+			json={"contact":contact,
+				"deviceId":deviceUUID,
+				"verificationCode":verificationCode},
+			headers=self.createHeader(deviceUUID))
+
+		reqJson = self.checkRequest(req)
+
+		authToken, refreshToken, locationUrl, userRefreshUrl = self.parseVerify(reqJson)
+
+		req = await self.requestGet(
+			self.baseUrl+locationUrl,
+			headers=self.createHeader(deviceUUID, authToken, "2.0.1")
+			)
+
+		reqJson = self.checkRequest(req)
+
+		return self.parseLocations(authToken, reqJson, refreshToken, userRefreshUrl)
+
+	'''refreshAuth()
+	See pHin.refreshAuth()
+	'''
+	async def refreshAuth(self, auth, deviceUUID, staleToken=None):
+		if auth.asyncLock is None:
+			auth.asyncLock = asyncio.Lock()
+
+		async with auth.asyncLock:
+			if staleToken is not None and auth.authToken != staleToken:
+				return auth.authToken
+
+			req = await self.requestPost(*self.createRefreshRequest(auth, deviceUUID))
+
+			self.updateAuth(auth, self.checkRequest(req))
+
+		return auth.authToken
+
+	'''callWithAuth()
+	See pHin.callWithAuth(), call returns an awaitable
+	'''
+	async def callWithAuth(self, auth, deviceUUID, call):
+		if not isinstance(auth, pHinAuth):
+			return await call(auth)
+
+		authToken = auth.authToken
+		if auth.canRefresh() and auth.isExpiring(self.refreshMargin):
+			try:
+				authToken = await self.refreshAuth(auth, deviceUUID, authToken)
+			except Exception as e:
+				self.logger.error("Can not refresh auth token: Exception=%s",e)
+
+		try:
+			return await call(authToken)
+		except pHinUnauthorized:
+			if not auth.canRefresh():
+				raise
+			self.logger.info("Auth token rejected, refreshing")
+			authToken = await self.refreshAuth(auth, deviceUUID, authToken)
+
+		return await call(authToken)
+
+	'''getData()
+	See pHin.getData()
+	'''
+	async def getData(self, authToken, deviceUUID, vesselUrl):
+
+		if isinstance(authToken, pHinAuth):
+			return await self.callWithAuth(authToken, deviceUUID,
+				lambda token: self.getData(token, deviceUUID, vesselUrl))
+
+		self.checkUrlRoute(vesselUrl)
+
+		dataList = await self.getWaterData(
+			authToken,
+			deviceUUID,
+			vesselUrl)
+
+		return self.mergeData(dataList)
+
+	'''getDataMany()
+	Runs getData() for many accounts on the current event loop
+
+	accounts - list of (authToken or pHinAuth, deviceUUID, vesselUrl)
+
+	Returns a list in the same order, holding either the data
+	dictionary or the Exception raised for that account
+	'''
+	async def getDataMany(self, accounts):
+		return await asyncio.gather(
+			*[self.getData(*account) for account in accounts],
+			return_exceptions=True)
+
+	'''getVesselsData()
+	See pHin.getVesselsData()
+	'''
+	async def getVesselsData(self, authToken, deviceUUID, vesselUrls):
+
+		if isinstance(authToken, pHinAuth):
+			return await self.callWithAuth(authToken, deviceUUID,
+				lambda token: self.getVesselsData(token, deviceUUID, vesselUrls))
+
+		for vesselUrl in vesselUrls:
+			self.checkUrlRoute(vesselUrl)
+
+		#Charts of the routes seen on the last poll are requested
+		#together with the vessels, see pHin.getVesselsData()
+		prefetched = {}
+		for vesselUrl in vesselUrls:
+			for chartUrl in self.chartRoutes.get(vesselUrl, []):
+				if chartUrl not in prefetched:
+					prefetched[chartUrl] = asyncio.ensure_future(
+						self.getChartData(authToken, deviceUUID, chartUrl))
+
+		async def getVesselData(info, data, chartUrl):
+			chartTask = prefetched.pop(chartUrl, None)
+			if chartUrl is None:
+				chartData = None
+			elif chartTask is not None:
+				chartData = await chartTask
+			else:
+				chartData = await self.getChartData(authToken, deviceUUID, chartUrl)
+			vesselData = self.mergeData([data, chartData])
+			vesselData["vessel"] = info
+			self.metrics.set("phin_vessel_last_success_timestamp_seconds", time.time(), {"vessel":info["id"]})
+			return vesselData
+
+		async def getLocationData(vesselUrl):
+			vesselList = await self.getVessels(authToken, deviceUUID, vesselUrl)
+			self.updateChartRoutes(vesselUrl, [chartUrl for info, data, chartUrl in vesselList])
+			return await self.gatherAll([getVesselData(*vessel) for vessel in vesselList])
+
+		try:
+			locations = await self.gatherAll(
+				[getLocationData(vesselUrl) for vesselUrl in vesselUrls])
+		finally:
+			#Routes that are gone, their results are not used
+			for chartTask in prefetched.values():
+				chartTask.cancel()
+
+		return [vesselData for location in locations for vesselData in location]
+
+	'''gatherAll()
+	asyncio.gather() that cancels the other awaitables once one
+	raises and waits for them, so none keeps running (and awaiting
+	prefetches that are cancelled) after the call failed
+	'''
+	async def gatherAll(self, awaitables):
+		tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+		try:
+			return await asyncio.gather(*tasks)
+		except BaseException:
+			for task in tasks:
+				task.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+			raise
+
+	async def getVessels(self, authToken, deviceUUID, vesselUrl):
+
+		req = await self.requestGet(
+			self.baseUrl+vesselUrl,
+			headers=self.createHeader(deviceUUID, authToken, "2.0.0")
+			)
+
+		reqJson = self.checkRequest(req)
+
+		return self.parseVessels(reqJson, req.text, vesselUrl)
+
+	async def getWaterData(self, authToken, deviceUUID, vesselUrl):
+
+		chartRoutes = self.chartRoutes.get(vesselUrl)
+		chartTask = None
+		if chartRoutes:
+			chartTask = asyncio.ensure_future(
+				self.getChartData(authToken, deviceUUID, chartRoutes[0]))
+
+		try:
+			req = await self.requestGet(
+				self.baseUrl+vesselUrl,
+				headers=self.createHeader(deviceUUID, authToken, "2.0.0")
+				)
+
+			reqJson = self.checkRequest(req)
+
+			vessels = self.parseVessels(reqJson, req.text, vesselUrl)
+			self.updateChartRoutes(vesselUrl, [chartUrl for info, data, chartUrl in vessels])
+			info, data, chartUrl = vessels[0]
+
+			if chartUrl is None:
+				chartData = None
+			elif chartTask is not None and chartRoutes[0] == chartUrl:
+				chartData = await chartTask
+				chartTask = None
+			else:
+				chartData = await self.getChartData(
+					authToken,
+					deviceUUID,
+					chartUrl)
+		finally:
+			if chartTask is not None:
+				chartTask.cancel()
+
+		return [data,chartData]
+
+	'''getChartData()
+	See pHin.getChartData()
+	'''
+	async def getChartData(self, authToken, deviceUUID, chartUrl):
+		req = await self.requestGet(
+			self.baseUrl + chartUrl,
+			headers=self.createChartHeader(deviceUUID, authToken, chartUrl)
+			)
+
+		if self.seriesStore is None:
+			return self.processChartResponse(chartUrl, req)
+
+		#Merging into the store commits to SQLite, done on a worker
+		#thread so it does not block the other requests on the loop
+		return await asyncio.get_running_loop().run_in_executor(
+			None, self.processChartResponse, chartUrl, req)
+
+	async def requestGet(self,url,headers={}):
+		return await self.request("GET", url, headers=headers, retries=self.maxRetries)
+
+	async def requestPost(self,url,json={},headers={}):
+		return await self.request("POST", url, headers=headers, json=json, retries=0)
+
+	'''request()
+	Sends a request through the shared session, limited by the
+	concurrency semaphore and guarded by the circuit breaker.
+	Connection errors are retried up to retries times with a
+	jittered backoff, matching the retry policy of pHin.
+	'''
+	async def request(self, method, url, headers={}, json=None, retries=0):
+		session = self.getSession()
+		span = self.startRequestSpan(method, url, headers)
+		marks = {}
+		response = None
+		try:
+			endpoint = self.beforeRequest(method, url)
+			attempt = 0
+			while True:
+				try:
+					async with self.semaphore:
+						started = time.time()
+						marks.clear()
+						async with session.request(method, url, headers=headers, json=json,
+							trace_request_ctx=marks) as resp:
+							body = await resp.read()
+							text = await resp.text()
+							self.recordResponse(endpoint, resp.status, resp.headers.get("Retry-After"),
+								time.time() - started, len(body))
+							response = asyncResponse(resp.status, text, resp.headers)
+							response.size = len(body)
+							return response
+				except asyncio.TimeoutError:
+					if attempt >= retries:
+						self.recordRequestError(endpoint, "timeout")
+						self.logger.critical("Timed out waiting for Server")
+						raise
+				except aiohttp.ClientConnectionError:
+					if attempt >= retries:
+						self.recordRequestError(endpoint, "connection")
+						self.logger.critical("Cannot Connect to Server")
+						raise
+				attempt += 1
+				await asyncio.sleep(0.3 * (2 ** (attempt - 1)) * random.uniform(0.5, 1.0))
+		except Exception as e:
+			span["exception"] = repr(e)
+			raise
+		finally:
+			phases = self.getPhases(marks, span["started"])
+			if response is not None:
+				self.endRequestSpan(span, response.status_code, response.size,
+					marks.get("headers", time.time()) - span["started"], phases)
+			else:
+				self.endRequestSpan(span, None, 0, None, phases)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+pyPhinBackfill - Historical backfill of pHin chart data
+
+Walks every chart route (appChartsMonth, ...) the vessels of the given
+locations advertise and merges the charts into a pHinStore, each route
+into its own series. A checkpoint per route keeps the time and the
+validators of the last download, so a job that is stopped resumes where
+it was and a chart is only downloaded again when it can have new points,
+and then conditionally.
+
+The vessels and their chart routes are taken from the last poll of the
+client, the vessel lists are only requested for locations it did not
+poll yet. Routes the poll itself fetches (the weekly chart) are left to
+the poll, which merges them into the same series. Charts without
+timestamps are only merged if the spacing of their points is known
+(chartIntervals), otherwise their points could not be dated. Such a
+route is downloaded once, recorded as undated and not requested again,
+getRoutes() only returns the routes that are stored.
+
+	store = pHinStore("phin-history.db")
+	backfill = pHinBackfill(client, store)
+	backfill.run(authToken, deviceUUID, vesselUrls)
+	routes = backfill.getRoutes("vessel id")
+	if "appChartsMonth" in routes:
+		store.rollup(routes["appChartsMonth"], "ph", "day", start=time.time() - 90 * 86400)
+
+"""
+
+import time
+import logging
+
+from pyPhin import pHinAuth, pHinUnauthorized
+from pyPhinBreaker import pHinCircuitOpen
+
+
+class pHinBackfill():
+
+	#Seconds between the points of charts that come without timestamps
+	chartIntervals = {"appChartsWeek":3600}
+
+	'''init()
+	client - pHin client used for the requests
+	store - pHinStore the charts and checkpoints are kept in
+	logger - Used to pass in a logger for module to use
+	minInterval - Seconds before a route is requested again, the
+		charts only get a new point about once an hour
+	'''
+	def __init__(self, client, store, logger=None, minInterval=3600):
+		if logger != None:
+			self.logger = logger
+		else:
+			self.logger = logging.getLogger("nullLogger")
+			self.logger.addHandler(logging.NullHandler())
+
+		self.client = client
+		self.store = store
+		self.minInterval = minInterval
+
+	'''run()
+	Backfills the chart routes of all vessels of the given locations
+
+	authToken - Token recieved from login(), or a pHinAuth
+	deviceUUID - Any UUID
+	vesselUrls - vesselUrls from verify()
+
+	Returns a python dictionary object with the number of routes
+	"fetched", "notModified", "skipped" (checkpoint recent enough),
+	"polled" (fetched by the poll), "undated" (no timestamps, only
+	downloaded the first time) and "failed", and the number of
+	"points" added
+	'''
+	def run(self, authToken, deviceUUID, vesselUrls, now=None):
+
+		if isinstance(authToken, pHinAuth):
+			return self.client.callWithAuth(authToken, deviceUUID,
+				lambda token: self.run(token, deviceUUID, vesselUrls, now))
+
+		if now is None:
+			now = time.time()
+
+		summary = {"fetched":0,"notModified":0,"skipped":0,"polled":0,"undated":0,"failed":0,"points":0}
+		polled = self.getPolledRoutes()
+		for vesselUrl in vesselUrls:
+			self.client.checkUrlRoute(vesselUrl)
+			for vessel, chart, route in self.getVesselRoutes(authToken, deviceUUID, vesselUrl):
+				if route in polled:
+					summary["polled"] += 1
+					continue
+				try:
+					result, points = self.backfillRoute(authToken, deviceUUID, vessel, chart, route, now)
+				except (pHinUnauthorized, pHinCircuitOpen):
+					raise
+				except Exception as e:
+					self.logger.error("Not able to backfill %s: Exception=%s", route, e)
+					result, points = "failed", 0
+				summary[result] += 1
+				summary["points"] += points
+
+		self.logger.info("Backfill of %d locations: %s", len(vesselUrls), summary)
+		return summary
+
+	'''getPolledRoutes()
+	Returns the chart routes the client fetches on every poll
+	'''
+	def getPolledRoutes(self):
+		return set(route for routes in list(self.client.chartRoutes.values()) for route in routes)
+
+	'''getVesselRoutes()
+	Returns the chart routes of all vessels of one location as a list
+	of (vessel id, chart name, route), from the last poll of the client
+	if it polled the location
+	'''
+	def getVesselRoutes(self, authToken, deviceUUID, vesselUrl):
+		if vesselUrl not in self.client.vesselCharts:
+			self.client.getVessels(authToken, deviceUUID, vesselUrl)
+
+		routes = []
+		for vesselId, charts in self.client.vesselCharts.get(vesselUrl, []):
+			for chart, route in sorted(charts.items()):
+				routes.append((vesselId, chart, route))
+		return routes
+
+	'''backfillRoute()
+	Downloads a chart route unless its checkpoint is recent or the
+	route is undated, the request carries the validators of the
+	checkpoint
+
+	Returns (result, number of points added)
+	'''
+	def backfillRoute(self, authToken, deviceUUID, vessel, chart, route, now):
+		interval = self.chartIntervals.get(chart)
+		checkpoint = self.store.getCheckpoint(route)
+		if checkpoint is not None and checkpoint["points"] is None and interval is None:
+			#Undated, downloading it again would not store anything either
+			return "undated", 0
+		if checkpoint is not None and checkpoint["fetched"] is not None and now - checkpoint["fetched"] < self.minInterval:
+			return "skipped", 0
+
+		self.client.checkUrlRoute(route)
+		headers = self.client.createHeader(deviceUUID, authToken, "1.0.0")
+		if checkpoint is not None:
+			if checkpoint["etag"] != None:
+				headers["If-None-Match"] = checkpoint["etag"]
+			if checkpoint["lastModified"] != None:
+				headers["If-Modified-Since"] = checkpoint["lastModified"]
+
+		req = self.client.requestGet(self.client.baseUrl + route, headers=headers)
+
+		if req is not None and req.status_code == 304 and checkpoint is not None:
+			self.store.setCheckpoint(route, vessel, chart, checkpoint["etag"], checkpoint["lastModified"], now, 0)
+			return "notModified", 0
+
+		reqJson = self.client.checkRequest(req)
+		etag, lastModified = req.headers.get("ETag"), req.headers.get("Last-Modified")
+
+		if interval is None and self.store.chartTimestamps(reqJson) is None:
+			self.logger.warning("Chart %s has no timestamps, %s is not backfilled", chart, route)
+			self.store.setCheckpoint(route, vessel, chart, etag, lastModified, now, None)
+			return "undated", 0
+
+		added = self.store.merge(route, reqJson, now, interval)
+		self.store.setCheckpoint(route, vessel, chart, etag, lastModified, now, len(added))
+		return "fetched", len(added)
+
+	'''getRoutes()
+	Returns the backfilled chart routes of a vessel in a python
+	dictionary object {chart name: route}, the route is the series
+	key in the store. Undated routes are left out.
+	'''
+	def getRoutes(self, vessel):
+		return dict((checkpoint["chart"], checkpoint["route"])
+			for checkpoint in self.store.getCheckpoints(vessel) if checkpoint["points"] is not None)
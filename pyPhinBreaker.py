@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+pyPhinBreaker - Circuit breaker for requests to the pHin API
+
+Failures (timeouts, connection errors, 5xx and 429 responses) are counted
+per endpoint. After failureThreshold failures in a row the circuit of the
+endpoint opens and requests fail fast with pHinCircuitOpen instead of
+waiting for a service that is down. After a jittered, exponentially
+growing delay (or the Retry-After of the service) one trial request is let
+through (half-open), its result closes or opens the circuit again.
+
+Endpoints are the method and route with ids replaced, so the same route
+of all accounts and vessels shares one circuit.
+
+"""
+
+import re
+import time
+import random
+import threading
+import email.utils
+
+
+'''pHinCircuitOpen
+Raised instead of sending a request while the circuit of its
+endpoint is open
+'''
+class pHinCircuitOpen(Exception):
+
+	def __init__(self, endpoint, retryAt):
+		self.endpoint = endpoint
+		self.retryAt = retryAt
+		Exception.__init__(self, "pHin API circuit open for %s, retry in %ds" % (
+			endpoint, max(0, int(round(retryAt - time.time())))))
+
+
+class circuitBreaker():
+
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half-open"
+
+	'''init()
+	failureThreshold - Failures in a row that open the circuit
+	baseDelay - Seconds the circuit stays open the first time, doubled
+		every time the trial request fails
+	maxDelay - Longest time the circuit stays open
+	jitter - Fraction of the delay that is randomized, so clients do
+		not retry in sync
+	'''
+	def __init__(self, failureThreshold=5, baseDelay=5, maxDelay=600, jitter=0.5, seed=None):
+		self.failureThreshold = failureThreshold
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+		self.jitter = jitter
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.circuits = {}
+
+	'''endpoint()
+	Returns the circuit key of a request
+	'''
+	def endpoint(self, method, url):
+		path = re.sub(r"^\w+://[^/]+", "", url).split("?")[0]
+		return "%s %s" % (method, re.sub(r"/[^/]*\d[^/]*", "/*", path))
+
+	def getCircuit(self, endpoint):
+		circuit = self.circuits.get(endpoint)
+		if circuit is None:
+			circuit = {"state":self.CLOSED,"failures":0,"opened":0,"retryAt":0}
+			self.circuits[endpoint] = circuit
+		return circuit
+
+	'''before()
+	Call before sending a request, raises pHinCircuitOpen if the
+	request should not be sent
+
+	Returns the endpoint to pass to success() or failure()
+	'''
+	def before(self, method, url, now=None):
+		if now is None:
+			now = time.time()
+		endpoint = self.endpoint(method, url)
+		with self.lock:
+			circuit = self.getCircuit(endpoint)
+			if circuit["state"] == self.CLOSED:
+				return endpoint
+			if now < circuit["retryAt"]:
+				raise pHinCircuitOpen(endpoint, circuit["retryAt"])
+
+			#Half-open, only this request is let through until it returns.
+			#If it never does another one is tried after the next delay.
+			circuit["state"] = self.HALF_OPEN
+			circuit["retryAt"] = now + self.getDelay(circuit["opened"])
+			return endpoint
+
+	'''record()
+	Records the response of a request, 5xx and 429 responses are
+	failures
+	'''
+	def record(self, endpoint, statusCode, retryAfter=None, now=None):
+		if statusCode == 429 or statusCode >= 500:
+			self.failure(endpoint, self.parseRetryAfter(retryAfter, now), now)
+		else:
+			self.success(endpoint)
+
+	def success(self, endpoint):
+		with self.lock:
+			circuit = self.getCircuit(endpoint)
+			circuit.update({"state":self.CLOSED,"failures":0,"opened":0})
+
+	'''failure()
+	Records a failed request
+
+	retryAfter - Seconds the service asked us to wait, opens
+		the circuit at once
+	'''
+	def failure(self, endpoint, retryAfter=None, now=None):
+		if now is None:
+			now = time.time()
+		with self.lock:
+			circuit = self.getCircuit(endpoint)
+			circuit["failures"] += 1
+			if retryAfter is None and circuit["state"] == self.OPEN:
+				#A request sent before the circuit opened
+				return
+			if (retryAfter is None and circuit["state"] == self.CLOSED
+				and circuit["failures"] < self.failureThreshold):
+				return
+
+			circuit["opened"] += 1
+			delay = self.getDelay(circuit["opened"])
+			if retryAfter is not None:
+				delay = max(delay, retryAfter)
+			circuit["state"] = self.OPEN
+			circuit["retryAt"] = now + delay
+
+	'''getDelay()
+	Exponential backoff with jitter for the n-th opening in a row
+	'''
+	def getDelay(self, opened):
+		delay = min(self.baseDelay * (2 ** (opened - 1)), self.maxDelay)
+		return delay * (1 - self.jitter) + self.random.uniform(0, delay * self.jitter)
+
+	'''parseRetryAfter()
+	Returns the seconds of a Retry-After header (seconds or an HTTP
+	date), or None
+	'''
+	def parseRetryAfter(self, retryAfter, now=None):
+		if not retryAfter:
+			return None
+		if now is None:
+			now = time.time()
+		try:
+			return max(0.0, float(retryAfter))
+		except ValueError:
+			pass
+		try:
+			return max(0.0, email.utils.parsedate_to_datetime(retryAfter).timestamp() - now)
+		except (TypeError, ValueError, IndexError):
+			return None
+
+	'''getState()
+	Returns the state of every known endpoint in a python dictionary
+	object {endpoint: {"state", "failures", "retryAt"}}
+	'''
+	def getState(self):
+		with self.lock:
+			return dict((endpoint, {"state":circuit["state"],
+				"failures":circuit["failures"],
+				"retryAt":circuit["retryAt"]})
+				for endpoint, circuit in self.circuits.items())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+pyPhinCassette - Record and replay pHin API exchanges
+
+A cassette records every request a pHin client sends and the response
+it got as JSON lines (gzip compressed if the path ends in .gz). Auth and
+refresh tokens, emails, contacts, device ids and verification codes are
+replaced before anything is written, the Authorization header is never
+kept.
+
+Replaying serves the recorded responses back through the same
+requestGet/requestPost path (circuit breaker, metrics, tracing), so
+parsing, averaging and the driver mapping can be benchmarked and tested
+offline against real payloads. Responses are matched by method and route
+and served in recorded order, at full speed or with the recorded latency.
+
+	with cassette("phin.cassette.gz", "record") as tape:
+		pHin(cassette=tape).getVesselsData(authToken, deviceUUID, vesselUrls)
+
+	client = pHin(cassette=cassette("phin.cassette.gz"))
+	client.getVesselsData("token", "uuid", vesselUrls)
+
+Only the synchronous pHin client supports cassettes.
+
+"""
+
+import re
+import gzip
+import json
+import time
+import datetime
+import threading
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+'''pHinCassetteMiss
+Raised on replay when the cassette has no response for a request
+'''
+class pHinCassetteMiss(Exception):
+	pass
+
+
+class cassette():
+
+	RECORD = "record"
+	REPLAY = "replay"
+
+	#Headers kept in the cassette, everything else is dropped
+	keptHeaders = ("Accept-Version", "If-None-Match", "If-Modified-Since",
+		"ETag", "Last-Modified", "Retry-After", "Content-Type")
+
+	#JSON keys whose values are replaced by a placeholder
+	secretKeys = ("auth_token", "refresh_token", "token", "authToken", "refreshToken",
+		"contact", "email", "deviceId", "verificationCode")
+
+	emailPattern = re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+")
+	tokenPattern = re.compile(r"eyJ[\w-]*\.[\w-]+\.[\w-]+")
+
+	'''init()
+	path - Cassette file, .gz for a compressed cassette
+	mode - record or replay
+	timing - On replay, wait the recorded latency before every
+		response instead of answering at full speed
+	loop - On replay, start over with the first response of a route
+		once all its responses were served, otherwise raise
+		pHinCassetteMiss
+	'''
+	def __init__(self, path, mode=REPLAY, timing=False, loop=True):
+		if mode not in (self.RECORD, self.REPLAY):
+			raise ValueError("Unknown cassette mode %s!" % mode)
+
+		self.path = path
+		self.mode = mode
+		self.timing = timing
+		self.loop = loop
+		self.lock = threading.Lock()
+		self.file = None
+		self.entries = {}
+		self.positions = {}
+		self.count = 0
+
+		if mode == self.RECORD:
+			self.file = self.open("wt")
+		else:
+			self.load()
+
+	def open(self, mode):
+		if self.path.endswith(".gz"):
+			return gzip.open(self.path, mode, encoding="utf-8")
+		return open(self.path, mode, encoding="utf-8")
+
+	def load(self):
+		with self.open("rt") as cassetteFile:
+			for line in cassetteFile:
+				if line.strip() == "":
+					continue
+				entry = json.loads(line)
+				self.entries.setdefault(self.getKey(entry["method"], entry["route"]), []).append(entry)
+				self.count += 1
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+	'''wrap()
+	Returns send (session.get or session.post) recording to or
+	replaying from the cassette
+	'''
+	def wrap(self, send, method):
+		if self.mode == self.RECORD:
+			def recordSend(url, **kwargs):
+				req = send(url, **kwargs)
+				self.record(method, url, kwargs, req)
+				return req
+			return recordSend
+
+		def replaySend(url, **kwargs):
+			return self.replay(method, url)
+		return replaySend
+
+	def getRoute(self, url):
+		return re.sub(r"^\w+://[^/]+", "", url)
+
+	def getKey(self, method, route):
+		return "%s %s" % (method, route)
+
+	'''record()
+	Appends a sanitized request and its response to the cassette
+	'''
+	def record(self, method, url, kwargs, req):
+		entry = {"method":method,
+			"route":self.getRoute(url),
+			"requestHeaders":self.keepHeaders(kwargs.get("headers")),
+			"requestBody":self.sanitize(kwargs.get("json")),
+			"status":req.status_code,
+			"headers":self.keepHeaders(req.headers),
+			"body":self.sanitizeText(req.text),
+			"elapsed":round(req.elapsed.total_seconds(), 4)}
+		line = json.dumps(entry, separators=(",", ":"))
+		with self.lock:
+			if self.file is not None:
+				self.file.write(line + "\n")
+				self.file.flush()
+				self.count += 1
+
+	'''replay()
+	Returns the next recorded response of a request as a
+	requests.Response
+	'''
+	def replay(self, method, url):
+		key = self.getKey(method, self.getRoute(url))
+		with self.lock:
+			entries = self.entries.get(key)
+			position = self.positions.get(key, 0)
+			if entries and position >= len(entries) and self.loop:
+				position = 0
+			if not entries or position >= len(entries):
+				raise pHinCassetteMiss("No recorded response for %s" % key)
+			self.positions[key] = position + 1
+			entry = entries[position]
+
+		if self.timing and entry["elapsed"] > 0:
+			time.sleep(entry["elapsed"])
+
+		response = requests.Response()
+		response.status_code = entry["status"]
+		response.headers = CaseInsensitiveDict(entry["headers"])
+		response._content = (entry["body"] or "").encode("utf-8")
+		response.encoding = "utf-8"
+		response.url = url
+		response.elapsed = datetime.timedelta(seconds=entry["elapsed"])
+		return response
+
+	def keepHeaders(self, headers):
+		if not headers:
+			return {}
+		kept = dict((name.lower(), name) for name in self.keptHeaders)
+		return dict((kept[name.lower()], value) for name, value in headers.items() if name.lower() in kept)
+
+	'''sanitize()
+	Returns a copy of a parsed JSON value with the secrets replaced
+	'''
+	def sanitize(self, value, key=None):
+		if isinstance(value, dict):
+			return dict((name, self.sanitize(item, name)) for name, item in value.items())
+		if isinstance(value, list):
+			return [self.sanitize(item) for item in value]
+		if isinstance(value, str):
+			#Routes such as the refreshToken entry of /urls are kept
+			if key in self.secretKeys and not value.startswith("/"):
+				return "<%s>" % key
+			return self.tokenPattern.sub("<token>", self.emailPattern.sub("user@example.com", value))
+		return value
+
+	'''sanitizeText()
+	Sanitizes a response body, JSON is sanitized by key and written
+	compact, other bodies only have tokens and emails replaced
+	'''
+	def sanitizeText(self, text):
+		if not text:
+			return text
+		try:
+			return json.dumps(self.sanitize(json.loads(text)), separators=(",", ":"))
+		except ValueError:
+			return self.sanitize(text)
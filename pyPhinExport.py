@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+pyPhinExport - Export pHin readings without Polyglot
+
+Polls the accounts of an accounts file on a schedule and streams one
+normalized reading per vessel to stdout or to rotating files, as JSON
+Lines or CSV. Every reading is written and flushed as soon as its
+account was polled. The accounts file is read again each round and only
+concurrency accounts are in flight, the readings are never held for a
+whole round. The shared client keeps the last chart, validators and
+trend of every vessel it polled (and their metrics), so memory grows
+with the number of vessels, but not with the number of rounds.
+
+	python3 pyPhinExport.py accounts.jsonl --interval 3600 --format csv --output phin.csv
+
+The accounts file has one JSON object per line with the keys of the node
+server parameters, lines starting with # are skipped:
+
+	{"authtoken": "...", "uuid": "...", "vesselurl": "/vessels/..."}
+	{"authtoken": "...", "uuid": "...", "vesselurls": ["/vessels/...", "/vessels/..."],
+		"refreshtoken": "...", "refreshurl": "/..."}
+
+Accounts with a refreshtoken and refreshurl have their auth token
+refreshed before it expires, the refreshed token is only kept in memory.
+
+"""
+
+import io
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pyPhin import pHin, pHinAuth
+from pyPhinReadings import columns, normalize, rotatingFile
+
+
+'''readAccounts()
+Yields (line number, account) for every account of an accounts
+file, one line at a time
+'''
+def readAccounts(path):
+	with open(path, "r", encoding="utf-8") as accountsFile:
+		for number, line in enumerate(accountsFile, 1):
+			line = line.strip()
+			if line == "" or line.startswith("#"):
+				continue
+			try:
+				account = json.loads(line)
+			except ValueError:
+				raise ValueError("Line %d of %s is not JSON!" % (number, path))
+			if not account.get("authtoken") or not account.get("uuid"):
+				raise ValueError("Line %d of %s has no authtoken or uuid!" % (number, path))
+			if not account.get("vesselurls") and not account.get("vesselurl"):
+				raise ValueError("Line %d of %s has no vesselurl!" % (number, path))
+			yield number, account
+
+
+'''streamOutput
+Stdout as an output, never rotated or closed
+'''
+class streamOutput():
+
+	def __init__(self, stream, header=None):
+		self.stream = stream
+		if header is not None:
+			self.write(header)
+
+	def write(self, text):
+		self.stream.write(text)
+		self.stream.flush()
+
+	def close(self):
+		pass
+
+
+'''lineFormat
+Formats a reading as one line of JSON Lines ("jsonl") or CSV
+'''
+class lineFormat():
+
+	def __init__(self, name):
+		if name not in ("jsonl", "csv"):
+			raise ValueError("Unknown format %s!" % name)
+		self.name = name
+
+	def getHeader(self):
+		if self.name == "csv":
+			return self.formatRow(columns)
+		return None
+
+	def format(self, reading):
+		if self.name == "csv":
+			return self.formatRow(["" if reading[column] is None else reading[column] for column in columns])
+		return json.dumps(reading, separators=(",", ":")) + "\n"
+
+	def formatRow(self, row):
+		line = io.StringIO()
+		csv.writer(line, lineterminator="\n").writerow(row)
+		return line.getvalue()
+
+
+class pHinExporter():
+
+	'''init()
+	client - pHin client shared by all accounts
+	output - Anything with write(text), every reading is written
+		with a single call
+	lineFormat - lineFormat of the readings
+	concurrency - Accounts polled at the same time
+	logger - Used to pass in a logger for module to use
+	'''
+	def __init__(self, client, output, lineFormat, concurrency=10, logger=None):
+		if logger != None:
+			self.logger = logger
+		else:
+			self.logger = logging.getLogger("nullLogger")
+			self.logger.addHandler(logging.NullHandler())
+
+		self.client = client
+		self.output = output
+		self.lineFormat = lineFormat
+		self.concurrency = concurrency
+		self.auths = {}
+
+	'''getAuth()
+	Returns the auth token of an account, a pHinAuth kept for the
+	account if it can be refreshed
+	'''
+	def getAuth(self, account):
+		if not account.get("refreshtoken") or not account.get("refreshurl"):
+			return account["authtoken"]
+		key = (account["uuid"], account["refreshtoken"])
+		if key not in self.auths:
+			self.auths[key] = pHinAuth(account["authtoken"], account["refreshtoken"], account["refreshurl"])
+		return self.auths[key]
+
+	'''pollAccount()
+	Polls all vessels of an account
+
+	Returns a list of normalized readings
+	'''
+	def pollAccount(self, number, account):
+		vesselUrls = account.get("vesselurls") or [account["vesselurl"]]
+		vessels = self.client.getVesselsData(self.getAuth(account), account["uuid"], vesselUrls)
+		now = time.time()
+		return [normalize(data, account.get("name", number), now) for data in vessels]
+
+	'''runRound()
+	Polls every account of the accounts file once, readings are
+	written as the accounts finish
+
+	Returns a python dictionary object with the number of "accounts",
+	"failed" accounts and "readings" written
+	'''
+	def runRound(self, accounts, executor):
+		summary = {"accounts":0, "failed":0, "readings":0}
+		inFlight = set()
+
+		def collect(done):
+			for future in done:
+				number = future.number
+				try:
+					readings = future.result()
+				except Exception as e:
+					self.logger.error("Not able to poll account on line %d: Exception=%s", number, e)
+					summary["failed"] += 1
+					continue
+				for reading in readings:
+					self.output.write(self.lineFormat.format(reading))
+					summary["readings"] += 1
+
+		for number, account in accounts:
+			if len(inFlight) >= self.concurrency:
+				done, inFlight = wait(inFlight, return_when=FIRST_COMPLETED)
+				collect(done)
+			future = executor.submit(self.pollAccount, number, account)
+			future.number = number
+			inFlight.add(future)
+			summary["accounts"] += 1
+
+		collect(wait(inFlight).done)
+		return summary
+
+	'''run()
+	Polls the accounts file every interval seconds, rounds times
+	(0 runs until interrupted)
+	'''
+	def run(self, accountsPath, interval=3600, rounds=1):
+		count = 0
+		with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+			while True:
+				started = time.time()
+				summary = self.runRound(readAccounts(accountsPath), executor)
+				count += 1
+				self.logger.info("Round %d: %s in %.1fs", count, summary, time.time() - started)
+				if rounds > 0 and count >= rounds:
+					return
+				time.sleep(max(0, started + interval - time.time()))
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Export pHin readings as JSON Lines or CSV")
+	parser.add_argument("accounts", help="accounts file, one JSON object per line")
+	parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+	parser.add_argument("--output", help="file to write to instead of stdout")
+	parser.add_argument("--max-bytes", type=int, default=0, help="rotate the output file at this size")
+	parser.add_argument("--backups", type=int, default=5, help="rotated output files kept")
+	parser.add_argument("--interval", type=float, default=3600, help="seconds between rounds")
+	parser.add_argument("--rounds", type=int, default=1, help="rounds to run, 0 runs until interrupted")
+	parser.add_argument("--concurrency", type=int, default=10, help="accounts polled at the same time")
+	parser.add_argument("--base-url", default=pHin.baseUrl)
+	parser.add_argument("--verbose", action="store_true", help="log every round to stderr")
+	args = parser.parse_args()
+
+	logging.basicConfig(stream=sys.stderr, level=logging.INFO if args.verbose else logging.ERROR,
+		format="%(asctime)s %(levelname)s %(message)s")
+	logger = logging.getLogger("pyPhinExport")
+
+	lines = lineFormat(args.format)
+	if args.output:
+		output = rotatingFile(args.output, args.max_bytes, args.backups, lines.getHeader())
+	else:
+		output = streamOutput(sys.stdout, lines.getHeader())
+
+	#Accounts run one after another on a worker each, the vessels and
+	#charts of an account are requested on the client's own workers
+	client = pHin(logger=logger, baseUrl=args.base_url,
+		poolMaxSize=args.concurrency, maxWorkers=args.concurrency)
+	exporter = pHinExporter(client, output, lines, args.concurrency, logger)
+	try:
+		exporter.run(args.accounts, args.interval, args.rounds)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		output.close()
+		client.close()
+
+
+if __name__ == "__main__":
+	main()
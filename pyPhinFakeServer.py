@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+pyPhinFakeServer - Local stand-in for the pHin API (api.phin.co)
+
+Serves /urls, signincontact, verify, locations, vessels and the
+appChartsWeek and appChartsMonth charts (the month chart with
+timestamps) with synthetic data for any number of accounts,
+locations and vessels. Auth tokens can be given a lifetime and renewed
+through the user refreshToken route. Latency and errors (401, 5xx, non-JSON bodies)
+can be injected to test and measure the client without the real service.
+
+	server = fakeServer(latency=0.05, vesselsPerLocation=3).start()
+	client = pHin(baseUrl=server.url)
+	authToken, deviceUUID, vesselUrl = server.getAccount(0)
+	client.getData(authToken, deviceUUID, vesselUrl)
+	server.stop()
+
+"""
+
+import base64
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class threadingServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class fakeServer():
+
+	'''init()
+	Configures the fake service
+
+	latency - Seconds added to every response, or (min, max) for a
+		random latency
+	errors - Probability per request of an injected error:
+		{"unauthorized": 0.01, "server": 0.01, "nonjson": 0.01,
+		"ratelimit": 0.01}
+	locationsPerAccount - Locations of every account
+	vesselsPerLocation - Vessels of every location
+	chartPoints - Points in the weekly chart
+	historyPoints - Points in the monthly chart
+	seed - Seed of the synthetic data and injected errors
+	tokenLifetime - Seconds auth tokens are accepted, None for
+		tokens that do not expire
+	'''
+	def __init__(self, latency=0, errors=None,
+		locationsPerAccount=1,
+		vesselsPerLocation=1,
+		chartPoints=168,
+		historyPoints=720,
+		seed=0,
+		tokenLifetime=None,
+		host="127.0.0.1",
+		port=0):
+		self.latency = latency
+		self.errors = errors or {}
+		self.locationsPerAccount = locationsPerAccount
+		self.vesselsPerLocation = vesselsPerLocation
+		self.chartPoints = chartPoints
+		self.historyPoints = historyPoints
+		self.seed = seed
+		self.tokenLifetime = tokenLifetime
+		self.host = host
+		self.port = port
+
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.hour = 0
+		#Time of hour 0 of the charts
+		self.epoch = int(time.time()) // 3600 * 3600
+		self.counts = {}
+		self.server = None
+		self.thread = None
+		self.url = None
+
+	def start(self):
+		handler = self.createHandler()
+		self.server = threadingServer((self.host, self.port), handler)
+		self.url = "http://%s:%d" % self.server.server_address
+		self.thread = threading.Thread(target=self.server.serve_forever, name="pHinFakeServer")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, excType, excValue, traceback):
+		self.stop()
+
+	'''advance()
+	Moves the synthetic charts forward, every hour adds a data point
+	'''
+	def advance(self, hours=1):
+		with self.lock:
+			self.hour += hours
+
+	'''getAccount()
+	Returns (authToken, deviceUUID, vesselUrl) of an account
+	'''
+	def getAccount(self, index):
+		return (self.createToken(index),
+			"00000000-0000-4000-8000-%012d" % index,
+			self.vesselsRoute(index, 0))
+
+	'''getVesselUrls()
+	Returns the vessel routes of all locations of an account
+	'''
+	def getVesselUrls(self, index):
+		return [self.vesselsRoute(index, location) for location in range(self.locationsPerAccount)]
+
+	'''getRefresh()
+	Returns (refreshToken, refreshUrl) of an account
+	'''
+	def getRefresh(self, index):
+		return self.refreshToken(index), "/users/%d/refreshToken" % index
+
+	'''getCounts()
+	Returns the number of requests served per route kind
+	'''
+	def getCounts(self):
+		with self.lock:
+			return dict(self.counts)
+
+	'''createToken()
+	JWT shaped auth token, unsigned, with the user and expiry
+	'''
+	def createToken(self, user):
+		issued = int(time.time())
+		claims = {"sub":str(user),"iat":issued}
+		if self.tokenLifetime is not None:
+			claims["exp"] = issued + self.tokenLifetime
+		return ".".join(self.encodeSegment(segment) for segment in ({"alg":"none","typ":"JWT"}, claims)) + ".fake"
+
+	def encodeSegment(self, data):
+		return base64.urlsafe_b64encode(json.dumps(data).encode("utf-8")).decode("ascii").rstrip("=")
+
+	def refreshToken(self, user):
+		return "fake-refresh-token-%08d" % user
+
+	def contactUser(self, contact):
+		return zlib.crc32(str(contact).encode("utf-8")) % 100000000
+
+	'''tokenUser()
+	Returns the user of a valid auth token, or None
+	'''
+	def tokenUser(self, authorization):
+		match = re.match(r"^Bearer [\w-]+\.([\w-]+)\.fake$", authorization or "")
+		if match is None:
+			return None
+		try:
+			payload = match.group(1)
+			claims = json.loads(base64.urlsafe_b64decode((payload + "=" * (-len(payload) % 4)).encode("ascii")))
+			user = int(claims["sub"])
+		except (ValueError, KeyError, TypeError):
+			return None
+		if "exp" in claims and claims["exp"] <= time.time():
+			self.count("token_expired")
+			return None
+		return user
+
+	def vesselsRoute(self, user, location):
+		return "/users/%d/locations/%d/vessels" % (user, location)
+
+	def chartRoute(self, user, location, vessel, window="week"):
+		return "/users/%d/locations/%d/vessels/%d/charts/%s" % (user, location, vessel, window)
+
+	def count(self, kind):
+		with self.lock:
+			self.counts[kind] = self.counts.get(kind, 0) + 1
+
+	def delay(self):
+		latency = self.latency
+		if isinstance(latency, (tuple, list)):
+			with self.lock:
+				latency = self.random.uniform(latency[0], latency[1])
+		if latency > 0:
+			time.sleep(latency)
+
+	'''injectedError()
+	Returns the kind of error to inject for this request, or None
+	'''
+	def injectedError(self):
+		with self.lock:
+			for kind in ("unauthorized", "server", "nonjson", "ratelimit"):
+				probability = self.errors.get(kind, 0)
+				if probability > 0 and self.random.random() < probability:
+					return kind
+		return None
+
+	def handle(self, method, path, headers, body):
+		self.delay()
+
+		error = self.injectedError()
+		if error == "unauthorized":
+			self.count("error_unauthorized")
+			return 401, {"success":False,"code":"Unauthorized"}, {}
+		if error == "server":
+			self.count("error_server")
+			return 503, "<html><body>Service Unavailable</body></html>", {}
+		if error == "nonjson":
+			self.count("error_nonjson")
+			return 200, "<html><body>Maintenance</body></html>", {}
+		if error == "ratelimit":
+			self.count("error_ratelimit")
+			return 429, {"success":False,"code":"TooManyRequests"}, {"Retry-After":"1"}
+
+		if method == "GET" and path == "/urls":
+			self.count("urls")
+			return 200, {"refreshToken":"/refreshtoken",
+				"signin":"/signincontact",
+				"success":True,
+				"versionCheck":"/version"}, {}
+
+		if method == "POST" and path == "/signincontact":
+			self.count("signin")
+			return 200, {"success":True,"verifyUrl":"/signincontact/verify/%d" % self.contactUser(body.get("contact")),"token":"signin"}, {}
+
+		match = re.match(r"^/signincontact/verify/\d+$", path)
+		if method == "POST" and match:
+			self.count("verify")
+			user = self.contactUser(body.get("contact"))
+			return 200, {"success":True,
+				"auth_token":self.createToken(user),
+				"refresh_token":self.refreshToken(user),
+				"user":{"locationsUrl":"/users/%d/locations" % user,
+					"userRefreshTokenUrl":"/users/%d/refreshToken" % user}}, {}
+
+		match = re.match(r"^/users/(\d+)/refreshToken$", path)
+		if method == "POST" and match:
+			self.count("refresh")
+			user = int(match.group(1))
+			if body.get("refresh_token") != self.refreshToken(user):
+				return 401, {"success":False,"code":"Unauthorized"}, {}
+			response = {"success":True,
+				"auth_token":self.createToken(user),
+				"refresh_token":self.refreshToken(user)}
+			if self.tokenLifetime is not None:
+				response["expires_in"] = self.tokenLifetime
+			return 200, response, {}
+
+		user = self.tokenUser(headers.get("Authorization"))
+
+		match = re.match(r"^/users/(\d+)/locations$", path)
+		if method == "GET" and match:
+			self.count("locations")
+			if user != int(match.group(1)):
+				return 401, {"success":False,"code":"Unauthorized"}, {}
+			return 200, self.locations(user), {}
+
+		match = re.match(r"^/users/(\d+)/locations/(\d+)/vessels$", path)
+		if method == "GET" and match:
+			self.count("vessels")
+			if user != int(match.group(1)):
+				return 401, {"success":False,"code":"Unauthorized"}, {}
+			return 200, self.vessels(user, int(match.group(2))), {}
+
+		match = re.match(r"^/users/(\d+)/locations/(\d+)/vessels/(\d+)/charts/(week|month)$", path)
+		if method == "GET" and match:
+			kind = "chart" if match.group(4) == "week" else "chart_month"
+			self.count(kind)
+			if user != int(match.group(1)):
+				return 401, {"success":False,"code":"Unauthorized"}, {}
+			etag = '"%d-%s-%s-%s-%d"' % (user, match.group(2), match.group(3), match.group(4), self.hour)
+			if headers.get("If-None-Match") == etag:
+				self.count("%s_not_modified" % kind)
+				return 304, None, {"ETag":etag}
+			return 200, self.chart(user, int(match.group(2)), int(match.group(3)), match.group(4)), {"ETag":etag}
+
+		self.count("not_found")
+		return 404, {"success":False,"code":"NotFound"}, {}
+
+	def locations(self, user):
+		return {"success":True,
+			"locations":[{
+				"vesselSummaries":[],
+				"resources":{"vessels":{"route":self.vesselsRoute(user, location)}}}
+				for location in range(self.locationsPerAccount)]}
+
+	def vessels(self, user, location):
+		vessels = []
+		for vessel in range(self.vesselsPerLocation):
+			rnd = random.Random("%d-%d-%d-%d" % (self.seed, user, location, vessel))
+			status = rnd.choice([1, 2, 3])
+			data = {"id":"vessel-%d-%d-%d" % (user, location, vessel),
+				"name":"Pool %d" % (vessel + 1),
+				"waterReport":{"TA":{"value":rnd.choice([60, 80, 100])},
+					"CYA":{"value":rnd.choice([30, 50, 70])},
+					"TH":{"value":rnd.choice([250, 350, 450])}},
+				"disc":{"temperatureF":round(rnd.uniform(65, 88), 1),
+					"name":["balanced", "needs-attention", "needs-immediate-attention"][status - 1],
+					"waterStatus":{"value":status}},
+				"widgets":[{"resources":{"appChartsWeek":{
+					"route":self.chartRoute(user, location, vessel)},
+					"appChartsMonth":{
+					"route":self.chartRoute(user, location, vessel, "month")}}}]}
+			if rnd.random() < 0.3:
+				data["requiredActions"] = [{"buttonDetails":{"title":"Dip a test strip"}}]
+			vessels.append(data)
+		return {"success":True,"vessels":vessels}
+
+	def chart(self, user, location, vessel, window="week"):
+		rnd = random.Random("%d-%d-%d-%d" % (self.seed, user, location, vessel))
+		phase = rnd.uniform(0, 2 * math.pi)
+		points = self.chartPoints if window == "week" else self.historyPoints
+		hours = range(self.hour - points + 1, self.hour + 1)
+		chart = {"success":True,
+			"ph":[round(7.4 + 0.3 * math.sin(phase + hour / 24.0), 2) for hour in hours],
+			"orpMv":[round(650 + 80 * math.sin(phase + hour / 12.0), 1) for hour in hours],
+			"batteryMv":[round(3300 - hour * 0.5, 1) for hour in hours],
+			"rssi":[-85 - (hour % 10) for hour in hours]}
+		if window != "week":
+			chart["timestamps"] = [self.epoch + hour * 3600 for hour in hours]
+		return chart
+
+	def createHandler(self):
+		fake = self
+
+		class handler(BaseHTTPRequestHandler):
+
+			protocol_version = "HTTP/1.1"
+			disable_nagle_algorithm = True
+
+			def do_GET(self):
+				self.respond("GET", {})
+
+			def do_POST(self):
+				length = int(self.headers.get("Content-Length") or 0)
+				try:
+					body = json.loads(self.rfile.read(length) or b"{}")
+				except ValueError:
+					body = {}
+				self.respond("POST", body)
+
+			def respond(self, method, body):
+				status, payload, headers = fake.handle(method, self.path, self.headers, body)
+				if payload is None:
+					data = b""
+				elif isinstance(payload, str):
+					data = payload.encode("utf-8")
+				else:
+					data = json.dumps(payload).encode("utf-8")
+
+				self.send_response(status)
+				for key, value in headers.items():
+					self.send_header(key, value)
+				if status != 304:
+					self.send_header("Content-Type", "application/json" if isinstance(payload, dict) else "text/html")
+					self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				if status != 304:
+					self.wfile.write(data)
+
+			def log_message(self, format, *args):
+				pass
+
+		return handler
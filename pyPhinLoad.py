@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+pyPhinLoad - Load harness for pyPhin and the pHin node server
+
+Runs pHin.getVesselsData (or Controller.queryPoolData with --controller) for N
+simulated accounts against a pyPhinFakeServer and reports throughput and
+p50/p95/p99 latency.
+
+	python3 pyPhinLoad.py --accounts 100 --iterations 5 --concurrency 20 --latency 0.05
+
+With --record the exchanges are written to a cassette, --replay serves
+them from a cassette instead of the fake server (see pyPhinCassette).
+Cassettes recorded against api.phin.co replay the same way as long as
+the accounts match.
+
+	python3 pyPhinLoad.py --accounts 10 --record load.cassette.gz
+	python3 pyPhinLoad.py --accounts 10 --iterations 100 --replay load.cassette.gz
+
+"""
+
+import argparse
+import logging
+import math
+import os
+import sys
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyPhin import pHin
+from pyPhinCassette import cassette
+from pyPhinFakeServer import fakeServer
+
+
+'''percentile()
+Nearest rank percentile of sorted values
+'''
+def percentile(values, percent):
+	if len(values) == 0:
+		return 0.0
+	rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+	return values[max(0, min(rank, len(values) - 1))]
+
+
+'''loadReport
+Collects the latency of every call and summarizes them
+'''
+class loadReport():
+
+	def __init__(self, name):
+		self.name = name
+		self.lock = threading.Lock()
+		self.latencies = []
+		self.errors = {}
+		self.started = None
+		self.finished = None
+
+	def start(self):
+		self.started = time.time()
+
+	def finish(self):
+		self.finished = time.time()
+
+	def record(self, latency, error=None):
+		with self.lock:
+			self.latencies.append(latency)
+			if error is not None:
+				kind = type(error).__name__
+				self.errors[kind] = self.errors.get(kind, 0) + 1
+
+	def getSummary(self):
+		latencies = sorted(self.latencies)
+		duration = (self.finished or time.time()) - self.started
+		return {"name":self.name,
+			"calls":len(latencies),
+			"errors":sum(self.errors.values()),
+			"errorKinds":dict(self.errors),
+			"seconds":round(duration, 3),
+			"throughput":round(len(latencies) / duration, 2) if duration > 0 else 0.0,
+			"p50":round(percentile(latencies, 50) * 1000, 1),
+			"p95":round(percentile(latencies, 95) * 1000, 1),
+			"p99":round(percentile(latencies, 99) * 1000, 1)}
+
+	def format(self):
+		summary = self.getSummary()
+		return ("%(name)s: %(calls)d calls, %(errors)d errors in %(seconds).2fs, "
+			"%(throughput).1f calls/s, p50=%(p50).1fms p95=%(p95).1fms p99=%(p99).1fms" % summary)
+
+
+'''runClientLoad()
+Calls pHin.getVesselsData for every account, iterations times, with
+concurrency calls in flight. All accounts share one pHin client.
+'''
+def runClientLoad(server, accounts, iterations=1, concurrency=10, client=None):
+	if client is None:
+		client = pHin(baseUrl=server.url, poolMaxSize=concurrency, maxWorkers=concurrency)
+
+	report = loadReport("pHin.getVesselsData")
+
+	def poll(index):
+		authToken, deviceUUID, vesselUrl = server.getAccount(index)
+		started = time.time()
+		try:
+			client.getVesselsData(authToken, deviceUUID, server.getVesselUrls(index))
+			report.record(time.time() - started)
+		except Exception as e:
+			report.record(time.time() - started, e)
+
+	report.start()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		for iteration in range(iterations):
+			list(executor.map(poll, range(accounts)))
+			server.advance()
+	report.finish()
+	return report
+
+
+'''fakePolyglot
+Just enough of the polyinterface Interface for a Controller to poll,
+sent messages are counted instead of going to MQTT
+'''
+class fakePolyglot():
+
+	def __init__(self):
+		self.inQueue = queue.Queue()
+		self.lock = threading.Lock()
+		self.messages = 0
+		self.config = None
+
+	def onConfig(self, callback):
+		pass
+
+	def onStop(self, callback):
+		pass
+
+	def send(self, message, *args, **kwargs):
+		with self.lock:
+			self.messages += 1
+
+	def addNode(self, node, *args, **kwargs):
+		self.send({"addnode":node.address})
+
+	def saveCustomParams(self, params):
+		pass
+
+	def addNotice(self, *args, **kwargs):
+		pass
+
+	def removeNoticesAll(self, *args, **kwargs):
+		pass
+
+	def installprofile(self):
+		pass
+
+	def restart(self):
+		pass
+
+
+'''runControllerLoad()
+Runs Controller.queryPoolData for every account and waits for the
+poll worker to finish it. Needs polyinterface (or pgc_interface) to
+be installed.
+
+tape - Cassette the controllers record to or replay from
+workDir - Directory the store and snapshot of every controller are
+	kept in, a new temporary directory by default
+'''
+def runControllerLoad(server, accounts, iterations=1, concurrency=10, tape=None, workDir=None):
+	from nodes.Controller import Controller
+
+	report = loadReport("Controller.queryPoolData")
+	polyglots = []
+	controllers = []
+
+	if workDir is None:
+		workDir = tempfile.mkdtemp(prefix="phinload")
+	try:
+		for index in range(accounts):
+			authToken, deviceUUID, vesselUrl = server.getAccount(index)
+			polyglot = fakePolyglot()
+			#Every controller has its own store and snapshot, like
+			#separate installs would
+			controller = Controller(polyglot,
+				storePath=os.path.join(workDir, "phin-%d.db" % index),
+				snapshotPath=os.path.join(workDir, "phin-snapshot-%d.json" % index))
+			controller.polyConfig = {"customParams":{
+				"authtoken":authToken,
+				"uuid":deviceUUID,
+				"vesselurl":vesselUrl,
+				"vesselurls":"[%s]" % ",".join('"%s"' % url for url in server.getVesselUrls(index))}}
+			controller.updateConfig()
+			controller.phin.baseUrl = server.url
+			controller.phin.cassette = tape
+			polyglots.append(polyglot)
+			controllers.append(controller)
+
+		def poll(controller):
+			started = time.time()
+			try:
+				flight = controller.queryPoolData('load')
+				flight.wait()
+				if flight.error is not None:
+					raise flight.error
+				report.record(time.time() - started)
+			except Exception as e:
+				report.record(time.time() - started, e)
+
+		report.start()
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			for iteration in range(iterations):
+				list(executor.map(poll, controllers))
+				server.advance()
+		report.finish()
+	finally:
+		for controller in controllers:
+			controller.stop()
+
+	report.messages = sum(polyglot.messages for polyglot in polyglots)
+	return report
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Load test pyPhin against a local fake pHin API")
+	parser.add_argument("--accounts", type=int, default=50)
+	parser.add_argument("--iterations", type=int, default=3)
+	parser.add_argument("--concurrency", type=int, default=10)
+	parser.add_argument("--locations", type=int, default=1, help="locations per account")
+	parser.add_argument("--vessels", type=int, default=1, help="vessels per location")
+	parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+	parser.add_argument("--errors", type=float, default=0.0, help="probability of each injected error kind")
+	parser.add_argument("--controller", action="store_true", help="drive Controller.queryPoolData instead of pHin")
+	parser.add_argument("--record", metavar="CASSETTE", help="record the exchanges to a cassette")
+	parser.add_argument("--replay", metavar="CASSETTE", help="replay the exchanges of a cassette")
+	parser.add_argument("--timing", action="store_true", help="replay with the recorded latency")
+	args = parser.parse_args()
+
+	#polyinterface redirects sys.stdout to its log once it is imported,
+	#the report goes to the real stdout
+	out = sys.__stdout__
+
+	tape = None
+	if args.record:
+		tape = cassette(args.record, cassette.RECORD)
+	elif args.replay:
+		tape = cassette(args.replay, cassette.REPLAY, timing=args.timing)
+
+	logging.basicConfig(level=logging.CRITICAL + 1)
+
+	errors = {"unauthorized":args.errors, "server":args.errors, "nonjson":args.errors, "ratelimit":args.errors}
+	with fakeServer(latency=args.latency, errors=errors,
+		locationsPerAccount=args.locations,
+		vesselsPerLocation=args.vessels) as server:
+
+		if args.controller:
+			report = runControllerLoad(server, args.accounts, args.iterations, args.concurrency, tape)
+		else:
+			client = pHin(baseUrl=server.url, poolMaxSize=args.concurrency, maxWorkers=args.concurrency, cassette=tape)
+			report = runClientLoad(server, args.accounts, args.iterations, args.concurrency, client)
+
+		print(report.format(), file=out)
+		if report.errors:
+			print("errors: %s" % report.errors, file=out)
+		if hasattr(report, "messages"):
+			print("polyglot messages: %d" % report.messages, file=out)
+		print("server requests: %s" % server.getCounts(), file=out)
+
+	if tape is not None:
+		tape.close()
+		print("cassette %s: %d exchanges" % (tape.path, tape.count), file=out)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+pyPhinMapping - Declarative field mapping for pHin data
+
+A fieldMap is a table of source paths (dotted keys into parsed JSON,
+python dictionaries or pyPhinModels, numbers index lists), the target
+each value goes to and an optional transform. The paths are split once
+when the table is built, apply() walks every row in a single pass and
+returns the values found and the rows whose path is missing.
+
+	vesselFields = fieldMap([
+		("waterReport.TA.value", ("waterData", "ta")),
+		("disc.temperatureF", ("waterData", "temperature")),
+		("requiredActions", ("pool", "test_strip_required"), testStripRequired, []),
+	])
+	values, missing = vesselFields.apply(vessel)
+
+pHin maps vessel responses to the models with it, the node server maps
+the models to drivers (nodes/Drivers.py).
+
+"""
+
+
+'''fieldRow
+One compiled row of a fieldMap
+'''
+class fieldRow():
+
+	__slots__ = ("path", "keys", "target", "transform", "default", "required")
+
+	def __init__(self, path, target, transform=None, default=None, required=True):
+		self.path = path
+		self.keys = tuple(int(key) if key.isdigit() else key for key in path.split("."))
+		self.target = target
+		self.transform = transform
+		self.default = default
+		self.required = required
+
+
+class fieldMap():
+
+	'''init()
+	rows - (source path, target[, transform[, default[, required]]])
+
+	target - Anything identifying the field to the caller, for
+		example a (section, field) of a model or a driver id
+	transform - Called with the value, None copies the value
+	default - Used when the path is missing, None reports the row
+		as missing
+	required - False for rows that are skipped without being
+		reported when the path is missing
+	'''
+	def __init__(self, rows):
+		self.rows = tuple(fieldRow(*row) for row in rows)
+
+	'''apply()
+	Maps a source in a single pass
+
+	Returns (list of (target, value), list of missing fieldRows).
+	Rows whose transform fails on the value count as missing.
+	'''
+	def apply(self, source):
+		values = []
+		missing = []
+		for row in self.rows:
+			value = source
+			try:
+				for key in row.keys:
+					value = value[key]
+				if value is None:
+					raise KeyError(row.path)
+			except (KeyError, IndexError, TypeError):
+				if row.default is None:
+					if row.required:
+						missing.append(row)
+					continue
+				value = row.default
+
+			if row.transform is not None:
+				try:
+					value = row.transform(value)
+				except (KeyError, IndexError, TypeError, ValueError):
+					missing.append(row)
+					continue
+			values.append((row.target, value))
+		return values, missing
+
+	'''getTargets()
+	Returns the targets of all rows in table order
+	'''
+	def getTargets(self):
+		return [row.target for row in self.rows]
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+pyPhinMetrics - In-process metrics for pyPhin and the pHin node server
+
+Counters, gauges and histograms with labels, kept in memory and exported
+in the Prometheus text format, either written to a file (for the node
+exporter textfile collector) or served on a local HTTP port.
+
+	metrics = metricsRegistry()
+	metrics.inc("phin_requests_total", {"endpoint":"GET /urls"})
+	metrics.observe("phin_request_seconds", 0.12, {"endpoint":"GET /urls"})
+	metrics.writeFile("/var/lib/node_exporter/phin.prom")
+	metrics.serve(9464)
+
+"""
+
+import os
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+#Histogram buckets (seconds) used unless a metric is described with its own
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+#Help and type of the metrics recorded by pyPhin and the node server
+METRICS = {
+	"phin_requests_total":("counter", "Requests sent to the pHin API"),
+	"phin_request_seconds":("histogram", "Time until the pHin API responded"),
+	"phin_request_errors_total":("counter", "Failed requests by cause"),
+	"phin_response_bytes_total":("counter", "Bytes received from the pHin API"),
+	"phin_last_success_timestamp_seconds":("gauge", "Time of the last successful response"),
+	"phin_parse_seconds":("histogram", "Time spent parsing responses"),
+	"phin_parse_errors_total":("counter", "Fields missing from responses"),
+	"phin_vessel_last_success_timestamp_seconds":("gauge", "Time of the last complete data of a vessel"),
+	"phin_poll_seconds":("histogram", "Duration of a node server poll"),
+	"phin_poll_failures":("gauge", "Failed node server polls in a row"),
+	"phin_sink_readings_total":("counter", "Readings written by a sink"),
+	"phin_sink_dropped_total":("counter", "Readings dropped while a sink was behind"),
+	"phin_sink_errors_total":("counter", "Failed sink writes"),
+	"phin_sink_pending":("gauge", "Readings queued for a sink"),
+}
+
+
+class threadingServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class metricsRegistry():
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.descriptions = {}
+		self.values = {}
+		self.server = None
+
+		for name, (kind, help) in METRICS.items():
+			self.describe(name, kind, help)
+
+	'''describe()
+	Sets the type (counter, gauge or histogram), help text and
+	histogram buckets of a metric. Undescribed metrics are untyped.
+	'''
+	def describe(self, name, kind, help, buckets=DEFAULT_BUCKETS):
+		with self.lock:
+			self.descriptions[name] = (kind, help, tuple(sorted(buckets)))
+
+	def getKey(self, name, labels):
+		return (name, tuple(sorted((labels or {}).items())))
+
+	'''inc()
+	Adds value to a counter
+	'''
+	def inc(self, name, labels=None, value=1):
+		key = self.getKey(name, labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + value
+
+	'''set()
+	Sets a gauge
+	'''
+	def set(self, name, value, labels=None):
+		key = self.getKey(name, labels)
+		with self.lock:
+			self.values[key] = value
+
+	'''observe()
+	Adds an observation to a histogram
+	'''
+	def observe(self, name, value, labels=None):
+		key = self.getKey(name, labels)
+		with self.lock:
+			histogram = self.values.get(key)
+			if histogram is None:
+				buckets = self.descriptions.get(name, (None, None, DEFAULT_BUCKETS))[2]
+				histogram = {"buckets":buckets,"counts":[0] * len(buckets),"sum":0.0,"count":0}
+				self.values[key] = histogram
+			for index, bound in enumerate(histogram["buckets"]):
+				if value <= bound:
+					histogram["counts"][index] += 1
+			histogram["sum"] += value
+			histogram["count"] += 1
+
+	'''get()
+	Returns the value of a counter or gauge, or a histogram as a
+	python dictionary object {"buckets", "counts", "sum", "count"}
+	'''
+	def get(self, name, labels=None, default=None):
+		with self.lock:
+			value = self.values.get(self.getKey(name, labels), default)
+			if isinstance(value, dict):
+				value = dict(value, counts=list(value["counts"]))
+			return value
+
+	'''render()
+	Returns all metrics in the Prometheus text format
+	'''
+	def render(self):
+		with self.lock:
+			names = {}
+			for (name, labels), value in self.values.items():
+				names.setdefault(name, []).append((labels, value))
+
+			lines = []
+			for name in sorted(names):
+				description = self.descriptions.get(name)
+				if description is not None:
+					lines.append("# HELP %s %s" % (name, description[1]))
+					lines.append("# TYPE %s %s" % (name, description[0]))
+				for labels, value in sorted(names[name], key=lambda series: series[0]):
+					if isinstance(value, dict):
+						for bound, count in zip(value["buckets"], value["counts"]):
+							lines.append("%s_bucket%s %d" % (name, self.formatLabels(labels + (("le", self.formatValue(bound)),)), count))
+						lines.append("%s_bucket%s %d" % (name, self.formatLabels(labels + (("le", "+Inf"),)), value["count"]))
+						lines.append("%s_sum%s %s" % (name, self.formatLabels(labels), self.formatValue(value["sum"])))
+						lines.append("%s_count%s %d" % (name, self.formatLabels(labels), value["count"]))
+					else:
+						lines.append("%s%s %s" % (name, self.formatLabels(labels), self.formatValue(value)))
+		return "\n".join(lines) + "\n"
+
+	def formatLabels(self, labels):
+		if len(labels) == 0:
+			return ""
+		return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+			for key, value in labels)
+
+	def formatValue(self, value):
+		if isinstance(value, bool):
+			return "1" if value else "0"
+		if isinstance(value, int):
+			return str(value)
+		if math.isinf(value):
+			return "+Inf" if value > 0 else "-Inf"
+		return repr(float(value))
+
+	'''writeFile()
+	Writes the metrics to a file, replaced atomically so readers
+	never see a partial file
+	'''
+	def writeFile(self, path):
+		tempPath = "%s.%d.tmp" % (path, os.getpid())
+		with open(tempPath, "w") as metricsFile:
+			metricsFile.write(self.render())
+		os.replace(tempPath, path)
+
+	'''serve()
+	Serves the metrics on http://host:port/metrics from a
+	background thread
+	'''
+	def serve(self, port, host="127.0.0.1"):
+		if self.server is not None:
+			return self.server
+		registry = self
+
+		class handler(BaseHTTPRequestHandler):
+
+			def do_GET(self):
+				if self.path.split("?")[0] not in ("/", "/metrics"):
+					self.send_response(404)
+					self.end_headers()
+					return
+				data = registry.render().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = threadingServer((host, port), handler)
+		thread = threading.Thread(target=self.server.serve_forever, name="pHinMetrics")
+		thread.daemon = True
+		thread.start()
+		return self.server
+
+	def close(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+pyPhinModels - Compact typed models for pHin data
+
+Parsed responses are kept in __slots__ objects instead of nested
+dictionaries. Fields are named like the keys of the dictionaries pHin
+always returned and every model can be read like one of those
+dictionaries (data["waterData"]["ph"]["value"], "ph" in waterData),
+asDict() returns the plain dictionary.
+
+Unset fields (None) are treated as missing keys. Models are shared
+between polls (for example a cached chart), do not modify them.
+
+"""
+
+
+class pHinModel():
+
+	__slots__ = ()
+
+	def __init__(self, **fields):
+		for name in self.__slots__:
+			setattr(self, name, fields.get(name))
+
+	def __getitem__(self, key):
+		if key not in self.__slots__:
+			raise KeyError(key)
+		value = getattr(self, key)
+		if value is None:
+			raise KeyError(key)
+		return value
+
+	def __setitem__(self, key, value):
+		if key not in self.__slots__:
+			raise KeyError(key)
+		setattr(self, key, value)
+
+	def __contains__(self, key):
+		return key in self.__slots__ and getattr(self, key) is not None
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def __eq__(self, other):
+		if isinstance(other, pHinModel):
+			other = other.asDict()
+		return self.asDict() == other
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __repr__(self):
+		return repr(self.asDict())
+
+	def keys(self):
+		return [name for name in self.__slots__ if getattr(self, name) is not None]
+
+	def get(self, key, default=None):
+		if key in self:
+			return getattr(self, key)
+		return default
+
+	def items(self):
+		return [(name, getattr(self, name)) for name in self.keys()]
+
+	'''merge()
+	Returns a new model with the set fields of other
+	overriding the fields of this model
+	'''
+	def merge(self, other):
+		merged = self.__class__()
+		for name in self.__slots__:
+			value = getattr(other, name) if other is not None else None
+			if value is None:
+				value = getattr(self, name)
+			elif isinstance(value, pHinModel) and getattr(self, name) is not None:
+				value = getattr(self, name).merge(value)
+			setattr(merged, name, value)
+		return merged
+
+	'''asDict()
+	Returns the model as plain python dictionaries
+	'''
+	def asDict(self):
+		data = {}
+		for name in self.keys():
+			value = getattr(self, name)
+			if isinstance(value, pHinModel):
+				value = value.asDict()
+			data[name] = value
+		return data
+
+
+'''Reading
+A classified reading, value and status (ph, orp, rssi) or
+value and percentage (battery), ph and orp with their trend
+'''
+class Reading(pHinModel):
+	__slots__ = ("value", "status", "percentage", "trend")
+
+
+'''Trend
+Drift per day, hours until the ok range is left (None if the
+trend stays in it), std of the points around the trend and the
+number of points seen
+'''
+class Trend(pHinModel):
+	__slots__ = ("drift", "hoursToLimit", "std", "count")
+
+
+class WaterData(pHinModel):
+	__slots__ = ("ta", "cya", "th", "temperature", "ph", "orp")
+
+
+class VesselData(pHinModel):
+	__slots__ = ("battery", "rssi")
+
+
+class PoolStatus(pHinModel):
+	__slots__ = ("status_title", "status_id", "test_strip_required")
+
+
+'''PoolData
+Everything known about one vessel, the result of pHin.getData()
+
+vessel holds the vessel info added by pHin.getVesselsData()
+'''
+class PoolData(pHinModel):
+	__slots__ = ("pool", "waterData", "vesselData", "vessel")
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+pyPhinReadings - Normalized pHin readings
+
+normalize() flattens one vessel of a pHin.getVesselsData() result into a
+reading with a fixed set of columns, missing values are None.
+rotatingFile is the file the readings are appended to, renamed once it
+reached a size. Shared by the exporter (pyPhinExport) and the sinks
+(pyPhinSinks).
+
+	reading = normalize(vessels[0], "pool", time.time())
+	output = rotatingFile("phin.jsonl", maxBytes=10000000)
+	output.write(json.dumps(reading) + "\\n")
+
+"""
+
+import os
+
+from pyPhinMapping import fieldMap
+
+
+'''readingFields
+Columns of a normalized reading and where they come from in a
+pHin.getVesselsData() result, missing values are exported empty
+'''
+readingFields = fieldMap([(path, column, transform, None, False) for column, path, transform in (
+	("vessel", "vessel.id", None),
+	("name", "vessel.name", None),
+	("vesselUrl", "vessel.vesselUrl", None),
+	("temperature", "waterData.temperature", None),
+	("ph", "waterData.ph.value", None),
+	("phStatus", "waterData.ph.status", None),
+	("phDrift", "waterData.ph.trend.drift", None),
+	("orp", "waterData.orp.value", None),
+	("orpStatus", "waterData.orp.status", None),
+	("orpDrift", "waterData.orp.trend.drift", None),
+	("ta", "waterData.ta", None),
+	("cya", "waterData.cya", None),
+	("th", "waterData.th", None),
+	("battery", "vesselData.battery.percentage", None),
+	("rssi", "vesselData.rssi.value", None),
+	("statusId", "pool.status_id", None),
+	("statusTitle", "pool.status_title", None),
+	("testStripRequired", "pool.test_strip_required", bool),
+	)])
+
+columns = ["time", "account"] + readingFields.getTargets()
+
+
+'''normalize()
+Returns one vessel of a pHin.getVesselsData() result as a flat
+python dictionary object with all columns
+'''
+def normalize(data, account, now):
+	reading = dict.fromkeys(columns)
+	reading["time"] = int(now)
+	reading["account"] = account
+	values, missing = readingFields.apply(data)
+	reading.update(values)
+	return reading
+
+
+'''rotatingFile
+A file that is renamed to path.1 (path.2, ...) once it reached
+maxBytes, at most backups old files are kept. A new file is
+started with the header.
+'''
+class rotatingFile():
+
+	def __init__(self, path, maxBytes=0, backups=5, header=None):
+		self.path = path
+		self.maxBytes = maxBytes
+		self.backups = backups
+		self.header = header
+		self.file = None
+		self.open()
+
+	def open(self):
+		self.file = open(self.path, "a", encoding="utf-8", newline="")
+		if self.header is not None and self.file.tell() == 0:
+			self.file.write(self.header)
+
+	def write(self, text):
+		if self.maxBytes > 0 and self.file.tell() > 0 and self.file.tell() + len(text) > self.maxBytes:
+			self.rotate()
+		self.file.write(text)
+		self.file.flush()
+
+	def rotate(self):
+		self.file.close()
+		for index in range(self.backups - 1, 0, -1):
+			if os.path.exists("%s.%d" % (self.path, index)):
+				os.replace("%s.%d" % (self.path, index), "%s.%d" % (self.path, index + 1))
+		if self.backups > 0:
+			os.replace(self.path, "%s.1" % self.path)
+		else:
+			os.remove(self.path)
+		self.open()
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+pyPhinSinks - Batched export of pHin readings
+
+A sink writes lists of normalized readings (see pyPhinReadings.normalize)
+somewhere, influxFileSink as Influx line protocol to a rotating file,
+mqttSink as JSON to an MQTT broker. batchingSink puts any sink behind a
+bounded in-memory queue and a background flusher thread that writes a
+batch once batchSize readings are queued or flushInterval seconds have
+passed. put() never blocks: once the queue is full the oldest readings
+are dropped, so a slow or unreachable sink can not hold up the poll
+that produced the readings. A failing sink is retried with a growing
+delay while the queue keeps absorbing (and dropping) readings.
+
+	sink = batchingSink(influxFileSink("phin.influx"), maxQueue=10000)
+	sink.put(readings(client.getVesselsData(authToken, deviceUUID, vesselUrls), "pool"))
+	sink.close()
+
+mqttSink needs paho-mqtt (pip install paho-mqtt), which is not
+installed by default.
+
+"""
+
+import abc
+import time
+import json
+import logging
+import threading
+from collections import deque
+
+from pyPhinReadings import normalize, rotatingFile
+
+try:
+	import paho.mqtt.client as mqtt
+except ImportError:
+	mqtt = None
+
+
+'''readings()
+Returns the normalized readings of a pHin.getVesselsData() result
+'''
+def readings(vessels, account, now=None):
+	if now is None:
+		now = time.time()
+	return [normalize(data, account, now) for data in vessels]
+
+
+class sink(abc.ABC):
+
+	name = "sink"
+
+	'''write()
+	Writes a batch of readings, raises if the batch was not written
+	'''
+	@abc.abstractmethod
+	def write(self, batch):
+		pass
+
+	def close(self):
+		pass
+
+
+class influxFileSink(sink):
+
+	name = "influx"
+
+	#Readings that are tags, the others are fields
+	tags = ("account", "vessel", "name")
+	#Fields written as integers
+	integers = ("phStatus", "orpStatus", "statusId")
+
+	'''init()
+	path - File the line protocol is appended to, for example
+		read by the Telegraf tail or file input
+	measurement - Measurement of every line
+	maxBytes - Rotate the file at this size, 0 never rotates
+	backups - Rotated files kept
+	'''
+	def __init__(self, path, measurement="phin", maxBytes=0, backups=5):
+		self.measurement = self.escape(measurement, ", ")
+		self.file = rotatingFile(path, maxBytes, backups)
+
+	def write(self, batch):
+		self.file.write("".join(self.formatLine(reading) for reading in batch))
+
+	def close(self):
+		self.file.close()
+
+	'''formatLine()
+	Returns a reading as one line of line protocol, time in
+	nanoseconds (the default precision of Influx and Telegraf)
+	'''
+	def formatLine(self, reading):
+		tags = "".join(",%s=%s" % (tag, self.escape(str(reading[tag]), ",= "))
+			for tag in self.tags if reading.get(tag) not in (None, ""))
+		fields = ",".join("%s=%s" % (field, self.formatField(field, value))
+			for field, value in reading.items()
+			if field not in self.tags and field != "time" and value is not None)
+		return "%s%s %s %d\n" % (self.measurement, tags, fields, int(reading["time"] * 1e9))
+
+	def formatField(self, field, value):
+		if isinstance(value, bool):
+			return "true" if value else "false"
+		if isinstance(value, (int, float)):
+			if field in self.integers:
+				return "%di" % int(value)
+			return repr(float(value))
+		return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+	def escape(self, text, characters):
+		text = text.replace("\\", "\\\\")
+		for character in characters:
+			text = text.replace(character, "\\" + character)
+		return text
+
+
+class mqttSink(sink):
+
+	name = "mqtt"
+
+	'''init()
+	host, port - MQTT broker, usually the local one
+	topic - Every reading is published as JSON to topic/vessel id
+	qos - QoS of the messages, with 1 or 2 write() waits until the
+		broker acknowledged the batch
+	retain - Keep the last reading of every vessel on the broker
+	'''
+	def __init__(self, host="localhost", port=1883, topic="phin", qos=0, retain=False,
+		clientId=None, username=None, password=None, timeout=10):
+		if mqtt is None:
+			raise Exception("paho-mqtt is required for mqttSink!")
+
+		self.topic = topic.rstrip("/")
+		self.qos = qos
+		self.retain = retain
+		self.timeout = timeout
+
+		try:
+			self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=clientId or "")
+		except AttributeError:
+			#paho-mqtt 1.x
+			self.client = mqtt.Client(client_id=clientId or "")
+		if username:
+			self.client.username_pw_set(username, password)
+		self.client.connect_async(host, port)
+		self.client.loop_start()
+
+	def write(self, batch):
+		if not self.client.is_connected():
+			raise Exception("Not connected to the MQTT broker!")
+
+		messages = []
+		for reading in batch:
+			topic = "%s/%s" % (self.topic, reading.get("vessel") or "unknown")
+			message = self.client.publish(topic, json.dumps(reading, separators=(",", ":")),
+				qos=self.qos, retain=self.retain)
+			if message.rc != mqtt.MQTT_ERR_SUCCESS:
+				raise Exception("Not able to publish to %s: rc=%s" % (topic, message.rc))
+			messages.append(message)
+
+		if self.qos > 0:
+			deadline = time.time() + self.timeout
+			for message in messages:
+				message.wait_for_publish(max(0, deadline - time.time()))
+				if not message.is_published():
+					raise Exception("MQTT broker did not acknowledge the batch!")
+
+	def close(self):
+		self.client.disconnect()
+		self.client.loop_stop()
+
+
+class batchingSink():
+
+	'''init()
+	sink - The sink batches are written to
+	maxQueue - Readings kept while the sink is behind, the oldest
+		are dropped beyond that
+	batchSize - Readings written with one write()
+	flushInterval - Seconds a reading waits at most for a batch to
+		fill up
+	retryDelay - Seconds before a failed batch is written again,
+		doubled on every failure up to maxRetryDelay
+	metrics - pyPhinMetrics registry the queue is reported to
+	logger - Used to pass in a logger for module to use
+	'''
+	def __init__(self, sink, maxQueue=10000, batchSize=500, flushInterval=5.0,
+		retryDelay=1.0, maxRetryDelay=60.0, metrics=None, logger=None):
+		if logger != None:
+			self.logger = logger
+		else:
+			self.logger = logging.getLogger("nullLogger")
+			self.logger.addHandler(logging.NullHandler())
+
+		self.sink = sink
+		self.name = sink.name
+		self.batchSize = max(1, batchSize)
+		self.flushInterval = flushInterval
+		self.retryDelay = retryDelay
+		self.maxRetryDelay = maxRetryDelay
+		self.metrics = metrics
+
+		self.condition = threading.Condition()
+		self.queue = deque(maxlen=max(1, maxQueue))
+		self.batch = None
+		self.oldest = None
+		self.flushing = False
+		self.closing = False
+		self.stats = {"queued":0, "written":0, "dropped":0, "failed":0}
+
+		self.thread = threading.Thread(target=self.run, name="phin-sink-%s" % self.name, daemon=True)
+		self.thread.start()
+
+	'''put()
+	Queues readings without blocking
+
+	Returns the number of old readings dropped to make room
+	'''
+	def put(self, readings):
+		with self.condition:
+			if self.closing:
+				return 0
+			dropped = max(0, len(self.queue) + len(readings) - self.queue.maxlen)
+			if not self.queue and readings:
+				#Starts the flush interval of the flusher
+				self.oldest = time.time()
+				self.condition.notify_all()
+			self.queue.extend(readings)
+			self.stats["queued"] += len(readings)
+			self.stats["dropped"] += dropped
+			if len(self.queue) >= self.batchSize:
+				self.condition.notify_all()
+
+		if dropped > 0:
+			self.logger.warning("Sink %s is behind, dropped %d readings", self.name, dropped)
+		self.recordMetrics(dropped=dropped)
+		return dropped
+
+	'''flush()
+	Writes everything queued right away and waits until it was
+	written, at most timeout seconds
+
+	Returns True if the queue is empty
+	'''
+	def flush(self, timeout=None):
+		deadline = None if timeout is None else time.time() + timeout
+		with self.condition:
+			self.flushing = True
+			self.condition.notify_all()
+			while (self.queue or self.batch) and self.thread.is_alive():
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					break
+				self.condition.wait(remaining)
+			self.flushing = False
+			return not self.queue and not self.batch
+
+	'''close()
+	Flushes for at most timeout seconds, stops the flusher and
+	closes the sink. Readings still queued then are dropped.
+	'''
+	def close(self, timeout=10):
+		self.flush(timeout)
+		with self.condition:
+			self.closing = True
+			self.condition.notify_all()
+		self.thread.join(timeout)
+		try:
+			self.sink.close()
+		except Exception as e:
+			self.logger.error("Not able to close sink %s: Exception=%s", self.name, e)
+
+	def getStats(self):
+		with self.condition:
+			stats = dict(self.stats)
+			stats["pending"] = len(self.queue) + len(self.batch or ())
+			return stats
+
+	'''run()
+	Flusher thread, takes a batch once it is full, the oldest reading
+	waited flushInterval or a flush was asked for, and writes it
+	outside the lock
+	'''
+	def run(self):
+		delay = self.retryDelay
+		while True:
+			with self.condition:
+				while not self.closing:
+					if self.batch is None and self.queue and (len(self.queue) >= self.batchSize or self.flushing
+						or time.time() - self.oldest >= self.flushInterval):
+						count = min(self.batchSize, len(self.queue))
+						self.batch = [self.queue.popleft() for index in range(count)]
+						#What is left waited at most as long as the batch
+						self.oldest = self.oldest if self.queue else None
+					if self.batch is not None:
+						break
+					self.condition.wait(None if self.oldest is None
+						else max(0.01, self.oldest + self.flushInterval - time.time()))
+				if self.closing:
+					return
+				batch = self.batch
+
+			try:
+				self.sink.write(batch)
+			except Exception as e:
+				with self.condition:
+					self.stats["failed"] += 1
+				self.logger.error("Not able to write %d readings to sink %s: Exception=%s", len(batch), self.name, e)
+				self.recordMetrics(error=True)
+				#The batch is kept and written again after the delay,
+				#new readings keep queueing (and dropping) meanwhile
+				with self.condition:
+					self.condition.wait_for(lambda: self.closing, delay)
+				delay = min(delay * 2, self.maxRetryDelay)
+				continue
+
+			delay = self.retryDelay
+			with self.condition:
+				self.batch = None
+				self.stats["written"] += len(batch)
+				self.condition.notify_all()
+			self.recordMetrics(written=len(batch))
+
+	def recordMetrics(self, written=0, dropped=0, error=False):
+		if self.metrics is None:
+			return
+		labels = {"sink":self.name}
+		if written:
+			self.metrics.inc("phin_sink_readings_total", labels, written)
+		if dropped:
+			self.metrics.inc("phin_sink_dropped_total", labels, dropped)
+		if error:
+			self.metrics.inc("phin_sink_errors_total", labels)
+		self.metrics.set("phin_sink_pending", self.getStats()["pending"], labels)
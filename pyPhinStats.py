@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""
+pyPhinStats - Rolling statistics for pHin chart series
+
+Moving averages, EWMA, rolling median/min/max, trend slope and outlier
+rejected means over chart arrays. Uses NumPy when it is installed and
+falls back to pure Python otherwise.
+
+welford and onlineTrend are streaming estimators, they are updated with
+one point at a time in O(1) and never look at earlier points again.
+
+Missing points (None) are ignored.
+
+"""
+
+import math
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+'''clean()
+Returns the values without missing points as a list of floats
+'''
+def clean(values):
+	return [float(value) for value in values if value is not None]
+
+
+'''tail()
+The last count values without missing points as a list of floats,
+only the end of the values is looked at
+'''
+def tail(values, count):
+	row = []
+	index = len(values) - 1
+	while index >= 0 and len(row) < count:
+		if values[index] is not None:
+			row.append(float(values[index]))
+		index -= 1
+	row.reverse()
+	return row
+
+
+'''mean()
+Average of the last window values, or of all values if there are
+fewer. Raises ValueError if there are no values.
+'''
+def mean(values, window=None):
+	values = clean(values)
+	if window is not None:
+		values = values[-window:]
+	if len(values) == 0:
+		raise ValueError("No values to average!")
+	return math.fsum(values) / len(values)
+
+
+'''sma()
+Simple moving average, one value per full window
+'''
+def sma(values, window):
+	values = clean(values)
+	if window <= 0 or len(values) < window:
+		return []
+	if numpy is not None:
+		sums = numpy.cumsum(numpy.insert(numpy.asarray(values), 0, 0.0))
+		return ((sums[window:] - sums[:-window]) / window).tolist()
+
+	result = []
+	total = math.fsum(values[:window])
+	result.append(total / window)
+	for index in range(window, len(values)):
+		total += values[index] - values[index - window]
+		result.append(total / window)
+	return result
+
+
+'''ewma()
+Exponentially weighted moving average, one value per point
+
+alpha - Weight of the newest point, 0 < alpha <= 1
+'''
+def ewma(values, alpha):
+	values = clean(values)
+	result = []
+	average = None
+	for value in values:
+		if average is None:
+			average = value
+		else:
+			average = alpha * value + (1 - alpha) * average
+		result.append(average)
+	return result
+
+
+'''ewmaLast()
+Latest EWMA value of the values, weighted so the first value
+does not dominate short series
+'''
+def ewmaLast(values, alpha):
+	values = clean(values)
+	if len(values) == 0:
+		raise ValueError("No values to average!")
+	count = len(values)
+	if numpy is not None:
+		weights = (1 - alpha) ** numpy.arange(count - 1, -1, -1, dtype=float)
+		return float(numpy.dot(weights, numpy.asarray(values)) / weights.sum())
+
+	weights = [(1 - alpha) ** (count - 1 - index) for index in range(count)]
+	return math.fsum(w * v for w, v in zip(weights, values)) / math.fsum(weights)
+
+
+def rollingWindows(values, window):
+	values = clean(values)
+	if window <= 0 or len(values) < window:
+		return None
+	if numpy is not None:
+		array = numpy.asarray(values)
+		shape = (len(values) - window + 1, window)
+		strides = (array.strides[0], array.strides[0])
+		return numpy.lib.stride_tricks.as_strided(array, shape=shape, strides=strides, writeable=False)
+	return [values[index:index + window] for index in range(len(values) - window + 1)]
+
+
+'''rollingMedian()
+Median of each full window
+'''
+def rollingMedian(values, window):
+	windows = rollingWindows(values, window)
+	if windows is None:
+		return []
+	if numpy is not None:
+		return numpy.median(windows, axis=1).tolist()
+	return [median(points) for points in windows]
+
+
+'''rollingMin()
+Minimum of each full window
+'''
+def rollingMin(values, window):
+	windows = rollingWindows(values, window)
+	if windows is None:
+		return []
+	if numpy is not None:
+		return windows.min(axis=1).tolist()
+	return [min(points) for points in windows]
+
+
+'''rollingMax()
+Maximum of each full window
+'''
+def rollingMax(values, window):
+	windows = rollingWindows(values, window)
+	if windows is None:
+		return []
+	if numpy is not None:
+		return windows.max(axis=1).tolist()
+	return [max(points) for points in windows]
+
+
+'''median()
+Median of the values
+'''
+def median(values):
+	values = sorted(clean(values))
+	count = len(values)
+	if count == 0:
+		raise ValueError("No values for median!")
+	middle = count // 2
+	if count % 2 == 1:
+		return values[middle]
+	return (values[middle - 1] + values[middle]) / 2.0
+
+
+'''slope()
+Least squares slope of the values per point, or per unit of x
+if x values are given. Returns 0 for fewer than 2 points.
+'''
+def slope(values, x=None):
+	if x is None:
+		values = clean(values)
+		x = range(len(values))
+	else:
+		pairs = [(float(xv), float(v)) for xv, v in zip(x, values) if v is not None]
+		x = [pair[0] for pair in pairs]
+		values = [pair[1] for pair in pairs]
+
+	count = len(values)
+	if count < 2:
+		return 0.0
+
+	if numpy is not None:
+		xs = numpy.asarray(x, dtype=float)
+		ys = numpy.asarray(values)
+		xs = xs - xs.mean()
+		denominator = numpy.dot(xs, xs)
+		if denominator == 0:
+			return 0.0
+		return float(numpy.dot(xs, ys - ys.mean()) / denominator)
+
+	xMean = math.fsum(x) / count
+	yMean = math.fsum(values) / count
+	denominator = math.fsum((xv - xMean) ** 2 for xv in x)
+	if denominator == 0:
+		return 0.0
+	return math.fsum((xv - xMean) * (v - yMean) for xv, v in zip(x, values)) / denominator
+
+
+'''robustMean()
+Mean of the values after rejecting outliers, points further than
+threshold scaled median absolute deviations from the median are
+dropped
+'''
+def robustMean(values, threshold=3.5):
+	values = clean(values)
+	if len(values) == 0:
+		raise ValueError("No values to average!")
+	center = median(values)
+	deviation = median([abs(value - center) for value in values])
+	if deviation == 0:
+		kept = [value for value in values if value == center]
+	else:
+		scale = 1.4826 * deviation
+		kept = [value for value in values if abs(value - center) / scale <= threshold]
+	return math.fsum(kept) / len(kept)
+
+
+'''lastWindows()
+Returns the last window points of every series, series that are
+not lists of numbers are returned as empty
+'''
+def lastWindows(seriesList, windows):
+	rows = []
+	for values, window in zip(seriesList, windows):
+		try:
+			rows.append(tail(values, window) if window > 0 else [])
+		except (TypeError, ValueError):
+			rows.append([])
+	return rows
+
+
+'''padded()
+The rows as one NumPy array, short rows padded with NaN
+'''
+def padded(rows):
+	width = max([len(row) for row in rows] + [1])
+	array = numpy.full((len(rows), width), numpy.nan)
+	for index, row in enumerate(rows):
+		array[index, :len(row)] = row
+	return array
+
+
+'''windowMeans()
+Average of the last window points of many series at once, one
+window per series. With NumPy all series are averaged in a single
+vectorized pass. Series without points are returned as None.
+'''
+def windowMeans(seriesList, windows):
+	rows = lastWindows(seriesList, windows)
+	if numpy is not None and any(rows):
+		counts = numpy.array([max(len(row), 1) for row in rows])
+		means = numpy.nansum(padded(rows), axis=1) / counts
+		return [float(means[index]) if len(row) > 0 else None for index, row in enumerate(rows)]
+	return [math.fsum(row) / len(row) if len(row) > 0 else None for row in rows]
+
+
+'''summarize()
+Statistics of the last window points of a series
+
+Returns a python dictionary object:
+{
+	"count": <points used>,
+	"mean": <simple average>,
+	"ewma": <exponentially weighted average>,
+	"median": <median>,
+	"min": <minimum>,
+	"max": <maximum>,
+	"slope": <change per point>,
+	"robustMean": <outlier rejected average>
+}
+Raises ValueError if the series has no points.
+'''
+def summarize(values, window, alpha=0.5, threshold=3.5):
+	values = clean(values)[-window:]
+	count = len(values)
+	if count == 0:
+		raise ValueError("No values to summarize!")
+
+	if numpy is not None:
+		array = numpy.asarray(values)
+		center = float(numpy.median(array))
+		summary = {"count":count,
+			"mean":float(array.mean()),
+			"median":center,
+			"min":float(array.min()),
+			"max":float(array.max())}
+	else:
+		center = median(values)
+		summary = {"count":count,
+			"mean":math.fsum(values) / count,
+			"median":center,
+			"min":min(values),
+			"max":max(values)}
+
+	summary["ewma"] = ewmaLast(values, alpha)
+	summary["slope"] = slope(values)
+	summary["robustMean"] = robustMean(values, threshold)
+	return summary
+
+
+'''summarizeMany()
+summarize() for many series, for example the same metric of all
+vessels. With NumPy the count, mean, median, min and max of all
+series are computed in a single vectorized pass. Series without
+points are returned as None.
+'''
+def summarizeMany(seriesList, window, alpha=0.5, threshold=3.5):
+	rows = lastWindows(seriesList, [window] * len(seriesList))
+	if numpy is None or not any(rows):
+		summaries = []
+		for row in rows:
+			summaries.append(summarize(row, window, alpha, threshold) if len(row) > 0 else None)
+		return summaries
+
+	#Only series with points, NumPy warns about rows that are all NaN
+	filled = [row for row in rows if len(row) > 0]
+	array = padded(filled)
+	means = numpy.nanmean(array, axis=1)
+	medians = numpy.nanmedian(array, axis=1)
+	minimums = numpy.nanmin(array, axis=1)
+	maximums = numpy.nanmax(array, axis=1)
+
+	summaries = []
+	index = -1
+	for row in rows:
+		if len(row) == 0:
+			summaries.append(None)
+			continue
+		index += 1
+		summaries.append({"count":len(row),
+			"mean":float(means[index]),
+			"median":float(medians[index]),
+			"min":float(minimums[index]),
+			"max":float(maximums[index]),
+			"ewma":ewmaLast(row, alpha),
+			"slope":slope(row),
+			"robustMean":robustMean(row, threshold)})
+	return summaries
+
+
+'''welford
+Running count, mean and variance of a stream of values, updated in
+O(1) per value with Welford's algorithm
+'''
+class welford():
+
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+
+	def update(self, value):
+		if value is None:
+			return
+		value = float(value)
+		self.count += 1
+		delta = value - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (value - self.mean)
+
+	'''variance()
+	Sample variance, 0 for fewer than 2 values
+	'''
+	def variance(self):
+		if self.count < 2:
+			return 0.0
+		return self.m2 / (self.count - 1)
+
+	def std(self):
+		return math.sqrt(self.variance())
+
+
+'''onlineTrend
+Linear trend of a stream of (epoch seconds, value) points, updated in
+O(1) per point. The least squares sums are exponentially weighted, a
+point counts half after halfLife seconds, so the slope follows the
+recent drift instead of the whole history. The sums are kept relative
+to the newest point so they stay precise however long it runs.
+
+halfLife - Seconds after which a point has half its weight
+'''
+class onlineTrend():
+
+	def __init__(self, halfLife=86400):
+		self.halfLife = float(halfLife)
+		self.count = 0
+		self.last = None
+		self.w = 0.0
+		self.wx = 0.0
+		self.wy = 0.0
+		self.wxx = 0.0
+		self.wxy = 0.0
+		self.residuals = welford()
+
+	'''update()
+	Adds a point, points not newer than the last one and missing
+	values are ignored. Returns True if the point was used.
+	'''
+	def update(self, ts, value):
+		if value is None:
+			return False
+		value = float(value)
+
+		if self.last is not None:
+			if ts <= self.last:
+				return False
+			if self.count >= 2:
+				self.residuals.update(value - self.predict(ts))
+
+			#Move x = 0 to the new point (x in hours), then fade out
+			shift = (ts - self.last) / 3600.0
+			self.wxx += shift * (shift * self.w - 2 * self.wx)
+			self.wxy -= shift * self.wy
+			self.wx -= shift * self.w
+			decay = 0.5 ** ((ts - self.last) / self.halfLife)
+			self.w *= decay
+			self.wx *= decay
+			self.wy *= decay
+			self.wxx *= decay
+			self.wxy *= decay
+
+		self.w += 1.0
+		self.wy += value
+		self.last = ts
+		self.count += 1
+		return True
+
+	'''slope()
+	Change per hour, 0 for fewer than 2 points
+	'''
+	def slope(self):
+		denominator = self.w * self.wxx - self.wx * self.wx
+		if self.count < 2 or denominator <= 1e-12:
+			return 0.0
+		return (self.w * self.wxy - self.wx * self.wy) / denominator
+
+	'''predict()
+	Value of the trend line at ts, None without points
+	'''
+	def predict(self, ts=None):
+		if self.count == 0:
+			return None
+		slope = self.slope()
+		level = (self.wy - slope * self.wx) / self.w
+		if ts is None:
+			return level
+		return level + slope * (ts - self.last) / 3600.0
+
+	'''std()
+	Standard deviation of the points around the trend line
+	'''
+	def std(self):
+		return self.residuals.std()
+
+	'''timeToThreshold()
+	Hours from the newest point until the trend line leaves the range
+	low to high (either may be None), 0 if it is already outside. None
+	if the trend does not leave the range.
+	'''
+	def timeToThreshold(self, low=None, high=None):
+		level = self.predict()
+		if level is None:
+			return None
+		if (low is not None and level < low) or (high is not None and level > high):
+			return 0.0
+		slope = self.slope()
+		if slope > 0 and high is not None:
+			return (high - level) / slope
+		if slope < 0 and low is not None:
+			return (level - low) / -slope
+		return None
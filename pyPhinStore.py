@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+pyPhinStore - Local time-series store for pHin chart data
+
+Keeps the ph, orpMv, batteryMv and rssi series of every chart route in a
+SQLite database. Each chart response is merged in, only points that are
+not stored yet are added, so history survives restarts and does not have
+to be downloaded again.
+
+Hourly, daily and weekly rollups (count, sum, min, max per metric) are
+updated with every merge, so long range queries read a few buckets
+instead of scanning the raw points. The backfill checkpoints of
+pyPhinBackfill are kept in the same database.
+
+"""
+
+import sqlite3
+import threading
+import time
+import datetime
+import logging
+
+
+class pHinStore():
+
+	#Chart series stored per point, in column order
+	columns = (("ph","ph"), ("orpMv","orp"), ("batteryMv","battery"), ("rssi","rssi"))
+
+	#Keys that may hold the timestamps of the chart points
+	timestampKeys = ("timestamps", "dates", "times")
+
+	#Rollup resolutions, bucket size in seconds. Weeks start on Monday
+	#00:00 UTC, 1970-01-05 was a Monday.
+	resolutions = {"hour":(3600, 0), "day":(86400, 0), "week":(604800, 345600)}
+
+	'''init()
+	Opens (and creates) the store
+
+	path - SQLite database file, ":memory:" for a temporary store
+	logger - Used to pass in a logger for module to use
+	pointInterval - Seconds between chart points, used to date
+		points of charts without timestamps
+	'''
+	def __init__(self, path, logger=None, pointInterval=3600):
+		if logger != None:
+			self.logger = logger
+		else:
+			self.logger = logging.getLogger("nullLogger")
+			self.logger.addHandler(logging.NullHandler())
+
+		self.pointInterval = pointInterval
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.createTables()
+
+	def createTables(self):
+		with self.lock, self.db:
+			self.db.execute(
+				"CREATE TABLE IF NOT EXISTS points ("
+				"series TEXT NOT NULL, ts INTEGER NOT NULL, "
+				"ph REAL, orp REAL, battery REAL, rssi REAL, "
+				"PRIMARY KEY (series, ts)) WITHOUT ROWID")
+			self.db.execute(
+				"CREATE TABLE IF NOT EXISTS rollups ("
+				"series TEXT NOT NULL, resolution TEXT NOT NULL, bucket INTEGER NOT NULL, "
+				"metric TEXT NOT NULL, count INTEGER NOT NULL, sum REAL NOT NULL, "
+				"min REAL NOT NULL, max REAL NOT NULL, "
+				"PRIMARY KEY (series, resolution, metric, bucket)) WITHOUT ROWID")
+			self.db.execute(
+				"CREATE TABLE IF NOT EXISTS checkpoints ("
+				"route TEXT NOT NULL PRIMARY KEY, vessel TEXT, chart TEXT, "
+				"etag TEXT, lastModified TEXT, fetched INTEGER, points INTEGER)")
+
+			#Stores created before rollups existed
+			rollups = self.db.execute("SELECT 1 FROM rollups LIMIT 1").fetchone()
+			points = self.db.execute("SELECT 1 FROM points LIMIT 1").fetchone()
+			if rollups is None and points is not None:
+				self.rebuildRollups()
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+	'''merge()
+	Merges a chart response into the store
+
+	seriesKey - Key of the series, usually the chart route
+	reqJson - Parsed chart response
+	now - Time of the response, used for charts without timestamps
+	interval - Seconds between the points of a chart without
+		timestamps, None for pointInterval
+
+	Charts with timestamps are deduplicated by timestamp. Otherwise
+	the chart is aligned with the stored tail by position and only
+	points after the overlap are added, dated interval apart ending
+	at now.
+
+	Returns the list of added points (ts, ph, orp, battery, rssi)
+	'''
+	def merge(self, seriesKey, reqJson, now=None, interval=None):
+		if now is None:
+			now = time.time()
+
+		rows = self.chartRows(reqJson)
+		if len(rows) == 0:
+			return []
+
+		timestamps = self.chartTimestamps(reqJson, len(rows))
+
+		with self.lock:
+			if timestamps is not None:
+				last = self.db.execute(
+					"SELECT MAX(ts) FROM points WHERE series=?", (seriesKey,)).fetchone()[0]
+				added = [(ts,) + row for ts, row in zip(timestamps, rows) if last is None or ts > last]
+			else:
+				added = self.alignRows(seriesKey, rows, int(now), interval or self.pointInterval)
+
+			if len(added) > 0:
+				with self.db:
+					self.db.executemany(
+						"INSERT OR REPLACE INTO points (series, ts, ph, orp, battery, rssi) VALUES (?,?,?,?,?,?)",
+						[(seriesKey,) + point for point in added])
+					self.updateRollups(seriesKey, added)
+
+		return added
+
+	'''bucketStart()
+	Returns the start of the rollup bucket of a timestamp
+	'''
+	def bucketStart(self, resolution, ts):
+		size, offset = self.resolutions[resolution]
+		return (int(ts) - offset) // size * size + offset
+
+	'''updateRollups()
+	Adds new points to the rollups of a series, call with the lock
+	held inside a transaction
+	'''
+	def updateRollups(self, seriesKey, points):
+		buckets = {}
+		for point in points:
+			for resolution in self.resolutions:
+				bucket = self.bucketStart(resolution, point[0])
+				for index, (key, metric) in enumerate(self.columns):
+					value = point[index + 1]
+					if value is None:
+						continue
+					value = float(value)
+					stats = buckets.get((resolution, metric, bucket))
+					if stats is None:
+						buckets[(resolution, metric, bucket)] = [1, value, value, value]
+					else:
+						stats[0] += 1
+						stats[1] += value
+						stats[2] = min(stats[2], value)
+						stats[3] = max(stats[3], value)
+
+		for (resolution, metric, bucket), stats in buckets.items():
+			stored = self.db.execute(
+				"SELECT count, sum, min, max FROM rollups WHERE series=? AND resolution=? AND metric=? AND bucket=?",
+				(seriesKey, resolution, metric, bucket)).fetchone()
+			if stored is not None:
+				stats = [stored[0] + stats[0], stored[1] + stats[1], min(stored[2], stats[2]), max(stored[3], stats[3])]
+			self.db.execute(
+				"INSERT OR REPLACE INTO rollups (series, resolution, metric, bucket, count, sum, min, max) VALUES (?,?,?,?,?,?,?,?)",
+				(seriesKey, resolution, metric, bucket) + tuple(stats))
+
+	'''rebuildRollups()
+	Computes all rollups from the stored points, call with the lock
+	held inside a transaction
+	'''
+	def rebuildRollups(self):
+		self.db.execute("DELETE FROM rollups")
+		for resolution, (size, offset) in self.resolutions.items():
+			for key, metric in self.columns:
+				self.db.execute(
+					"INSERT INTO rollups (series, resolution, metric, bucket, count, sum, min, max) "
+					"SELECT series, ?, ?, (ts - ?) / ? * ? + ?, COUNT({0}), SUM({0}), MIN({0}), MAX({0}) "
+					"FROM points WHERE {0} IS NOT NULL GROUP BY series, (ts - ?) / ?".format(metric),
+					(resolution, metric, offset, size, size, offset, offset, size))
+
+	'''rollup()
+	Returns the rollups of one metric (ph, orp, battery or rssi) of a
+	series as a list of (bucket, count, mean, min, max), oldest first
+
+	resolution - hour, day or week
+	start, end - Epoch seconds, buckets starting in the range are
+		returned, None for no limit
+	'''
+	def rollup(self, seriesKey, metric, resolution="day", start=None, end=None):
+		if resolution not in self.resolutions:
+			raise ValueError("Unknown resolution %s!" % resolution)
+		sql = ("SELECT bucket, count, sum / count, min, max FROM rollups "
+			"WHERE series=? AND resolution=? AND metric=?")
+		args = [seriesKey, resolution, metric]
+		if start is not None:
+			sql += " AND bucket>=?"
+			args.append(self.bucketStart(resolution, start))
+		if end is not None:
+			sql += " AND bucket<=?"
+			args.append(int(end))
+		sql += " ORDER BY bucket"
+
+		with self.lock:
+			return self.db.execute(sql, args).fetchall()
+
+	'''getCheckpoint()
+	Returns the backfill checkpoint of a chart route as a python
+	dictionary object, or None. points is None for a route that
+	could not be stored (no timestamps).
+	'''
+	def getCheckpoint(self, route):
+		with self.lock:
+			row = self.db.execute(
+				"SELECT route, vessel, chart, etag, lastModified, fetched, points FROM checkpoints WHERE route=?",
+				(route,)).fetchone()
+		if row is None:
+			return None
+		return dict(zip(("route", "vessel", "chart", "etag", "lastModified", "fetched", "points"), row))
+
+	def setCheckpoint(self, route, vessel, chart, etag, lastModified, fetched, points):
+		with self.lock, self.db:
+			self.db.execute(
+				"INSERT OR REPLACE INTO checkpoints (route, vessel, chart, etag, lastModified, fetched, points) "
+				"VALUES (?,?,?,?,?,?,?)",
+				(route, vessel, chart, etag, lastModified, int(fetched), points))
+
+	'''getCheckpoints()
+	Returns the backfill checkpoints of a vessel, or of all vessels
+	'''
+	def getCheckpoints(self, vessel=None):
+		sql = "SELECT route FROM checkpoints"
+		args = []
+		if vessel is not None:
+			sql += " WHERE vessel=?"
+			args.append(vessel)
+		with self.lock:
+			routes = [row[0] for row in self.db.execute(sql, args)]
+		return [self.getCheckpoint(route) for route in routes]
+
+	'''chartRows()
+	Returns the chart as a list of (ph, orp, battery, rssi) rows
+	'''
+	def chartRows(self, reqJson):
+		columns = [reqJson.get(key) or [] for key, column in self.columns]
+		length = max(len(column) for column in columns)
+		if length == 0:
+			return []
+
+		#Series of different lengths are aligned on the latest point
+		rows = []
+		for index in range(length):
+			row = []
+			for column in columns:
+				offset = index - (length - len(column))
+				row.append(column[offset] if offset >= 0 else None)
+			rows.append(tuple(row))
+		return rows
+
+	'''chartTimestamps()
+	Returns the epoch seconds of the chart points, or None if the
+	chart has no usable timestamps
+
+	length - Number of points, None for the number of chart rows
+	'''
+	def chartTimestamps(self, reqJson, length=None):
+		if length is None:
+			length = len(self.chartRows(reqJson))
+		for key in self.timestampKeys:
+			values = reqJson.get(key)
+			if not values or len(values) != length:
+				continue
+			try:
+				return [self.toEpoch(value) for value in values]
+			except (TypeError, ValueError):
+				self.logger.error("Not able to read chart timestamps %s", key)
+		return None
+
+	def toEpoch(self, value):
+		if isinstance(value, (int, float)):
+			#milliseconds
+			if value > 1e11:
+				value = value / 1000.0
+			return int(value)
+		value = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+		if value.tzinfo is None:
+			value = value.replace(tzinfo=datetime.timezone.utc)
+		return int(value.timestamp())
+
+	'''alignRows()
+	Finds the largest overlap between the stored tail and the start
+	of the chart and returns the dated points after the overlap
+	'''
+	def alignRows(self, seriesKey, rows, now, interval):
+		tail = self.db.execute(
+			"SELECT ts, ph, orp, battery, rssi FROM points WHERE series=? ORDER BY ts DESC LIMIT ?",
+			(seriesKey, len(rows))).fetchall()
+		tail.reverse()
+		tailRows = [tuple(point[1:]) for point in tail]
+
+		overlap = 0
+		for size in range(min(len(tailRows), len(rows)), 0, -1):
+			if tailRows[-size:] == rows[:size]:
+				overlap = size
+				break
+
+		newRows = rows[overlap:]
+		lastTs = tail[-1][0] if len(tail) > 0 else None
+
+		added = []
+		for index, row in enumerate(newRows):
+			ts = now - (len(newRows) - 1 - index) * interval
+			if lastTs is not None and ts <= lastTs:
+				ts = lastTs + 1
+			lastTs = ts
+			added.append((ts,) + row)
+		return added
+
+	'''query()
+	Returns the points of a series in a time range as a list of
+	(ts, ph, orp, battery, rssi), oldest first
+
+	start, end - Epoch seconds, inclusive, None for no limit
+	'''
+	def query(self, seriesKey, start=None, end=None):
+		sql = "SELECT ts, ph, orp, battery, rssi FROM points WHERE series=?"
+		args = [seriesKey]
+		if start is not None:
+			sql += " AND ts>=?"
+			args.append(int(start))
+		if end is not None:
+			sql += " AND ts<=?"
+			args.append(int(end))
+		sql += " ORDER BY ts"
+
+		with self.lock:
+			return self.db.execute(sql, args).fetchall()
+
+	'''latest()
+	Returns the last count points of a series, oldest first
+	'''
+	def latest(self, seriesKey, count):
+		with self.lock:
+			points = self.db.execute(
+				"SELECT ts, ph, orp, battery, rssi FROM points WHERE series=? ORDER BY ts DESC LIMIT ?",
+				(seriesKey, count)).fetchall()
+		points.reverse()
+		return points
+
+	'''getSeries()
+	Returns the keys of all stored series
+	'''
+	def getSeries(self):
+		with self.lock:
+			return [row[0] for row in self.db.execute("SELECT DISTINCT series FROM points")]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+pyPhinTrace - Tracing and profiling helpers for pyPhin
+
+pHin calls the hooks added with pHin.addHook() with a span, a python
+dictionary object describing one request or parse stage:
+
+	onRequestStart - {"kind": "request", "method", "route", "url",
+		"acceptVersion", "started"}
+	onRequestEnd - the same span with "status", "bytes", "duration",
+		"exception" and "phases" added
+	onParse - {"kind": "parse", "stage", "source", "started", "duration"}
+
+phases splits the duration of a request in seconds: "dns" (name
+resolution, only for new connections), "connect" (TCP, new connections),
+"tls" (handshake, new connections), "serverWait" (request sent until the
+response headers arrived) and "transfer" (reading the body). dns,
+connect and tls are only recorded while request hooks are added, the
+client then uses the connection pools of tracePoolClasses.
+
+jsonTracer writes every finished span as a JSON line, profile() runs a
+call under cProfile. cProfile only sees the thread it runs on, so the
+requests of a profiled client run one after another on that thread.
+
+	tracer = jsonTracer("phin-trace.jsonl").attach(client)
+	client.getVesselsData(authToken, deviceUUID, vesselUrls)
+	tracer.close()
+
+"""
+
+import io
+import json
+import time
+import socket
+import pstats
+import cProfile
+import threading
+from concurrent.futures import Future
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.connection import allowed_gai_family
+
+
+#Connection timings of the request running on this thread
+connectionPhases = threading.local()
+
+
+'''resetPhases()
+Clears the connection timings of this thread before a request
+'''
+def resetPhases():
+	connectionPhases.dns = 0.0
+	connectionPhases.connect = 0.0
+	connectionPhases.tls = 0.0
+
+
+'''getPhases()
+Returns the connection timings recorded on this thread since
+resetPhases()
+'''
+def getPhases():
+	return {"dns":getattr(connectionPhases, "dns", 0.0),
+		"connect":getattr(connectionPhases, "connect", 0.0),
+		"tls":getattr(connectionPhases, "tls", 0.0)}
+
+
+'''newConnection()
+Opens the socket of a urllib3 connection with the name resolution
+timed on its own. The host is resolved once with the address family
+urllib3 would use to time the lookup, the socket is then opened by
+urllib3 itself, which resolves again (usually from the resolver
+cache) and picks the address. The lookup time is taken off the
+connect time.
+'''
+def newConnection(connection, newConn):
+	started = time.time()
+	try:
+		socket.getaddrinfo(connection.host.strip("[]"), connection.port, allowed_gai_family(), socket.SOCK_STREAM)
+	except (socket.gaierror, UnicodeError):
+		#urllib3 fails the same way below and raises its own error
+		pass
+	connectionPhases.dns = time.time() - started
+
+	started = time.time()
+	try:
+		return newConn(connection)
+	finally:
+		connectionPhases.connect = max(0.0, time.time() - started - connectionPhases.dns)
+
+
+class tracedHTTPConnection(HTTPConnection):
+
+	def _new_conn(self):
+		return newConnection(self, HTTPConnection._new_conn)
+
+
+class tracedHTTPSConnection(HTTPSConnection):
+
+	def _new_conn(self):
+		return newConnection(self, HTTPSConnection._new_conn)
+
+	def connect(self):
+		started = time.time()
+		try:
+			return HTTPSConnection.connect(self)
+		finally:
+			connectionPhases.tls = max(0.0, time.time() - started
+				- getattr(connectionPhases, "dns", 0.0) - getattr(connectionPhases, "connect", 0.0))
+
+
+class tracedHTTPConnectionPool(HTTPConnectionPool):
+	ConnectionCls = tracedHTTPConnection
+
+
+class tracedHTTPSConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = tracedHTTPSConnection
+
+
+'''tracePoolClasses
+Connection pools of a urllib3 PoolManager that record DNS,
+connect and TLS handshake times, pHin only uses them while
+request hooks are added
+'''
+tracePoolClasses = {"http":tracedHTTPConnectionPool, "https":tracedHTTPSConnectionPool}
+
+
+'''jsonTracer
+Writes finished request and parse spans as JSON lines
+
+path - File the spans are appended to
+'''
+class jsonTracer():
+
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.file = open(path, "a")
+		self.clients = []
+
+	'''attach()
+	Adds the tracer to the hooks of a pHin client
+	'''
+	def attach(self, client):
+		client.addHook("onRequestEnd", self.write)
+		client.addHook("onParse", self.write)
+		self.clients.append(client)
+		return self
+
+	def detach(self, client):
+		client.removeHook("onRequestEnd", self.write)
+		client.removeHook("onParse", self.write)
+		self.clients.remove(client)
+
+	def write(self, span):
+		line = json.dumps(span, default=str, sort_keys=True)
+		with self.lock:
+			if self.file is not None:
+				self.file.write(line + "\n")
+				self.file.flush()
+
+	def close(self):
+		for client in list(self.clients):
+			self.detach(client)
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+
+'''serialExecutor
+Runs submitted calls at once on the calling thread
+'''
+class serialExecutor():
+
+	def submit(self, fn, *args, **kwargs):
+		future = Future()
+		try:
+			future.set_result(fn(*args, **kwargs))
+		except Exception as e:
+			future.set_exception(e)
+		return future
+
+	def shutdown(self, wait=True):
+		pass
+
+
+'''profile()
+Runs call() under cProfile and writes the statistics, sorted by
+cumulative time, to path
+
+client - pHin client used by call, its requests are run on the
+	profiled thread
+
+Returns (result of call, statistics text)
+'''
+def profile(call, path=None, limit=40, client=None):
+	if client is not None:
+		executor = client.executor
+		client.executor = serialExecutor()
+
+	profiler = cProfile.Profile()
+	profiler.enable()
+	try:
+		result = call()
+	finally:
+		profiler.disable()
+		if client is not None:
+			client.executor = executor
+
+	output = io.StringIO()
+	stats = pstats.Stats(profiler, stream=output)
+	stats.sort_stats("cumulative").print_stats(limit)
+	text = output.getvalue()
+
+	if path is not None:
+		with open(path, "w") as statsFile:
+			statsFile.write(text)
+
+	return result, text
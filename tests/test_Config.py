@@ -0,0 +1,91 @@
+import logging
+
+import pytest
+
+from nodes.Config import Config
+
+
+TOKEN = "t" * 40
+ROUTE = "/users/1/locations/0/vessels"
+
+
+def test_empty_config():
+	config = Config()
+	assert config.email is None
+	assert config.authToken is None
+	assert config.vesselUrls is None
+	assert config.logLevel == 10
+	assert config.mqttTopic == "phin"
+
+
+def test_values_that_are_too_short_or_invalid_are_none():
+	config = Config({"email":"Enter your email", "uuid":"short", "authtoken":"t" * 39,
+		"verifyurl":"/signincontact/v/1", "vesselurl":"/v"})
+	assert config.email is None
+	assert config.uuid is None
+	assert config.authToken is None
+	assert config.verifyUrl is None
+	assert config.vesselUrl is None
+
+
+def test_valid_registration():
+	config = Config({"email":"someone@example.com", "uuid":"00000000-0000-4000-8000-000000000000",
+		"verifyurl":"/signincontact/verify/1", "authtoken":TOKEN})
+	assert config.email == "someone@example.com"
+	assert config.uuid == "00000000-0000-4000-8000-000000000000"
+	assert config.verifyUrl == "/signincontact/verify/1"
+	assert config.authToken == TOKEN
+
+
+@pytest.mark.parametrize("code, expected", [
+	("12345", "12345"),
+	("<Enter activation code>", None),
+	("12345678901", None),
+	("", None)])
+def test_activation_code(code, expected):
+	assert Config({"activationcode":code}).activationCode == expected
+
+
+def test_vessel_urls_fall_back_to_the_single_vessel_url():
+	assert Config({"vesselurl":ROUTE}).vesselUrls == (ROUTE,)
+	assert Config({"vesselurl":ROUTE, "vesselurls":'["%s", "/users/1/locations/1/vessels"]' % ROUTE}).vesselUrls == (
+		ROUTE, "/users/1/locations/1/vessels")
+	assert Config({"vesselurl":ROUTE, "vesselurls":"[]"}).vesselUrls == (ROUTE,)
+
+
+def test_invalid_vessel_urls_are_logged(caplog):
+	with caplog.at_level(logging.ERROR):
+		config = Config({"vesselurl":ROUTE, "vesselurls":"not json"}, logging.getLogger("test"))
+	assert config.vesselUrls == (ROUTE,)
+	assert "invalid_vesselurls" in caplog.text
+
+
+@pytest.mark.parametrize("mqtthost, host, port", [
+	("localhost", "localhost", 1883),
+	("broker:1884", "broker", 1884),
+	("broker:abc", None, 1883),
+	("", None, 1883)])
+def test_mqtt_host(mqtthost, host, port):
+	config = Config({"mqtthost":mqtthost})
+	assert (config.mqttHost, config.mqttPort) == (host, port)
+
+
+@pytest.mark.parametrize("loglevel, expected", [("20", 20), ("100", 50), ("-5", 0), ("debug", 10)])
+def test_log_level_is_clamped(loglevel, expected):
+	assert Config({"loglevel":loglevel}).logLevel == expected
+
+
+def test_config_is_read_only_and_matches_its_params():
+	params = {"authtoken":TOKEN}
+	config = Config(params)
+	with pytest.raises(AttributeError):
+		config.authToken = None
+	with pytest.raises(TypeError):
+		config.params["authtoken"] = None
+
+	params["authtoken"] = "x"
+	assert config.authToken == TOKEN
+	assert config.matches({"authtoken":TOKEN})
+	assert not config.matches(params)
+	assert config.get("authtoken") == TOKEN
+	assert config.get("email") is None
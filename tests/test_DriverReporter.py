@@ -0,0 +1,107 @@
+import threading
+
+from nodes.DriverReporter import DriverReporter
+
+
+class recordingNode():
+
+	def __init__(self):
+		self.reports = []
+
+	def setDriver(self, driver, value, force=False):
+		self.reports.append((driver, value, force))
+
+
+def createReporter(heartbeat=3600):
+	node = recordingNode()
+	return node, DriverReporter(node, {"GV1":0.05, "GV7":5}, heartbeat)
+
+
+def test_first_value_is_forced():
+	node, reporter = createReporter()
+	assert reporter.setDriver("GV1", 7.2, now=0)
+	assert node.reports == [("GV1", 7.2, True)]
+
+
+def test_changes_inside_the_deadband_are_not_reported():
+	node, reporter = createReporter()
+	reporter.setDriver("GV1", 7.2, now=0)
+	assert not reporter.setDriver("GV1", 7.24, now=10)
+	assert reporter.setDriver("GV1", 7.25, now=20)
+	assert not reporter.setDriver("GV1", 7.21, now=30)
+	assert node.reports == [("GV1", 7.2, True), ("GV1", 7.25, False)]
+
+
+def test_deadband_is_measured_from_the_last_reported_value():
+	node, reporter = createReporter()
+	reporter.setDriver("GV7", 700, now=0)
+	for value in (703, 706, 709):
+		reporter.setDriver("GV7", value, now=10)
+	assert node.reports == [("GV7", 700, True), ("GV7", 706, False)]
+
+
+def test_drivers_without_deadband_report_any_change():
+	node, reporter = createReporter()
+	reporter.setDriver("ST", 1, now=0)
+	assert not reporter.setDriver("ST", 1.0, now=1)
+	assert reporter.setDriver("ST", 2, now=2)
+	assert reporter.setDriver("GV20", "ok", now=3)
+	assert not reporter.setDriver("GV20", "ok", now=4)
+
+
+def test_heartbeat_reports_unchanged_values():
+	node, reporter = createReporter(heartbeat=100)
+	reporter.setDriver("GV1", 7.2, now=0)
+	assert not reporter.setDriver("GV1", 7.2, now=99)
+	assert reporter.setDriver("GV1", 7.2, now=100)
+	assert node.reports[-1] == ("GV1", 7.2, True)
+
+
+def test_reset_reports_everything_again():
+	node, reporter = createReporter()
+	reporter.setDriver("GV1", 7.2, now=0)
+	reporter.reset()
+	assert reporter.setDriver("GV1", 7.2, now=1)
+
+
+def test_batch_reports_the_last_value_when_it_ends():
+	node, reporter = createReporter()
+	with reporter.batch():
+		assert reporter.setDriver("GV1", 7.0, now=0) is None
+		reporter.setDriver("GV1", 7.3, now=1)
+		reporter.setDriver("GV7", 650, now=1)
+		assert node.reports == []
+	assert sorted(node.reports) == [("GV1", 7.3, True), ("GV7", 650, True)]
+
+
+def test_nested_batches_report_once_the_outermost_ends():
+	node, reporter = createReporter()
+	with reporter.batch():
+		with reporter.batch():
+			reporter.setDriver("GV1", 7.0, now=0)
+		assert node.reports == []
+	assert node.reports == [("GV1", 7.0, True)]
+
+
+def test_batch_reports_even_if_the_block_fails():
+	node, reporter = createReporter()
+	try:
+		with reporter.batch():
+			reporter.setDriver("GV1", 7.0, now=0)
+			raise RuntimeError()
+	except RuntimeError:
+		pass
+	assert node.reports == [("GV1", 7.0, True)]
+
+
+def test_other_threads_are_not_held_up_by_a_batch():
+	node, reporter = createReporter()
+	reported = []
+	with reporter.batch():
+		reporter.setDriver("GV1", 7.0, now=0)
+		thread = threading.Thread(target=lambda: reported.append(reporter.setDriver("GV7", 650, now=0)))
+		thread.start()
+		thread.join(5)
+		assert reported == [True]
+		assert node.reports == [("GV7", 650, True)]
+	assert node.reports[-1] == ("GV1", 7.0, True)
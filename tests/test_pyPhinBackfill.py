@@ -0,0 +1,91 @@
+import pytest
+
+from pyPhin import pHin
+from pyPhinBackfill import pHinBackfill
+from pyPhinFakeServer import fakeServer
+from pyPhinStore import pHinStore
+
+
+class undatedServer(fakeServer):
+
+	#Month charts like the real service sends them, without timestamps
+	def chart(self, *args, **kwargs):
+		chart = fakeServer.chart(self, *args, **kwargs)
+		chart.pop("timestamps", None)
+		return chart
+
+
+def run(serverClass, polled=True):
+	server = serverClass(historyPoints=48).start()
+	client = pHin(baseUrl=server.url)
+	store = pHinStore(":memory:")
+	authToken, deviceUUID, vesselUrl = server.getAccount(0)
+	if polled:
+		client.getVesselsData(authToken, deviceUUID, [vesselUrl])
+	backfill = pHinBackfill(client, store)
+	return server, client, store, backfill, lambda now: backfill.run(authToken, deviceUUID, [vesselUrl], now)
+
+
+@pytest.fixture
+def dated():
+	server, client, store, backfill, runAt = run(fakeServer)
+	yield server, store, backfill, runAt
+	client.close()
+	server.stop()
+
+
+@pytest.fixture
+def undated():
+	server, client, store, backfill, runAt = run(undatedServer)
+	yield server, store, backfill, runAt
+	client.close()
+	server.stop()
+
+
+def test_leaves_the_polled_chart_to_the_poll(dated):
+	server, store, backfill, runAt = dated
+	summary = runAt(1000)
+	assert summary["polled"] == 1
+	assert summary["fetched"] == 1
+	assert summary["points"] == 48
+	assert server.getCounts() == {"vessels":1, "chart":1, "chart_month":1}
+	assert list(backfill.getRoutes("vessel-0-0-0")) == ["appChartsMonth"]
+
+
+def test_checkpoint_skips_recent_and_revalidates_old_routes(dated):
+	server, store, backfill, runAt = dated
+	runAt(1000)
+	assert runAt(1000 + backfill.minInterval - 1)["skipped"] == 1
+
+	#Nothing changed on the server, the checkpoint validators are sent
+	assert runAt(1000 + backfill.minInterval)["notModified"] == 1
+	assert server.getCounts()["chart_month_not_modified"] == 1
+
+	server.advance()
+	summary = runAt(1000 + 2 * backfill.minInterval)
+	assert summary["fetched"] == 1
+	assert summary["points"] == 1
+
+
+def test_undated_chart_is_downloaded_once(undated):
+	server, store, backfill, runAt = undated
+	assert runAt(1000)["undated"] == 1
+	assert runAt(1000 + 10 * backfill.minInterval)["undated"] == 1
+	assert server.getCounts()["chart_month"] == 1
+	assert store.getSeries() == []
+	assert backfill.getRoutes("vessel-0-0-0") == {}
+
+
+def test_vessels_are_requested_for_locations_not_polled():
+	server, client, store, backfill, runAt = run(fakeServer, polled=False)
+	try:
+		#Without a poll the weekly chart is backfilled too, dated
+		#by its known point spacing
+		summary = runAt(1000)
+		assert summary["polled"] == 0
+		assert summary["fetched"] == 2
+		assert server.getCounts() == {"vessels":1, "chart":1, "chart_month":1}
+		assert sorted(backfill.getRoutes("vessel-0-0-0")) == ["appChartsMonth", "appChartsWeek"]
+	finally:
+		client.close()
+		server.stop()
@@ -0,0 +1,87 @@
+import pytest
+
+from pyPhinBreaker import circuitBreaker, pHinCircuitOpen
+
+
+URL = "https://api.phin.co/users/12/locations/3/vessels"
+
+
+def openCircuit(breaker, now):
+	endpoint = breaker.before("GET", URL, now)
+	for index in range(breaker.failureThreshold):
+		breaker.record(endpoint, 503, now=now)
+	return endpoint
+
+
+def test_endpoint_replaces_ids():
+	breaker = circuitBreaker()
+	assert breaker.endpoint("GET", URL + "?x=1") == "GET /users/*/locations/*/vessels"
+	assert breaker.endpoint("GET", "https://api.phin.co/users/99/locations/0/vessels") == breaker.endpoint("GET", URL)
+
+
+def test_opens_after_threshold_failures_in_a_row():
+	breaker = circuitBreaker(failureThreshold=3, baseDelay=10, jitter=0)
+	endpoint = breaker.before("GET", URL, 0)
+	breaker.record(endpoint, 500, now=0)
+	breaker.record(endpoint, 200, now=0)
+	breaker.record(endpoint, 500, now=0)
+	breaker.record(endpoint, 429, now=0)
+	breaker.before("GET", URL, 0)
+
+	breaker.record(endpoint, 502, now=0)
+	with pytest.raises(pHinCircuitOpen) as error:
+		breaker.before("GET", URL, 5)
+	assert error.value.endpoint == endpoint
+	assert error.value.retryAt == 10
+
+
+def test_client_errors_do_not_count():
+	breaker = circuitBreaker(failureThreshold=1)
+	endpoint = breaker.before("GET", URL, 0)
+	breaker.record(endpoint, 401, now=0)
+	breaker.record(endpoint, 404, now=0)
+	assert breaker.before("GET", URL, 0) == endpoint
+
+
+def test_half_open_trial_closes_or_reopens():
+	breaker = circuitBreaker(failureThreshold=2, baseDelay=10, jitter=0)
+	endpoint = openCircuit(breaker, 0)
+
+	#One trial after the delay, the next request still fails fast
+	assert breaker.before("GET", URL, 10) == endpoint
+	assert breaker.getState()[endpoint]["state"] == circuitBreaker.HALF_OPEN
+	with pytest.raises(pHinCircuitOpen):
+		breaker.before("GET", URL, 10)
+
+	#A failed trial doubles the delay
+	breaker.record(endpoint, 500, now=10)
+	assert breaker.getState()[endpoint] == {"state":circuitBreaker.OPEN, "failures":3, "retryAt":30}
+
+	breaker.before("GET", URL, 30)
+	breaker.record(endpoint, 200, now=30)
+	assert breaker.getState()[endpoint]["state"] == circuitBreaker.CLOSED
+	assert breaker.before("GET", URL, 30) == endpoint
+
+
+def test_delay_is_capped_and_jittered():
+	breaker = circuitBreaker(baseDelay=5, maxDelay=60, jitter=0.5, seed=1)
+	for opened in range(1, 10):
+		delay = min(5 * 2 ** (opened - 1), 60)
+		assert delay * 0.5 <= breaker.getDelay(opened) <= delay
+
+
+def test_retry_after_opens_at_once():
+	breaker = circuitBreaker(failureThreshold=5, baseDelay=1, jitter=0)
+	endpoint = breaker.before("GET", URL, 0)
+	breaker.record(endpoint, 429, retryAfter="120", now=0)
+	with pytest.raises(pHinCircuitOpen) as error:
+		breaker.before("GET", URL, 60)
+	assert error.value.retryAt == 120
+
+
+def test_parse_retry_after():
+	breaker = circuitBreaker()
+	assert breaker.parseRetryAfter("30") == 30.0
+	assert breaker.parseRetryAfter("Thu, 01 Jan 1970 00:02:00 GMT", now=60) == 60.0
+	assert breaker.parseRetryAfter("soon") is None
+	assert breaker.parseRetryAfter(None) is None
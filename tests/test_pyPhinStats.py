@@ -0,0 +1,95 @@
+import math
+
+import pytest
+
+import pyPhinStats
+
+
+@pytest.fixture(params=["numpy", "python"])
+def stats(request, monkeypatch):
+	if request.param == "python":
+		monkeypatch.setattr(pyPhinStats, "numpy", None)
+	elif pyPhinStats.numpy is None:
+		pytest.skip("NumPy is not installed")
+	return pyPhinStats
+
+
+def test_tail_skips_missing_points():
+	assert pyPhinStats.tail([1, None, 2, 3, None], 2) == [2.0, 3.0]
+	assert pyPhinStats.tail([None, None], 3) == []
+	assert pyPhinStats.tail([1, 2], 5) == [1.0, 2.0]
+
+
+def test_mean_of_short_series_uses_all_points():
+	assert pyPhinStats.mean([7.0, None, 8.0], 24) == 7.5
+	with pytest.raises(ValueError):
+		pyPhinStats.mean([None], 24)
+
+
+def test_sma(stats):
+	assert stats.sma([1, 2, 3, 4], 2) == [1.5, 2.5, 3.5]
+	assert stats.sma([1, 2], 3) == []
+
+
+def test_ewma_last_weights_recent_points(stats):
+	assert stats.ewmaLast([5.0], 0.5) == 5.0
+	assert stats.ewmaLast([1.0, 2.0], 0.5) == pytest.approx((0.5 * 1 + 2) / 1.5)
+
+
+def test_slope(stats):
+	assert stats.slope([1, 3, 5, 7]) == pytest.approx(2.0)
+	assert stats.slope([1, 2, 3], x=[0, 10, 20]) == pytest.approx(0.1)
+	assert stats.slope([4]) == 0.0
+
+
+def test_robust_mean_rejects_outliers():
+	assert pyPhinStats.robustMean([7.0, 7.2, 7.1, 7.3, 14.0]) == pytest.approx(7.15)
+
+
+def test_last_windows_empties_invalid_series():
+	assert pyPhinStats.lastWindows([[1, None, 2, 3], "x", 5, [1, 2]], [2, 1, 1, 0]) == [[2.0, 3.0], [], [], []]
+
+
+def test_window_means(stats):
+	means = stats.windowMeans([[1, None, 2, 3, None], [None], [7.0] * 100, []], [2, 3, 24, 4])
+	assert means == [2.5, None, 7.0, None]
+
+
+def test_summarize_many_matches_summarize(stats):
+	series = [[7.0 + 0.1 * math.sin(index) for index in range(50)], [None, None], [650, 700, None, 720]]
+	summaries = stats.summarizeMany(series, 24)
+	assert summaries[1] is None
+	for values, summary in zip([series[0], series[2]], [summaries[0], summaries[2]]):
+		expected = stats.summarize(values, 24)
+		assert summary.keys() == expected.keys()
+		for key in expected:
+			assert summary[key] == pytest.approx(expected[key])
+
+
+def test_welford():
+	stream = pyPhinStats.welford()
+	for value in (2, 4, 4, 4, 5, 5, 7, 9, None):
+		stream.update(value)
+	assert stream.count == 8
+	assert stream.mean == pytest.approx(5.0)
+	assert stream.variance() == pytest.approx(32.0 / 7)
+
+
+def test_online_trend_follows_a_linear_drift():
+	trend = pyPhinStats.onlineTrend()
+	for hour in range(48):
+		trend.update(hour * 3600, 7.0 + 0.01 * hour)
+	assert trend.slope() == pytest.approx(0.01)
+	assert trend.predict() == pytest.approx(7.47)
+	assert trend.timeToThreshold(high=7.8) == pytest.approx(33.0)
+	assert trend.timeToThreshold(low=7.2) is None
+
+
+def test_online_trend_ignores_old_and_missing_points():
+	trend = pyPhinStats.onlineTrend()
+	assert trend.update(3600, 7.0)
+	assert not trend.update(3600, 7.5)
+	assert not trend.update(0, 7.5)
+	assert not trend.update(7200, None)
+	assert trend.count == 1
+	assert trend.slope() == 0.0
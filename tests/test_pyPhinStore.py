@@ -0,0 +1,75 @@
+import pytest
+
+from pyPhinStore import pHinStore
+
+
+DAY = 86400
+
+
+@pytest.fixture
+def store():
+	store = pHinStore(":memory:")
+	yield store
+	store.close()
+
+
+def chart(ph, timestamps=None):
+	reqJson = {"ph":ph, "orpMv":[700.0] * len(ph)}
+	if timestamps is not None:
+		reqJson["timestamps"] = timestamps
+	return reqJson
+
+
+def test_merge_with_timestamps_adds_only_new_points(store):
+	assert len(store.merge("month", chart([7.0, 7.2], [DAY, DAY + 3600]))) == 2
+	added = store.merge("month", chart([7.2, 7.4], [DAY + 3600, DAY + 7200]))
+	assert added == [(DAY + 7200, 7.4, 700.0, None, None)]
+	assert [point[:2] for point in store.query("month")] == [(DAY, 7.0), (DAY + 3600, 7.2), (DAY + 7200, 7.4)]
+
+
+def test_timestamps_in_milliseconds_and_iso(store):
+	assert store.chartTimestamps(chart([7.0], [1700000000123])) == [1700000000]
+	assert store.chartTimestamps(chart([7.0], ["1970-01-02T00:00:00Z"])) == [DAY]
+	assert store.chartTimestamps(chart([7.0, 7.1], [DAY])) is None
+	assert store.chartTimestamps(chart([7.0])) is None
+
+
+def test_merge_without_timestamps_aligns_on_the_stored_tail(store):
+	store.merge("week", chart([7.0, 7.1, 7.2]), now=10 * 3600)
+	added = store.merge("week", chart([7.1, 7.2, 7.3, 7.4]), now=12 * 3600)
+	assert [point[:2] for point in added] == [(11 * 3600, 7.3), (12 * 3600, 7.4)]
+	assert [point[0] for point in store.query("week")] == [8 * 3600, 9 * 3600, 10 * 3600, 11 * 3600, 12 * 3600]
+
+
+def test_merge_without_timestamps_uses_the_given_interval(store):
+	added = store.merge("month", chart([7.0, 7.1, 7.2]), now=10 * DAY, interval=DAY)
+	assert [point[0] for point in added] == [8 * DAY, 9 * DAY, 10 * DAY]
+
+
+def test_rollups_follow_the_merged_points(store):
+	store.merge("month", chart([7.0, 7.4, 8.0], [DAY, DAY + 3600, 2 * DAY]))
+	store.merge("month", chart([8.0, 6.0], [2 * DAY, 2 * DAY + 60]))
+	assert store.rollup("month", "ph", "day") == [(DAY, 2, 7.2, 7.0, 7.4), (2 * DAY, 2, 7.0, 6.0, 8.0)]
+	assert store.rollup("month", "ph", "day", start=2 * DAY + 5) == [(2 * DAY, 2, 7.0, 6.0, 8.0)]
+	assert [bucket[:2] for bucket in store.rollup("month", "orp", "week")] == [(-3 * DAY, 4)]
+	with pytest.raises(ValueError):
+		store.rollup("month", "ph", "month")
+
+
+def test_rebuilt_rollups_match_the_incremental_ones(store):
+	store.merge("month", chart([7.0, 7.4, 8.0], [DAY, DAY + 3600, 2 * DAY]))
+	incremental = store.rollup("month", "ph", "hour")
+	with store.lock, store.db:
+		store.rebuildRollups()
+	assert store.rollup("month", "ph", "hour") == incremental
+
+
+def test_checkpoints(store):
+	assert store.getCheckpoint("/charts/month") is None
+	store.setCheckpoint("/charts/month", "vessel-1", "appChartsMonth", '"abc"', None, 100.5, 3)
+	store.setCheckpoint("/charts/day", "vessel-1", "appChartsDay", None, None, 100, None)
+	store.setCheckpoint("/charts/other", "vessel-2", "appChartsMonth", None, None, 100, 0)
+	assert store.getCheckpoint("/charts/month") == {"route":"/charts/month", "vessel":"vessel-1",
+		"chart":"appChartsMonth", "etag":'"abc"', "lastModified":None, "fetched":100, "points":3}
+	assert sorted(checkpoint["route"] for checkpoint in store.getCheckpoints("vessel-1")) == ["/charts/day", "/charts/month"]
+	assert len(store.getCheckpoints()) == 3